@@ -0,0 +1,668 @@
+#
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of the OverDrive Libby Plugin by ping
+# OverDrive Libby Plugin for calibre / libby-calibre-plugin
+#
+# See https://github.com/ping/libby-calibre-plugin for more
+# information
+#
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from timeit import default_timer as timer
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import urlparse
+
+from calibre.constants import __version__ as calibre_version
+from calibre.gui2 import destroy_app, ensure_app
+
+FIXTURES_DIR = Path(__file__).parent.joinpath("fixtures")
+
+benchmark_logger = logging.getLogger(__name__)
+benchmark_logger.setLevel(logging.WARNING)
+
+# name -> setup function that returns the function to be timed
+# and the number of items processed per call
+BENCHMARKS: Dict[str, Callable[["BenchmarkContext"], Tuple[Callable, int]]] = {}
+
+
+def benchmark(name: str):
+    def decorator(setup_fn):
+        BENCHMARKS[name] = setup_fn
+        return setup_fn
+
+    return decorator
+
+
+class BenchmarkContext:
+    def __init__(self, scale: int, library_size: int, temp_dir: Path):
+        self.scale = scale
+        self.library_size = library_size
+        self.temp_dir = temp_dir
+        self._fixtures: Dict[str, object] = {}
+
+    def fixture(self, name: str):
+        if name not in self._fixtures:
+            fixture_path = FIXTURES_DIR.joinpath(name)
+            if fixture_path.suffix == ".json":
+                with fixture_path.open("r", encoding="utf-8") as f:
+                    self._fixtures[name] = json.load(f)
+            else:
+                self._fixtures[name] = fixture_path.read_text(encoding="utf-8")
+        return self._fixtures[name]
+
+    def scaled(self, items: List[Dict]) -> List[Dict]:
+        """
+        Multiply the recorded items by the scale, giving each copy a unique id.
+
+        :param items:
+        :return:
+        """
+        scaled_items = []
+        for n in range(self.scale):
+            for item in items:
+                scaled_item = copy.deepcopy(item)
+                if n and "id" in scaled_item:
+                    scaled_item["id"] = f'{scaled_item["id"]}{n:03d}'
+                scaled_items.append(scaled_item)
+        return scaled_items
+
+    def synced_state(self) -> Dict:
+        synced_state = copy.deepcopy(self.fixture("sync_state.json"))
+        for k in ("loans", "holds", "__subscriptions"):
+            synced_state[k] = self.scaled(synced_state[k])
+        synced_state["search_results"] = self.scaled(
+            self.fixture("search_results.json")["search_results"]
+        )
+        return synced_state
+
+    def library_db(self):
+        """
+        A stand-in for the calibre db with only the fields used by the plugin models.
+
+        :return:
+        """
+        synced_state = self.fixture("sync_state.json")
+        medias = synced_state["loans"] + synced_state["__subscriptions"]
+        titles, formats, identifiers = {}, {}, {}
+        for book_id in range(1, self.library_size + 1):
+            titles[book_id] = f"Calibre Book {book_id}"
+            identifiers[book_id] = {"isbn": f"979{book_id:010d}"}
+            if book_id % 10:
+                formats[book_id] = ("EPUB",)
+        # every 2nd loan and magazine is already in the library
+        for book_id, media in enumerate(medias[::2], start=self.library_size + 1):
+            titles[book_id] = media["title"]
+            formats[book_id] = ("EPUB",)
+        fields = {
+            "title": titles,
+            "formats": formats,
+            "identifiers": identifiers,
+        }
+        return SimpleNamespace(
+            fields={
+                k: SimpleNamespace(table=SimpleNamespace(book_col_map=v))
+                for k, v in fields.items()
+            }
+        )
+
+
+def _api_timestamps(ctx: BenchmarkContext) -> List[str]:
+    synced_state = ctx.synced_state()
+    timestamps = []
+    for media in synced_state["loans"] + synced_state["holds"]:
+        for k in ("checkoutDate", "expireDate", "placedDate", "publishDate"):
+            if media.get(k):
+                timestamps.append(media[k])
+    for media in synced_state["__subscriptions"]:
+        timestamps.append(media["estimatedReleaseDate"])
+    return timestamps
+
+
+@benchmark("libby.parse_datetime")
+def setup_parse_datetime(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.libby import LibbyClient
+
+    timestamps = _api_timestamps(ctx)
+
+    def run():
+        for ts in timestamps:
+            LibbyClient.parse_datetime(ts)
+
+    return run, len(timestamps)
+
+
+@benchmark("libby.parse_datetime.uncached")
+def setup_parse_datetime_uncached(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.libby import LibbyClient
+
+    timestamps = _api_timestamps(ctx)
+
+    def run():
+        for ts in timestamps:
+            LibbyClient._parse_iso_datetime(ts)
+
+    return run, len(timestamps)
+
+
+@benchmark("libby.parse_datetime.strptime")
+def setup_parse_datetime_strptime(ctx: BenchmarkContext):
+    # the previous implementation, for comparison
+    from calibre_plugins.overdrive_libby.libby import LibbyClient
+
+    timestamps = _api_timestamps(ctx)
+
+    def run():
+        for ts in timestamps:
+            LibbyClient._parse_datetime_strptime(ts)
+
+    return run, len(timestamps)
+
+
+@benchmark("sync.merge")
+def setup_sync_merge(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.utils import SqliteCache
+    from calibre_plugins.overdrive_libby.workers import (
+        extract_cached_items,
+        set_subscription_card_ids,
+    )
+
+    synced_state = ctx.synced_state()
+    libraries_cache = SqliteCache(logger=benchmark_logger)
+    media_cache = SqliteCache(logger=benchmark_logger)
+    for library in synced_state["__libraries"]:
+        libraries_cache.put(str(library["websiteId"]), library)
+    magazines = synced_state["__subscriptions"]
+    # half the magazines are cached
+    for magazine in magazines[::2]:
+        media_cache.put(magazine["id"], magazine)
+    website_ids = [str(c["library"]["websiteId"]) for c in synced_state["cards"]]
+    subscriptions = [
+        {"parent_magazine_id": m["parentMagazineTitleId"], "card_id": m["cardId"]}
+        for m in magazines
+    ]
+
+    def run():
+        extract_cached_items(website_ids, libraries_cache)
+        extract_cached_items([m["id"] for m in magazines], media_cache)
+        set_subscription_card_ids(magazines, subscriptions)
+
+    return run, len(website_ids) + len(magazines)
+
+
+def _models(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.models import (
+        LibbyCardsModel,
+        LibbyCardsSortFilterModel,
+        LibbyHoldsModel,
+        LibbyHoldsSortFilterModel,
+        LibbyLoansModel,
+        LibbyLoansSortFilterModel,
+        LibbyMagazinesModel,
+        LibbyMagazinesSortFilterModel,
+        LibbySearchModel,
+        LibbySearchSortFilterModel,
+    )
+
+    db = ctx.library_db()
+    return {
+        "loans": (
+            lambda s: LibbyLoansModel(None, s, db, {}),
+            LibbyLoansSortFilterModel,
+        ),
+        "holds": (lambda s: LibbyHoldsModel(None, s, db), LibbyHoldsSortFilterModel),
+        "cards": (lambda s: LibbyCardsModel(None, s, db), LibbyCardsSortFilterModel),
+        "magazines": (
+            lambda s: LibbyMagazinesModel(None, s, db),
+            LibbyMagazinesSortFilterModel,
+        ),
+        "search": (lambda s: LibbySearchModel(None, s, db), LibbySearchSortFilterModel),
+    }, db
+
+
+def _setup_model_sync(ctx: BenchmarkContext, name: str):
+    models, _ = _models(ctx)
+    model_class, _ = models[name]
+    synced_state = ctx.synced_state()
+    model = model_class(None)
+
+    def run():
+        model.sync(synced_state)
+
+    return run, 1
+
+
+def _setup_model_data(ctx: BenchmarkContext, name: str):
+    from qt.core import Qt
+    from calibre_plugins.overdrive_libby.models import LibbyModel
+
+    models, _ = _models(ctx)
+    model_class, _ = models[name]
+    model = model_class(ctx.synced_state())
+    roles = (Qt.DisplayRole, LibbyModel.DisplaySortRole, Qt.ToolTipRole)
+    indices = [
+        model.index(row, col)
+        for row in range(model.rowCount())
+        for col in range(model.columnCount())
+    ]
+
+    def run():
+        for index in indices:
+            for role in roles:
+                model.data(index, role)
+
+    return run, len(indices) * len(roles)
+
+
+def _setup_model_filter(ctx: BenchmarkContext, name: str):
+    models, db = _models(ctx)
+    model_class, proxy_model_class = models[name]
+    model = model_class(ctx.synced_state())
+    proxy_model = proxy_model_class(None, model=model, db=db)
+    for filter_setter in (
+        "set_filter_hide_books_already_in_library",
+        "set_filter_hide_magazines_already_in_library",
+    ):
+        if hasattr(proxy_model, filter_setter):
+            getattr(proxy_model, filter_setter)(True)
+    filter_texts = ["", "a", "ip", "lorem", ""]
+
+    def run():
+        for filter_text in filter_texts:
+            proxy_model.set_filter_text(filter_text)
+            # bypass the typing delay
+            proxy_model.apply_filter_text()
+
+    return run, model.rowCount() * len(filter_texts)
+
+
+def _setup_model_sort(ctx: BenchmarkContext, name: str):
+    from qt.core import Qt
+
+    models, db = _models(ctx)
+    model_class, proxy_model_class = models[name]
+    model = model_class(ctx.synced_state())
+    proxy_model = proxy_model_class(None, model=model, db=db)
+
+    def run():
+        for col in range(model.columnCount()):
+            for order in (Qt.AscendingOrder, Qt.DescendingOrder):
+                proxy_model.sort(col, order)
+
+    return run, model.columnCount() * 2
+
+
+for model_name in ("loans", "holds", "cards", "magazines", "search"):
+    for bench_name, bench_setup in (
+        ("sync", _setup_model_sync),
+        ("data", _setup_model_data),
+        ("filter", _setup_model_filter),
+        ("sort", _setup_model_sort),
+    ):
+        BENCHMARKS[
+            f"models.{model_name}.{bench_name}"
+        ] = lambda ctx, n=model_name, fn=bench_setup: fn(ctx, n)
+
+
+@benchmark("models.search.sort.1000")
+def setup_search_sort_1000(ctx: BenchmarkContext):
+    # at least 1000 search results, whatever the scale
+    results_count = len(ctx.fixture("search_results.json")["search_results"])
+    scale = max(ctx.scale, -(-1000 // results_count))
+    return _setup_model_sort(
+        BenchmarkContext(scale, ctx.library_size, ctx.temp_dir), "search"
+    )
+
+
+@benchmark("magazine.parse_soup")
+def setup_parse_soup(ctx: BenchmarkContext):
+    from bs4 import BeautifulSoup
+
+    html = ctx.fixture("article.xhtml")
+
+    def run():
+        BeautifulSoup(html, features="html.parser")
+
+    return run, 1
+
+
+@benchmark("magazine.parse_and_cleanup_soup")
+def setup_cleanup_soup(ctx: BenchmarkContext):
+    from bs4 import BeautifulSoup
+    from calibre_plugins.overdrive_libby.magazine_download import _cleanup_soup
+
+    html = ctx.fixture("article.xhtml")
+
+    def run():
+        for version in ("2.0", "3.0"):
+            _cleanup_soup(BeautifulSoup(html, features="html.parser"), version=version)
+
+    return run, 2
+
+
+class RecordedLibbyClient:
+    """
+    Serves the recorded magazine openbook, roster and assets in place of the
+    LibbyClient, so that CustomMagazineDownload can be run offline.
+    """
+
+    def __init__(self, ctx: BenchmarkContext, entries: List[Dict]):
+        self.openbook = ctx.fixture("openbook.json")
+        self.rosters = [{"group": "title-content", "entries": entries}]
+        self.assets: Dict[str, bytes] = {}
+        for entry in entries:
+            path = urlparse(entry["url"]).path
+            if entry["mediaType"] == "text/css":
+                css_name = "issue.css" if "issue" in path else "article.css"
+                self.assets[path] = ctx.fixture(css_name).encode("utf-8")
+            elif entry["mediaType"] == "application/xhtml+xml":
+                self.assets[path] = ctx.fixture("article.xhtml").encode("utf-8")
+            else:
+                # images are already compressed
+                self.assets[path] = os.urandom(64 * 1024)
+
+    def process_ebook(self, loan: Dict):
+        return "https://example.read.overdrive.com/", self.openbook, self.rosters
+
+    @staticmethod
+    def default_headers() -> Dict:
+        return {}
+
+    def send_request(self, endpoint: str, **kwargs) -> bytes:
+        return self.assets[urlparse(endpoint).path]
+
+
+def _setup_magazine_download(ctx: BenchmarkContext, entries: List[Dict]):
+    import shutil
+    import threading
+
+    from calibre_plugins.overdrive_libby.libby.client import LibbyFormats
+    from calibre_plugins.overdrive_libby.magazine_download import (
+        CustomMagazineDownload,
+    )
+
+    magazine = ctx.fixture("sync_state.json")["__subscriptions"][0]
+    libby_client = RecordedLibbyClient(ctx, entries)
+    overdrive_client = SimpleNamespace(media=lambda title_id: magazine)
+    notifications = SimpleNamespace(put=lambda notification: None)
+    download = CustomMagazineDownload()
+
+    def run():
+        epub_file_path = download._custom_download(
+            libby_client,
+            overdrive_client,
+            magazine,
+            LibbyFormats.MagazineOverDrive,
+            "magazine.epub",
+            benchmark_logger,
+            threading.Event(),
+            notifications,
+        )
+        shutil.rmtree(epub_file_path.parent, ignore_errors=True)
+
+    return run, len(entries)
+
+
+@benchmark("magazine.patch_css")
+def setup_patch_css(ctx: BenchmarkContext):
+    # a roster of only stylesheets, so that the css patching dominates
+    css_entries = [
+        e for e in ctx.fixture("roster.json")["entries"] if e["mediaType"] == "text/css"
+    ]
+    entries = [
+        {**e, "url": e["url"].replace(".css", f"_{n}.css")}
+        for n in range(ctx.scale)
+        for e in css_entries
+    ]
+    return _setup_magazine_download(ctx, entries)
+
+
+@benchmark("magazine.zip_epub")
+def setup_zip_epub(ctx: BenchmarkContext):
+    # the full recorded roster, which is mostly images to be zipped
+    return _setup_magazine_download(ctx, ctx.fixture("roster.json")["entries"])
+
+
+@benchmark("magazine.build_opf_package")
+def setup_build_opf_package(ctx: BenchmarkContext):
+    import xml.etree.ElementTree as ET
+
+    from calibre_plugins.overdrive_libby.libby.client import LibbyFormats
+    from calibre_plugins.overdrive_libby.magazine_download_utils import (
+        build_opf_package,
+    )
+
+    synced_state = ctx.synced_state()
+    medias = [(m, LibbyFormats.EBookOverdrive) for m in synced_state["loans"][:10]] + [
+        (m, LibbyFormats.MagazineOverDrive)
+        for m in synced_state["__subscriptions"][:10]
+    ]
+
+    def run():
+        for media_info, loan_format in medias:
+            for version in ("2.0", "3.0"):
+                ET.tostring(
+                    build_opf_package(
+                        media_info, version=version, loan_format=loan_format
+                    )
+                )
+
+    return run, len(medias) * 2
+
+
+def _cache_items(ctx: BenchmarkContext) -> List[Dict]:
+    synced_state = ctx.synced_state()
+    return (
+        synced_state["loans"]
+        + synced_state["holds"]
+        + synced_state["__subscriptions"]
+        + synced_state["search_results"]
+    )
+
+
+@benchmark("cache.simplecache.save")
+def setup_simplecache_save(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.utils import SimpleCache
+
+    items = _cache_items(ctx)
+    cache = SimpleCache(
+        capacity=len(items),
+        persist_to_path=ctx.temp_dir.joinpath("simplecache_save.json"),
+        logger=benchmark_logger,
+    )
+    for item in items:
+        cache.put(item["id"], item)
+
+    def run():
+        cache.save()
+
+    return run, len(items)
+
+
+@benchmark("cache.simplecache.load")
+def setup_simplecache_load(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.utils import SimpleCache
+
+    items = _cache_items(ctx)
+    cache_path = ctx.temp_dir.joinpath("simplecache_load.json")
+    cache = SimpleCache(
+        capacity=len(items), persist_to_path=cache_path, logger=benchmark_logger
+    )
+    for item in items:
+        cache.put(item["id"], item)
+    cache.save()
+
+    def run():
+        SimpleCache(
+            capacity=len(items), persist_to_path=cache_path, logger=benchmark_logger
+        )
+
+    return run, len(items)
+
+
+@benchmark("cache.sqlitecache.save")
+def setup_sqlitecache_save(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.utils import SqliteCache
+
+    items = _cache_items(ctx)
+    cache = SqliteCache(
+        capacity=len(items),
+        persist_to_path=ctx.temp_dir.joinpath("sqlitecache_save.sqlite"),
+        logger=benchmark_logger,
+    )
+
+    def run():
+        for item in items:
+            cache.put(item["id"], item)
+        cache.save()
+
+    return run, len(items)
+
+
+@benchmark("cache.sqlitecache.load")
+def setup_sqlitecache_load(ctx: BenchmarkContext):
+    from calibre_plugins.overdrive_libby.utils import SqliteCache
+
+    items = _cache_items(ctx)
+    cache_path = ctx.temp_dir.joinpath("sqlitecache_load.sqlite")
+    cache = SqliteCache(
+        capacity=len(items), persist_to_path=cache_path, logger=benchmark_logger
+    )
+    for item in items:
+        cache.put(item["id"], item)
+    cache.save()
+
+    def run():
+        loaded_cache = SqliteCache(
+            capacity=len(items), persist_to_path=cache_path, logger=benchmark_logger
+        )
+        for item in items:
+            loaded_cache.get(item["id"])
+
+    return run, len(items)
+
+
+def measure(fn: Callable, repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        timings.append(timer() - start)
+    return timings
+
+
+def run_benchmarks(names: List[str], scale: int, library_size: int, repeat: int):
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in names:
+            bench_temp_dir = Path(temp_dir, name)
+            bench_temp_dir.mkdir()
+            ctx = BenchmarkContext(scale, library_size, bench_temp_dir)
+            fn, item_count = BENCHMARKS[name](ctx)
+            timings = measure(fn, repeat)
+            median = statistics.median(timings)
+            results[name] = {
+                "items": item_count,
+                "repeat": repeat,
+                "min": min(timings),
+                "median": median,
+                "mean": statistics.mean(timings),
+                "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+                "median_per_item": median / max(1, item_count),
+            }
+            print(
+                f"{name:<40} {median * 1000:>10.3f} ms  "
+                f"({results[name]['median_per_item'] * 1e6:.2f} us/item, n={item_count})",
+                file=sys.stderr,
+            )
+    return results
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    print(f"\n{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        baseline_result = baseline.get("results", {}).get(name)
+        if not baseline_result:
+            continue
+        before, after = baseline_result["median"], result["median"]
+        print(
+            f"{name:<40} {before * 1000:>9.3f} ms {after * 1000:>9.3f} ms "
+            f"{(after - before) / before * 100 if before else 0:>+7.1f}%"
+        )
+
+
+# Run with:
+# calibre-customize -b calibre-plugin && calibre-debug -e benchmarks/run.py -- --output results.json
+# Selected benchmarks: calibre-debug -e benchmarks/run.py -- --benchmarks models.search.sort libby.parse_datetime
+# Compare with an earlier run: calibre-debug -e benchmarks/run.py -- --compare results.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for the plugin using recorded fixtures."
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="*", help="Benchmarks to run (prefix match)"
+    )
+    parser.add_argument(
+        "--scale", type=int, default=10, help="Multiply the recorded fixtures"
+    )
+    parser.add_argument(
+        "--library-size",
+        dest="library_size",
+        type=int,
+        default=5000,
+        help="Number of books in the simulated calibre library",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Save results as json to this path")
+    parser.add_argument("--compare", help="Compare against a previous results json")
+    parser.add_argument("--list", action="store_true", help="List benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS.keys()))
+        sys.exit(0)
+
+    selected = [
+        name
+        for name in BENCHMARKS
+        if not args.benchmarks or any(name.startswith(b) for b in args.benchmarks)
+    ]
+    try:
+        ensure_app()
+        benchmark_results = run_benchmarks(
+            selected, args.scale, args.library_size, args.repeat
+        )
+    finally:
+        destroy_app()
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(tz=timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "calibre": calibre_version,
+            "platform": platform.platform(),
+            "scale": args.scale,
+            "library_size": args.library_size,
+        },
+        "results": benchmark_results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(benchmark_results, json.load(f))
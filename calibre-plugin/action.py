@@ -8,6 +8,7 @@
 # information
 #
 import logging
+import shutil
 from pathlib import Path
 
 from calibre.constants import DEBUG, config_dir
@@ -34,16 +35,21 @@ from .dialog import (
     SearchDialogMixin,
     AdvancedSearchDialogMixin,
 )
+from .ebook_download import PARTIAL_DOWNLOADS_DIR
 from .utils import (
     CARD_ICON,
     COVER_PLACEHOLDER,
     ICON_MAP,
     PluginImages,
-    SimpleCache,
+    SqliteCache,
     svg_to_qicon,
 )
 
 PLUGIN_DIR = Path(config_dir, PLUGINS_FOLDER_NAME)
+SYNCED_STATE_PATH = PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.sync.json")
+# expired libraries/media are kept for this number of days so that they can be
+# revalidated with a conditional request instead of being fetched again
+CACHE_STALE_AGE_DAYS = 30
 CI_COMMIT_TXT = "commit.txt"
 
 # noinspection PyUnreachableCode
@@ -172,13 +178,23 @@ class OverdriveLibbyAction(InterfaceAction):
                 "https://www.mobileread.com/forums/showthread.php?t=354816"
             ),
         )
-        self.libraries_cache = SimpleCache(
-            persist_to_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.libraries.json"),
+        self.libraries_cache = SqliteCache(
+            persist_to_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.libraries.sqlite"),
             cache_age_days=PREFS[PreferenceKeys.CACHE_AGE_DAYS],
             logger=logger,
+            import_from_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.libraries.json"),
+            stale_age_days=CACHE_STALE_AGE_DAYS,
         )
-        self.media_cache = SimpleCache(
-            persist_to_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.media.json"),
+        self.media_cache = SqliteCache(
+            persist_to_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.media.sqlite"),
+            cache_age_days=PREFS[PreferenceKeys.CACHE_AGE_DAYS],
+            logger=logger,
+            import_from_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.media.json"),
+            stale_age_days=CACHE_STALE_AGE_DAYS,
+        )
+        # parent magazine ID -> latest issue ID
+        self.magazines_cache = SqliteCache(
+            persist_to_path=PLUGIN_DIR.joinpath(f"{PLUGIN_NAME}.magazines.sqlite"),
             cache_age_days=PREFS[PreferenceKeys.CACHE_AGE_DAYS],
             logger=logger,
         )
@@ -191,6 +207,10 @@ class OverdriveLibbyAction(InterfaceAction):
         self.libraries_cache.save()
         self.media_cache.clear()
         self.media_cache.save()
+        self.magazines_cache.clear()
+        self.magazines_cache.save()
+        SYNCED_STATE_PATH.unlink(missing_ok=True)
+        shutil.rmtree(PARTIAL_DOWNLOADS_DIR, ignore_errors=True)
 
     def show_dialog(self):
         base_plugin_object = self.interface_action_base_plugin
@@ -203,6 +223,8 @@ class OverdriveLibbyAction(InterfaceAction):
                 self.resources,
                 self.libraries_cache,
                 self.media_cache,
+                SYNCED_STATE_PATH,
+                self.magazines_cache,
             )
             self.main_dialog.finished.connect(self.main_dialog_finished)
             window_title = _("OverDrive Libby v{version}{dev}").format(
@@ -221,8 +243,10 @@ class OverdriveLibbyAction(InterfaceAction):
     def apply_settings(self):
         self.libraries_cache.cache_age_days = PREFS[PreferenceKeys.CACHE_AGE_DAYS]
         self.media_cache.cache_age_days = PREFS[PreferenceKeys.CACHE_AGE_DAYS]
+        self.magazines_cache.cache_age_days = PREFS[PreferenceKeys.CACHE_AGE_DAYS]
         self.libraries_cache.reload()
         self.media_cache.reload()
+        self.magazines_cache.reload()
         if self.main_dialog:
             # close off main UI to make sure everything is consistent
             self.main_dialog.close()
@@ -237,8 +261,27 @@ class OverdriveLibbyDialog(
     LoansDialogMixin,
     BaseDialogMixin,
 ):
-    def __init__(self, gui, icon, do_user_config, icons, libraries_cache, media_cache):
-        super().__init__(gui, icon, do_user_config, icons, libraries_cache, media_cache)
+    def __init__(
+        self,
+        gui,
+        icon,
+        do_user_config,
+        icons,
+        libraries_cache,
+        media_cache,
+        synced_state_path=None,
+        magazines_cache=None,
+    ):
+        super().__init__(
+            gui,
+            icon,
+            do_user_config,
+            icons,
+            libraries_cache,
+            media_cache,
+            synced_state_path,
+            magazines_cache,
+        )
 
         # this non-intuitive code is because Windows
         size_hint = self.sizeHint()
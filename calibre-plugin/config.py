@@ -79,6 +79,7 @@ class PreferenceKeys:
     ALWAYS_DOWNLOAD_AS_NEW = "always_download_new"
     NETWORK_TIMEOUT = "network_timeout"
     NETWORK_RETRY = "network_retry"
+    NETWORK_CONCURRENT_DOWNLOADS = "network_concurrent_downloads"
     SEARCH_RESULTS_MAX = "search_results_max"
     SEARCH_LIBRARIES = "search_libraries"
     CUSTCOL_BORROWED_DATE = "custcol_borrowed_dt"
@@ -122,6 +123,7 @@ class PreferenceTexts:
     ALWAYS_DOWNLOAD_AS_NEW = _("Always download as a new book")
     NETWORK_TIMEOUT = _("Connection timeout")
     NETWORK_RETRY = _c("Retry attempts")
+    NETWORK_CONCURRENT_DOWNLOADS = _("Concurrent downloads")
     SEARCH_RESULTS_MAX = _("Maximum search results")
     SEARCH_LIBRARIES = _("Library Keys (comma-separated, max: {n})").format(
         n=MAX_SEARCH_LIBRARIES
@@ -155,6 +157,7 @@ PREFS.defaults[PreferenceKeys.MARK_UPDATED_BOOKS] = True
 PREFS.defaults[PreferenceKeys.ALWAYS_DOWNLOAD_AS_NEW] = False
 PREFS.defaults[PreferenceKeys.NETWORK_TIMEOUT] = 30
 PREFS.defaults[PreferenceKeys.NETWORK_RETRY] = 1
+PREFS.defaults[PreferenceKeys.NETWORK_CONCURRENT_DOWNLOADS] = 4
 PREFS.defaults[PreferenceKeys.SEARCH_RESULTS_MAX] = 20
 PREFS.defaults[PreferenceKeys.SEARCH_LIBRARIES] = []
 PREFS.defaults[PreferenceKeys.CUSTCOL_BORROWED_DATE] = ""
@@ -697,6 +700,21 @@ class ConfigWidget(QWidget):
         self.network_retry_txt.setValue(PREFS[PreferenceKeys.NETWORK_RETRY])
         network_layout.addRow(PreferenceTexts.NETWORK_RETRY, self.network_retry_txt)
 
+        self.network_concurrent_downloads_txt = QSpinBox(self)
+        self.network_concurrent_downloads_txt.setToolTip(
+            _(
+                "The maximum number of files to download at the same time, for example magazine pages"
+            )
+        )
+        self.network_concurrent_downloads_txt.setRange(1, 10)
+        self.network_concurrent_downloads_txt.setValue(
+            PREFS[PreferenceKeys.NETWORK_CONCURRENT_DOWNLOADS]
+        )
+        network_layout.addRow(
+            PreferenceTexts.NETWORK_CONCURRENT_DOWNLOADS,
+            self.network_concurrent_downloads_txt,
+        )
+
         self.resize(self.sizeHint())
 
     def generate_code_btn_clicked(self):
@@ -906,6 +924,9 @@ class ConfigWidget(QWidget):
         PREFS[PreferenceKeys.NETWORK_RETRY] = int(
             self.network_retry_txt.cleanText().strip()
         )
+        PREFS[PreferenceKeys.NETWORK_CONCURRENT_DOWNLOADS] = int(
+            self.network_concurrent_downloads_txt.cleanText().strip()
+        )
         PREFS[PreferenceKeys.SEARCH_RESULTS_MAX] = int(
             self.search_results_max_txt.cleanText().strip()
         )
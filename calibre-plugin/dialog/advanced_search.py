@@ -7,8 +7,10 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from threading import Lock
-from typing import Dict, List
+from typing import Dict, List, Optional, Set
 
 from calibre.constants import DEBUG
 from qt.core import (
@@ -19,7 +21,6 @@ from qt.core import (
     QHBoxLayout,
     QLineEdit,
     QRadioButton,
-    QThread,
     QWidget,
     Qt,
 )
@@ -41,6 +42,7 @@ from ..libby import LibbyFormats
 from ..models import (
     LibbySearchModel,
     LibbySearchSortFilterModel,
+    LibrarySearchResultsMerger,
 )
 from ..overdrive import LibraryMediaSearchParams
 from ..utils import PluginImages
@@ -54,11 +56,29 @@ load_translations()
 
 
 class AdvancedSearchDialogMixin(SearchBaseDialog):
+    # max number of libraries searched concurrently
+    max_search_workers = 4
+    # number of results fetched from each library per page, so that the first
+    # page is not slowed down by a large maximum number of search results
+    search_page_size = 24
+
     def __init__(self, *args):
         super().__init__(*args)
 
-        self._lib_search_threads: List[QThread] = []
-        self._lib_search_result_sets: Dict[str, List[Dict]] = {}
+        # library searches are run on a bounded pool shared by all searches
+        self._adv_search_executor = ThreadPoolExecutor(
+            max_workers=self.max_search_workers
+        )
+        # incremented for each search so that results from superseded searches are ignored
+        self._adv_search_id = 0
+        self._lib_search_workers: Dict[str, OverDriveLibraryMediaSearchWorker] = {}
+        self._lib_search_results = LibrarySearchResultsMerger()
+        # query for the current page of results
+        self._adv_search_query: Optional[LibraryMediaSearchParams] = None
+        # libraries that have not returned results for the current page
+        self._lib_search_pending: Set[str] = set()
+        # libraries with more results than have been fetched
+        self._lib_search_has_more: Set[str] = set()
         self.lock = Lock()
 
         adv_search_widget = QWidget()
@@ -163,6 +183,7 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
             self, model=self.adv_search_model
         )
         self.adv_search_proxy_model.setSourceModel(self.adv_search_model)
+        self.adv_search_model.fetch_more_requested.connect(self.adv_search_fetch_more)
 
         # The main search results list
         self.adv_search_results_view = DefaultQTableView(
@@ -247,10 +268,12 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
         self.last_borrow_action_changed.connect(self.rebind_advsearch_borrow_btn)
         self.sync_starting.connect(self.base_sync_starting_advsearch)
         self.sync_ended.connect(self.base_sync_ended_advsearch)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_advsearch)
         self.loan_added.connect(self.loan_added_advsearch)
         self.loan_removed.connect(self.loan_removed_advsearch)
         self.hold_added.connect(self.hold_added_advsearch)
         self.hold_removed.connect(self.hold_removed_advsearch)
+        self.finished.connect(self.adv_search_dialog_finished)
 
     def toggle_advsearch_mode_btn_clicked(self):
         if hasattr(self, "search_tab_index"):
@@ -262,6 +285,9 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
         self.adv_search_borrow_btn.setEnabled(False)
         self.adv_search_model.sync({})
 
+    def base_synced_state_loaded_advsearch(self, value):
+        self.adv_search_model.sync(value)
+
     def base_sync_ended_advsearch(self, value):
         self.adv_search_borrow_btn.setEnabled(True)
         self.adv_search_model.sync(value)
@@ -315,20 +341,12 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
         self.adv_hold_btn.setMenu(None)
         self.adv_hold_btn.setEnabled(True)
 
-    def _has_running_search(self, asked_by=None) -> bool:
-        for t in self._lib_search_threads:
-            if asked_by and asked_by == t.library_key:
-                continue
-            if t.isRunning():
-                return True
-        return False
-
     def adv_search_btn_clicked(self):
         self.adv_search_model.sync({"search_results": []})
         self.adv_search_results_view.sortByColumn(-1, Qt.AscendingOrder)
         self._reset_borrow_hold_buttons()
-        if self._has_running_search():
-            return
+        # a new search supersedes the running one
+        self._cancel_adv_search()
 
         if not PREFS[PreferenceKeys.INCL_NONDOWNLOADABLE_TITLES]:
             formats = [
@@ -375,13 +393,19 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
             formats=formats,
             media_type=media_type,
             subject_id=subject_id,
-            per_page=PREFS[PreferenceKeys.SEARCH_RESULTS_MAX],
+            per_page=min(
+                self.search_page_size, PREFS[PreferenceKeys.SEARCH_RESULTS_MAX]
+            ),
+            page=1,
         )
         if query.is_empty():
+            self.adv_search_btn.setText(_c("Search"))
+            self.unsetCursor()
+            self.status_bar.clearMessage()
             return
 
+        # the button is left enabled so that the search can be superseded
         self.adv_search_btn.setText(_c("Searching..."))
-        self.adv_search_btn.setEnabled(False)
         self.setCursor(Qt.WaitCursor)
         library_keys = self.adv_search_model.limited_library_keys()
         self.status_bar.showMessage(
@@ -391,15 +415,39 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
                 len(library_keys),
             ).format(n=len(library_keys))
         )
-        self._lib_search_threads = []
-        self._lib_search_result_sets = {}
+        self._lib_search_results = LibrarySearchResultsMerger()
+        self._search_libraries(library_keys, query)
+
+    def adv_search_fetch_more(self):
+        # the view has been scrolled to the end of the results, so fetch the next page
+        query = self._adv_search_query
+        library_keys = sorted(self._lib_search_has_more)
+        if not (query and library_keys):
+            self.adv_search_model.set_can_fetch_more(False)
+            return
 
+        self.adv_search_btn.setText(_c("Searching..."))
+        self.setCursor(Qt.WaitCursor)
+        self.status_bar.showMessage(_("Loading more results..."))
+        self._search_libraries(library_keys, replace(query, page=query.page + 1))
+
+    def _search_libraries(
+        self, library_keys: List[str], query: LibraryMediaSearchParams
+    ):
+        """
+        Search the libraries for a page of results.
+
+        :param library_keys:
+        :param query:
+        :return:
+        """
+        self._adv_search_query = query
+        self._lib_search_pending = set(library_keys)
+        self._lib_search_has_more = set()
         for library_key in library_keys:
-            search_thread = self._get_adv_search_thread(
-                self.overdrive_client, library_key, query
+            self._lib_search_workers[library_key] = self._submit_adv_search(
+                self._adv_search_id, self.overdrive_client, library_key, query
             )
-            self._lib_search_threads.append(search_thread)
-            search_thread.start()
 
     def adv_search_for(self, title: str, author: str):
         self.tabs.setCurrentIndex(self.adv_search_tab_index)
@@ -410,109 +458,83 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
         self.adv_search_btn.setFocus(Qt.OtherFocusReason)
         self.adv_search_btn.animateClick()
 
-    def _process_search_results(self, library_key, search_items: List[Dict]):
+    def _process_search_results(
+        self,
+        library_key,
+        search_items: List[Dict],
+        fetched_at: Optional[float] = None,
+    ):
         with self.lock:
-            self._lib_search_result_sets[library_key] = search_items
-            found_library_keys = self._lib_search_result_sets.keys()
-            if len(found_library_keys) != len(self._lib_search_threads):
-                pending_libraries = [
-                    t.library_key
-                    for t in self._lib_search_threads
-                    if t.library_key not in found_library_keys
-                ]
+            query = self._adv_search_query
+            if not query:
+                return
+            max_results = PREFS[PreferenceKeys.SEARCH_RESULTS_MAX]
+            offset = (query.page - 1) * query.per_page
+            # merge and display the results as each library's results arrive
+            self._lib_search_results.merge(
+                library_key,
+                # the last page can take the library past the max results
+                search_items[: max(max_results - offset, 0)],
+                start_rank=offset + 1,
+            )
+            if (
+                len(search_items) >= query.per_page
+                and offset + query.per_page < max_results
+            ):
+                # a full page, so the library may have more results
+                self._lib_search_has_more.add(library_key)
+            self._lib_search_pending.discard(library_key)
+            search_results = self._lib_search_results.results()
+            self.adv_search_model.update_search_results(
+                search_results, fetched_at=fetched_at
+            )
+            if self._lib_search_pending:
                 self.status_bar.showMessage(
                     _("Waiting for {libraries}...").format(
-                        libraries=", ".join(pending_libraries)
+                        libraries=", ".join(sorted(self._lib_search_pending))
                     )
                 )
                 return
 
+            self._lib_search_workers = {}
+            self.adv_search_model.set_can_fetch_more(bool(self._lib_search_has_more))
             self.adv_search_btn.setText(_c("Search"))
-            self.adv_search_btn.setEnabled(True)
             self.unsetCursor()
             self.status_bar.clearMessage()
-            combined_search_results: Dict[str, Dict] = {}
-            for lib_key, result_items in self._lib_search_result_sets.items():
-                for item_rank, item in enumerate(result_items, start=1):
-                    site_availability = {}
-                    for k in (
-                        "advantageKey",
-                        "availabilityType",
-                        "availableCopies",
-                        "estimatedWaitDays",
-                        "formats",
-                        "holdsCount",
-                        "holdsRatio",
-                        "isAdvantageFiltered",
-                        "isAvailable",
-                        "isOwned",
-                        "isRecommendableToLibrary",
-                        "isFastlane",
-                        "isHoldable",
-                        "juvenileEligible",
-                        "luckyDayAvailableCopies",
-                        "luckyDayOwnedCopies",
-                        "ownedCopies",
-                        "visitorEligible",
-                        "youngAdultEligible",
-                    ):
-                        if k in item:
-                            site_availability[k] = item.pop(k)
-                    site_availability["advantageKey"] = library_key
-                    item.setdefault("siteAvailabilities", {})
-                    item.setdefault("__item_ranks", [])
-                    item.setdefault("formats", [])
-                    title_id = item["id"]
-                    combined_search_results.setdefault(title_id, item)
-                    # merge site availabilities
-                    combined_search_results[title_id]["siteAvailabilities"][
-                        lib_key
-                    ] = site_availability
-                    # merge item ranks
-                    combined_search_results[title_id]["__item_ranks"].append(item_rank)
-                    # merge formats
-                    existing_format_ids = [
-                        f["id"]
-                        for f in combined_search_results[title_id].get("formats", [])
-                    ]
-                    for f in site_availability.get("formats", []):
-                        if f["id"] not in existing_format_ids:
-                            combined_search_results[title_id]["formats"].append(f)
-
-            ordered_search_result_items = sorted(
-                combined_search_results.values(),
-                key=lambda r: (
-                    sum(r["__item_ranks"]) / len(r["__item_ranks"]),  # average rank
-                    1 / len(r["__item_ranks"]),
-                ),
-            )
             self.status_bar.showMessage(
                 ngettext(
                     "{n} result found",
                     "{n} results found",
-                    len(ordered_search_result_items),
-                ).format(n=len(ordered_search_result_items)),
+                    len(search_results),
+                ).format(n=len(search_results)),
                 5000,
             )
-            self.adv_search_model.sync({"search_results": ordered_search_result_items})
 
-    def _get_adv_search_thread(
-        self, overdrive_client, library_key: str, query: LibraryMediaSearchParams
-    ):
-        thread = QThread()
+    def _submit_adv_search(
+        self,
+        search_id: int,
+        overdrive_client,
+        library_key: str,
+        query: LibraryMediaSearchParams,
+    ) -> OverDriveLibraryMediaSearchWorker:
         worker = OverDriveLibraryMediaSearchWorker()
-        worker.setup(overdrive_client, library_key, query)
-        worker.moveToThread(thread)
-        thread.library_key = library_key
-        thread.worker = worker
-        thread.started.connect(worker.run)
+        worker.setup(
+            overdrive_client, library_key, query, cache=self.search_results_cache
+        )
 
-        def done(lib_key: str, results: Dict):
-            thread.quit()
-            self._process_search_results(lib_key, results.get("items", []))
+        # signals are emitted from the executor thread, so these are queued
+        # and run in the GUI thread
+        def done(lib_key: str, results: Dict, fetched_at: float):
+            if search_id != self._adv_search_id:
+                # superseded by a new search
+                return
+            self._process_search_results(
+                lib_key, results.get("items", []), fetched_at=fetched_at
+            )
 
         def errored_out(lib_key: str, err: Exception):
-            thread.quit()
+            if search_id != self._adv_search_id:
+                return
             self.logger.warning(
                 "Error encountered during search (%s): %s", lib_key, err
             )
@@ -524,7 +546,27 @@ class AdvancedSearchDialogMixin(SearchBaseDialog):
             )
             self._process_search_results(lib_key, [])
 
-        worker.finished.connect(lambda lib_key, results: done(lib_key, results))
+        worker.finished.connect(
+            lambda lib_key, results, fetched_at: done(lib_key, results, fetched_at)
+        )
         worker.errored.connect(lambda lib_key, err: errored_out(lib_key, err))
-
-        return thread
+        worker.future = self._adv_search_executor.submit(worker.run)
+        return worker
+
+    def _cancel_adv_search(self):
+        """
+        Cancel the current search. Library searches that have not started are
+        cancelled, and results from those that are already running are ignored.
+
+        :return:
+        """
+        self._adv_search_id += 1
+        for worker in self._lib_search_workers.values():
+            worker.future.cancel()
+        self._lib_search_workers = {}
+        self._lib_search_pending = set()
+        self._lib_search_has_more = set()
+
+    def adv_search_dialog_finished(self):
+        self._cancel_adv_search()
+        self._adv_search_executor.shutdown(wait=False)
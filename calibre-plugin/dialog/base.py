@@ -9,7 +9,10 @@
 #
 import json
 from collections import OrderedDict
+from datetime import datetime, timezone
 from functools import cmp_to_key, partial
+from pathlib import Path
+from timeit import default_timer as timer
 from typing import Dict, List, Optional
 
 from calibre import prepare_string_for_xml
@@ -62,6 +65,7 @@ from ..models import (
     CREATOR_ROLE_TRANSLATION,
     LOAN_TYPE_TRANSLATION,
     LibbyModel,
+    LibraryMatchIndex,
     get_media_title,
     truncate_for_display,
 )
@@ -70,7 +74,7 @@ from ..overdrive.errors import ClientConnectionError as OverDriveConnectionError
 from ..utils import (
     OD_IDENTIFIER,
     PluginImages,
-    SimpleCache,
+    SqliteCache,
     generate_od_identifier,
     rating_to_stars,
     svg_to_pixmap,
@@ -117,6 +121,9 @@ class BaseDialogMixin(QDialog):
     hide_title_already_in_lib_pref_changed = pyqtSignal(bool)
     sync_starting = pyqtSignal()
     sync_ended = pyqtSignal(dict)
+    # the last synced state, shown with the action buttons disabled until the sync ends
+    synced_state_loaded = pyqtSignal(dict)
+    sync_failed = pyqtSignal()
     loan_added = pyqtSignal(dict)
     hold_added = pyqtSignal(dict)
     loan_removed = pyqtSignal(dict)
@@ -128,8 +135,10 @@ class BaseDialogMixin(QDialog):
         icon,
         do_user_config,
         resources: Dict,
-        libraries_cache: SimpleCache,
-        media_cache: SimpleCache,
+        libraries_cache: SqliteCache,
+        media_cache: SqliteCache,
+        synced_state_path: Optional[Path] = None,
+        magazines_cache: Optional[SqliteCache] = None,
     ):
         super().__init__(gui)
         self.setAttribute(Qt.WA_DeleteOnClose)
@@ -137,11 +146,17 @@ class BaseDialogMixin(QDialog):
         self.do_user_config = do_user_config
         self.resources = resources
         self.db = gui.current_db.new_api
+        # shared by the models to find titles already in the calibre library
+        self.library_match_index = LibraryMatchIndex(self.db)
         self.client = None
         self._sync_thread = QThread()  # main sync thread
         self.logger = logger
         self.libraries_cache = libraries_cache
         self.media_cache = media_cache
+        self.magazines_cache = magazines_cache
+        # the last synced state is displayed while a new sync is in progress
+        self.synced_state_path = synced_state_path
+        self.has_synced = False
         self.setWindowIcon(icon)
         self.view_vspan = 1
         self.view_hspan = 4
@@ -190,6 +205,12 @@ class BaseDialogMixin(QDialog):
         help_lbl.setTextInteractionFlags(
             Qt.LinksAccessibleByKeyboard | Qt.LinksAccessibleByMouse
         )
+        # indicates that the last synced state is being displayed
+        self.stale_lbl = QLabel(self)
+        self.stale_lbl.setStyleSheet("margin: 0 4px; font-style: italic")
+        self.stale_lbl.setAttribute(Qt.WA_TranslucentBackground)
+        self.stale_lbl.hide()
+        self.status_bar.addPermanentWidget(self.stale_lbl)
         self.status_bar.addPermanentWidget(help_lbl)
         layout.addWidget(self.status_bar, 1, 0)
 
@@ -209,6 +230,8 @@ class BaseDialogMixin(QDialog):
             logger.debug("Saved new UI height preference: %d", new_height)
         self.libraries_cache.save()
         self.media_cache.save()
+        if self.magazines_cache:
+            self.magazines_cache.save()
 
     def add_tab(self, widget, label) -> int:
         """
@@ -411,15 +434,55 @@ class BaseDialogMixin(QDialog):
             return
         if not self._sync_thread.isRunning():
             self.status_bar.showMessage(_("Synchronizing..."))
-            self.loading_overlay(_("Synchronizing..."))
+            self.library_match_index.invalidate()
             self.sync_starting.emit()
-            self._sync_thread = self._get_sync_thread()
+            stale_state = None if self.has_synced else self.load_synced_state()
+            if stale_state:
+                # display the last synced state until the sync completes
+                self.synced_state_loaded.emit(stale_state)
+                self.stale_lbl.show()
+            else:
+                self.loading_overlay(_("Synchronizing..."))
+            self._sync_thread = self._get_sync_thread(stale_state)
             self._sync_thread.start()
 
-    def _get_sync_thread(self):
+    def load_synced_state(self) -> Optional[Dict]:
+        """
+        Load the last synced state saved by the sync worker.
+
+        :return:
+        """
+        if not (self.synced_state_path and self.synced_state_path.exists()):
+            return None
+        start = timer()
+        try:
+            with self.synced_state_path.open("r", encoding="utf-8") as f:
+                synced_state = json.load(f)
+            synced_at = datetime.fromtimestamp(
+                self.synced_state_path.stat().st_mtime, tz=timezone.utc
+            )
+            self.stale_lbl.setText(
+                _("Showing data from {dt}").format(
+                    dt=format_date(
+                        dt_as_local(synced_at), tweaks["gui_timestamp_display_format"]
+                    )
+                )
+            )
+            logger.info("Loading synced state took %f seconds", timer() - start)
+            return synced_state
+        except Exception as err:  # noqa
+            logger.warning("Unable to load synced state: %s", err)
+            return None
+
+    def _get_sync_thread(self, stale_state: Optional[Dict] = None):
         thread = QThread()
         worker = SyncDataWorker()
-        worker.setup(self.libraries_cache, self.media_cache)
+        worker.setup(
+            self.libraries_cache,
+            self.media_cache,
+            self.synced_state_path,
+            self.magazines_cache,
+        )
         worker.moveToThread(thread)
         thread.worker = worker
         thread.started.connect(worker.run)
@@ -434,8 +497,10 @@ class BaseDialogMixin(QDialog):
                 PREFS[PreferenceKeys.LIBBY_TOKEN] = new_identity_token
                 if self.client:
                     self.client.identity_token = new_identity_token
+            self.has_synced = True
             self.sync_ended.emit(value)
             self.loading_overlay.hide()
+            self.stale_lbl.hide()
             try:
                 holds = value.get("holds", [])
                 holds_count = len(holds)
@@ -462,7 +527,11 @@ class BaseDialogMixin(QDialog):
                 thread.quit()
 
         def errored_out(err: Exception):
-            self.sync_ended.emit({})
+            if not stale_state:
+                self.sync_ended.emit({})
+            # the last synced state stays displayed, so only the refresh controls
+            # are enabled
+            self.sync_failed.emit()
             try:
                 thread.quit()
                 self.loading_overlay.hide()
@@ -8,16 +8,18 @@
 # information
 #
 import copy
+from typing import Callable, Dict, List, Optional
 
-from qt.core import Qt, QMenu, QIcon, QCursor
+from qt.core import Qt, QMenu, QIcon, QCursor, QThread
 
 from .base import BaseDialogMixin
 from .. import DEMO_MODE
 from ..compat import _c
 from ..config import PREFS, PreferenceKeys, BorrowActions
 from ..libby import LibbyClient
-from ..models import get_media_title, truncate_for_display
-from ..utils import PluginImages, obfuscate_name
+from ..models import LibbySearchModel, get_media_title, truncate_for_display
+from ..utils import ExpiringCache, PluginImages, obfuscate_name
+from ..workers import OverDriveMediaAvailabilityWorker
 
 # noinspection PyUnreachableCode
 if False:
@@ -25,10 +27,89 @@ if False:
 
 load_translations()
 
+# number of searches cached
+SEARCH_RESULTS_CACHE_SIZE = 50
+# number of seconds that search results are cached for
+SEARCH_RESULTS_CACHE_TTL = 5 * 60
+
 
 class SearchBaseDialog(BaseDialogMixin):
     def __init__(self, *args):
         super().__init__(*args)
+        self._availability_threads: Dict[LibbySearchModel, QThread] = {}
+        # short-lived cache of search results, for repeated searches
+        self.search_results_cache = ExpiringCache(
+            capacity=SEARCH_RESULTS_CACHE_SIZE, ttl=SEARCH_RESULTS_CACHE_TTL
+        )
+        # borrowing or placing a hold changes the availabilities
+        for signal in (
+            self.loan_added,
+            self.loan_removed,
+            self.hold_added,
+            self.hold_removed,
+        ):
+            signal.connect(lambda _: self.search_results_cache.clear())
+
+    def refresh_availabilities(
+        self,
+        view,
+        model: LibbySearchModel,
+        refreshed_callback: Optional[Callable] = None,
+    ):
+        """
+        Refresh the availabilities of the search results shown in the view
+        in the background, if they have expired.
+
+        :param view:
+        :param model:
+        :param refreshed_callback: Called after the model has been updated
+        :return:
+        """
+        thread = self._availability_threads.get(model)
+        if (thread and thread.isRunning()) or not model.availabilities_expired():
+            return
+        proxy_model = view.model()
+        title_ids = [
+            proxy_model.index(row, 0).data(LibbySearchModel.TitleIdRole)
+            for row in range(proxy_model.rowCount())
+        ]
+        library_title_ids = model.get_library_title_ids(title_ids)
+        if not library_title_ids:
+            return
+        thread = self._get_availability_thread(
+            self.overdrive_client, model, library_title_ids, refreshed_callback
+        )
+        self._availability_threads[model] = thread
+        thread.start()
+
+    def _get_availability_thread(
+        self,
+        overdrive_client,
+        model: LibbySearchModel,
+        library_title_ids: Dict[str, List[str]],
+        refreshed_callback: Optional[Callable] = None,
+    ):
+        thread = QThread()
+        worker = OverDriveMediaAvailabilityWorker()
+        worker.setup(overdrive_client, library_title_ids)
+        worker.moveToThread(thread)
+        thread.worker = worker
+        thread.started.connect(worker.run)
+
+        def done(availabilities: Dict):
+            thread.quit()
+            model.update_availabilities(availabilities)
+            if refreshed_callback:
+                refreshed_callback()
+
+        def errored_out(err: Exception):
+            thread.quit()
+            self.logger.warning("Error refreshing availability: %s", err)
+
+        worker.finished.connect(lambda availabilities: done(availabilities))
+        worker.errored.connect(lambda err: errored_out(err))
+
+        return thread
 
     def _wrap_for_rich_text(self, txt):
         return f"<p>{txt}</p>"
@@ -87,6 +168,16 @@ class SearchBaseDialog(BaseDialogMixin):
             hold_btn.setMenu(None)
             return
 
+        # availabilities may have changed since the search was made, so refresh
+        # them and rebuild the borrow/hold menus when done
+        self.refresh_availabilities(
+            view,
+            model,
+            lambda: self.view_selection_model_selectionchanged(
+                borrow_btn, hold_btn, view, model
+            ),
+        )
+
         indices = selection_model.selectedRows()
         media = indices[-1].data(Qt.UserRole)
         self.status_bar.showMessage(get_media_title(media, include_subtitle=True), 3000)
@@ -112,11 +112,19 @@ class CardsDialogMixin(BaseDialogMixin):
         self.cards_tab_index = self.add_tab(self.cards_scroll_area, _("Cards"))
         self.sync_starting.connect(self.base_sync_starting_cards)
         self.sync_ended.connect(self.base_sync_ended_cards)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_cards)
+        self.sync_failed.connect(self.base_sync_failed_cards)
 
     def base_sync_starting_cards(self):
         self.cards_refresh_btn.setEnabled(False)
         self.libby_cards_model.sync({})
 
+    def base_synced_state_loaded_cards(self, value):
+        self.libby_cards_model.sync(value)
+
+    def base_sync_failed_cards(self):
+        self.cards_refresh_btn.setEnabled(True)
+
     def base_sync_ended_cards(self, value):
         self.cards_refresh_btn.setEnabled(True)
         self.libby_cards_model.sync(value)
@@ -103,6 +103,7 @@ class HoldsDialogMixin(BaseDialogMixin):
         )
 
         self.holds_model.modelReset.connect(self.holds_model_changed)
+        self.holds_model.rowsInserted.connect(self.holds_model_changed)
         self.holds_model.rowsRemoved.connect(self.holds_model_changed)
         self.holds_model.dataChanged.connect(self.holds_model_changed)
 
@@ -167,6 +168,8 @@ class HoldsDialogMixin(BaseDialogMixin):
         )
         self.sync_starting.connect(self.base_sync_starting_holds)
         self.sync_ended.connect(self.base_sync_ended_holds)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_holds)
+        self.sync_failed.connect(self.base_sync_failed_holds)
         self.hold_added.connect(self.hold_added_holds)
         self.hold_removed.connect(self.hold_removed_holds)
 
@@ -179,7 +182,13 @@ class HoldsDialogMixin(BaseDialogMixin):
     def base_sync_starting_holds(self):
         self.holds_refresh_btn.setEnabled(False)
         self.holds_borrow_btn.setEnabled(False)
-        self.holds_model.sync({})
+        # rows are kept so that only the changes are applied when the sync ends
+
+    def base_synced_state_loaded_holds(self, value):
+        self.holds_model.sync(value)
+
+    def base_sync_failed_holds(self):
+        self.holds_refresh_btn.setEnabled(True)
 
     def base_sync_ended_holds(self, value):
         self.holds_refresh_btn.setEnabled(True)
@@ -7,7 +7,7 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 from calibre.constants import DEBUG
 from calibre.gui2 import Dispatcher, open_url
@@ -36,7 +36,11 @@ from ..compat import (
     _c,
 )
 from ..config import PREFS, PreferenceKeys, PreferenceTexts
-from ..ebook_download import CustomEbookDownload
+from ..ebook_download import (
+    CustomEbookBatchDownload,
+    CustomEbookDownload,
+    EbookDownloadItem,
+)
 from ..empty_download import EmptyBookDownload
 from ..libby import LibbyClient, LibbyFormats
 from ..loan_actions import LibbyLoanRenew, LibbyLoanReturn
@@ -58,6 +62,7 @@ if False:
 load_translations()
 
 gui_ebook_download = CustomEbookDownload()
+gui_ebook_batch_download = CustomEbookBatchDownload()
 gui_magazine_download = CustomMagazineDownload()
 guid_empty_download = EmptyBookDownload()
 gui_libby_return = LibbyLoanReturn()
@@ -103,7 +108,10 @@ class LoansDialogMixin(BaseDialogMixin):
 
         self.loans_model = LibbyLoansModel(None, [], self.db, self.resources)
         self.loans_search_proxy_model = LibbyLoansSortFilterModel(
-            self, model=self.loans_model, db=self.db
+            self,
+            model=self.loans_model,
+            db=self.db,
+            match_index=self.library_match_index,
         )
 
         # The main loan list
@@ -169,6 +177,8 @@ class LoansDialogMixin(BaseDialogMixin):
         self.loans_tab_index = self.add_tab(widget, _("Loans"))
         self.sync_starting.connect(self.base_sync_starting_loans)
         self.sync_ended.connect(self.base_sync_ended_loans)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_loans)
+        self.sync_failed.connect(self.base_sync_failed_loans)
         self.loan_added.connect(self.loan_added_loans)
         self.hold_added.connect(self.hold_added_loans)
         self.loan_removed.connect(self.loan_removed_loans)
@@ -192,7 +202,13 @@ class LoansDialogMixin(BaseDialogMixin):
     def base_sync_starting_loans(self):
         self.loans_refresh_btn.setEnabled(False)
         self.download_btn.setEnabled(False)
-        self.loans_model.sync({})
+        # rows are kept so that only the changes are applied when the sync ends
+
+    def base_synced_state_loaded_loans(self, value):
+        self.loans_model.sync(value)
+
+    def base_sync_failed_loans(self):
+        self.loans_refresh_btn.setEnabled(True)
 
     def base_sync_ended_loans(self, value):
         self.loans_refresh_btn.setEnabled(True)
@@ -346,12 +362,45 @@ class LoansDialogMixin(BaseDialogMixin):
         selection_model = self.loans_view.selectionModel()
         if selection_model.hasSelection():
             rows = selection_model.selectedRows()
-            for row in reversed(rows):
-                self.download_loan(row.data(Qt.UserRole))
+            loans = [row.data(Qt.UserRole) for row in reversed(rows)]
+            # multiple ebooks are downloaded together in a single batch job
+            ebook_loans: List[Tuple[Dict, str]] = []
+            for loan in loans:
+                format_id = self.get_ebook_format(loan)
+                if format_id:
+                    ebook_loans.append((loan, format_id))
+            batched_loan_ids = set()
+            if len(ebook_loans) > 1:
+                self.download_ebooks(ebook_loans)
+                batched_loan_ids = {
+                    (loan["id"], loan["cardId"]) for loan, __ in ebook_loans
+                }
+            for loan in loans:
+                if (loan["id"], loan["cardId"]) not in batched_loan_ids:
+                    self.download_loan(loan)
                 if PREFS[PreferenceKeys.HIDE_BOOKS_ALREADY_IN_LIB]:
-                    self.loans_search_proxy_model.temporarily_hide(
-                        row.data(Qt.UserRole)
-                    )
+                    self.loans_search_proxy_model.temporarily_hide(loan)
+
+    @staticmethod
+    def get_ebook_format(loan: Dict) -> Optional[str]:
+        """
+        Get the format to download if the loan will be downloaded as an ebook,
+        i.e. not as an empty book or magazine.
+
+        :param loan:
+        :return:
+        """
+        try:
+            format_id = LibbyClient.get_loan_format(
+                loan, prefer_open_format=PREFS[PreferenceKeys.PREFER_OPEN_FORMATS]
+            )
+        except ValueError:
+            return None
+        if LibbyClient.is_downloadable_audiobook_loan(
+            loan
+        ) or not LibbyClient.is_downloadable_ebook_loan(loan):
+            return None
+        return format_id
 
     def download_loan(self, loan: Dict):
         # do actual downloading of the loan
@@ -492,6 +541,62 @@ class LoansDialogMixin(BaseDialogMixin):
         self.gui.job_manager.run_threaded_job(job)
         self.gui.status_bar.show_message(description, 3000)
 
+    def download_ebooks(self, ebook_loans: List[Tuple[Dict, str]]):
+        """
+        Download multiple ebook loans in a single batch job.
+
+        :param ebook_loans: List of (loan, format_id), see :meth:`get_ebook_format`
+        :return:
+        """
+        tags = [t.strip() for t in PREFS[PreferenceKeys.TAG_EBOOKS].split(",")]
+        download_items: List[EbookDownloadItem] = []
+        for loan, format_id in ebook_loans:
+            card = self.loans_model.get_card(loan["cardId"])
+            library = self.loans_model.get_library(
+                self.loans_model.get_website_id(card)
+            )
+            book_id, mi = self.match_existing_book(loan, library, format_id)
+            if mi and book_id:
+                self.logger.debug("Matched existing empty book: %s", mi.title)
+            download_items.append(
+                EbookDownloadItem(
+                    loan,
+                    card,
+                    library,
+                    format_id,
+                    book_id,
+                    mi,
+                    f'{loan["id"]}.{LibbyClient.get_file_extension(format_id)}',
+                    tags,
+                )
+            )
+        if not download_items:
+            return
+
+        n = len(download_items)
+        show_download_info(ngettext("{n} book", "{n} books", n).format(n=n), self)
+        description = ngettext(
+            "Downloading {n} book", "Downloading {n} books", n
+        ).format(n=n)
+        callback = Dispatcher(self.downloaded_loan)
+        job = ThreadedJob(
+            "overdrive_libby_download_books",
+            description,
+            gui_ebook_batch_download,
+            (
+                self.gui,
+                self.client,
+                download_items,
+                PREFS[PreferenceKeys.NETWORK_CONCURRENT_DOWNLOADS],
+            ),
+            {},
+            callback,
+            max_concurrent_count=1,
+            killable=False,
+        )
+        self.gui.job_manager.run_threaded_job(job)
+        self.gui.status_bar.show_message(description, 3000)
+
     def download_magazine(self, loan: Dict, format_id: str, filename: str, tags=None):
         if not tags:
             tags = []
@@ -594,8 +699,15 @@ class LoansDialogMixin(BaseDialogMixin):
             self.unhandled_exception(job.exception, msg=_c("Failed to download e-book"))
 
         try:
-            if job.result:
-                self.loans_search_proxy_model.unhide(job.result)
+            if job.failed:
+                # a batch download can fail after some of the loans have been added
+                loans = getattr(job.exception, "added_loans", [])
+            else:
+                # batch downloads return a list of loans
+                loans = job.result if isinstance(job.result, list) else [job.result]
+            for loan in loans:
+                if loan:
+                    self.loans_search_proxy_model.unhide(loan)
         except RuntimeError as runtime_err:
             # most likely because the plugin UI was closed before download was completed
             self.logger.warning("Error displaying media results: %s", runtime_err)
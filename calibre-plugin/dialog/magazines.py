@@ -153,7 +153,10 @@ class MagazinesDialogMixin(BaseDialogMixin):
 
         self.magazines_model = LibbyMagazinesModel(None, [], self.db)
         self.magazines_search_proxy_model = LibbyMagazinesSortFilterModel(
-            self, model=self.magazines_model, db=self.db
+            self,
+            model=self.magazines_model,
+            db=self.db,
+            match_index=self.library_match_index,
         )
 
         # The main magazines list
@@ -219,6 +222,8 @@ class MagazinesDialogMixin(BaseDialogMixin):
         )
         self.sync_starting.connect(self.base_sync_starting_magazines)
         self.sync_ended.connect(self.base_sync_ended_magazines)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_magazines)
+        self.sync_failed.connect(self.base_sync_failed_magazines)
         self.loan_added.connect(self.loan_added_magazines)
         self.loan_removed.connect(self.loan_removed_magazines)
         self.hide_title_already_in_lib_pref_changed.connect(
@@ -233,9 +238,16 @@ class MagazinesDialogMixin(BaseDialogMixin):
 
     def base_sync_starting_magazines(self):
         self.magazines_refresh_btn.setEnabled(False)
-        self.magazines_model.sync({})
+        # rows are kept so that only the changes are applied when the sync ends
         self.cards_model.sync({})
 
+    def base_synced_state_loaded_magazines(self, value):
+        self.magazines_model.sync(value)
+        self.cards_model.sync(value)
+
+    def base_sync_failed_magazines(self):
+        self.magazines_refresh_btn.setEnabled(True)
+
     def base_sync_ended_magazines(self, value):
         self.magazines_refresh_btn.setEnabled(True)
         self.magazines_model.sync(value)
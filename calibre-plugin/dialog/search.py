@@ -156,6 +156,7 @@ class SearchDialogMixin(SearchBaseDialog):
         self.last_borrow_action_changed.connect(self.rebind_search_borrow_btn)
         self.sync_starting.connect(self.base_sync_starting_search)
         self.sync_ended.connect(self.base_sync_ended_search)
+        self.synced_state_loaded.connect(self.base_synced_state_loaded_search)
         self.loan_added.connect(self.loan_added_search)
         self.loan_removed.connect(self.loan_removed_search)
         self.hold_added.connect(self.hold_added_search)
@@ -187,6 +188,9 @@ class SearchDialogMixin(SearchBaseDialog):
         self.search_borrow_btn.setEnabled(False)
         self.search_model.sync({})
 
+    def base_synced_state_loaded_search(self, value):
+        self.search_model.sync(value)
+
     def base_sync_ended_search(self, value):
         self.search_borrow_btn.setEnabled(True)
         self.search_model.sync(value)
@@ -264,18 +268,23 @@ class SearchDialogMixin(SearchBaseDialog):
                 LibbyFormats.MagazineOverDrive,
             ]
         worker.setup(
-            overdrive_client, query, library_keys, formats, max_items=max_items
+            overdrive_client,
+            query,
+            library_keys,
+            formats,
+            max_items=max_items,
+            cache=self.search_results_cache,
         )
         worker.moveToThread(thread)
         thread.worker = worker
         thread.started.connect(worker.run)
 
-        def done(results):
+        def done(results, fetched_at: float):
             thread.quit()
             self.search_btn.setText(_c("Search"))
             self.search_btn.setEnabled(True)
             self.unsetCursor()
-            self.search_model.sync({"search_results": results})
+            self.search_model.sync({"search_results": results}, fetched_at=fetched_at)
             self.status_bar.showMessage(
                 ngettext("{n} result found", "{n} results found", len(results)).format(
                     n=len(results)
@@ -290,7 +299,7 @@ class SearchDialogMixin(SearchBaseDialog):
             self.unsetCursor()
             raise err
 
-        worker.finished.connect(lambda results: done(results))
+        worker.finished.connect(lambda results, fetched_at: done(results, fetched_at))
         worker.errored.connect(lambda err: errored_out(err))
 
         return thread
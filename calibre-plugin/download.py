@@ -8,9 +8,11 @@
 # information
 #
 
+import logging
 import time
+from collections import namedtuple
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 from calibre.ebooks.metadata.meta import get_metadata
 from calibre.ebooks.metadata.worker import run_import_plugins
@@ -21,6 +23,22 @@ from .overdrive import OverDriveClient
 from .utils import OD_IDENTIFIER, generate_od_identifier
 
 
+# a downloaded loan file to be added to the calibre db, see LibbyDownload.add_many()
+DownloadedLoan = namedtuple(
+    "DownloadedLoan",
+    [
+        "loan",
+        "card",
+        "library",
+        "format_id",
+        "downloaded_file",
+        "book_id",
+        "tags",
+        "metadata",
+    ],
+)
+
+
 class LibbyDownload:
     """
     Base class for download jobs
@@ -140,33 +158,53 @@ class LibbyDownload:
         :param logger:
         :return:
         """
+        self.update_custom_columns_for_books({book_id: loan}, db, logger)
+
+    def update_custom_columns_for_books(
+        self, book_id_loans: Dict[int, Dict], db, logger
+    ):
+        """
+        Update custom columns from loans, with a single write per column for all the books.
+
+        :param book_id_loans: Mapping of book id to loan
+        :param db:
+        :param logger:
+        :return:
+        """
         try:
-            if PREFS[PreferenceKeys.CUSTCOL_BORROWED_DATE] and loan.get("checkoutDate"):
-                borrowed_date = LibbyClient.parse_datetime(loan["checkoutDate"])
-                db.set_field(
-                    PREFS[PreferenceKeys.CUSTCOL_BORROWED_DATE],
-                    {book_id: borrowed_date},
-                )
+            if PREFS[PreferenceKeys.CUSTCOL_BORROWED_DATE]:
+                borrowed_dates = {
+                    book_id: LibbyClient.parse_datetime(loan["checkoutDate"])
+                    for book_id, loan in book_id_loans.items()
+                    if loan.get("checkoutDate")
+                }
+                if borrowed_dates:
+                    db.set_field(
+                        PREFS[PreferenceKeys.CUSTCOL_BORROWED_DATE], borrowed_dates
+                    )
         except Exception as err:
             logger.exception("Error updating Borrowed Date: %s", err)
         try:
-            if PREFS[PreferenceKeys.CUSTCOL_DUE_DATE] and loan.get("expireDate"):
-                due_date = LibbyClient.parse_datetime(loan["expireDate"])
-                db.set_field(
-                    PREFS[PreferenceKeys.CUSTCOL_DUE_DATE],
-                    {book_id: due_date},
-                )
+            if PREFS[PreferenceKeys.CUSTCOL_DUE_DATE]:
+                due_dates = {
+                    book_id: LibbyClient.parse_datetime(loan["expireDate"])
+                    for book_id, loan in book_id_loans.items()
+                    if loan.get("expireDate")
+                }
+                if due_dates:
+                    db.set_field(PREFS[PreferenceKeys.CUSTCOL_DUE_DATE], due_dates)
         except Exception as err:
             logger.exception("Error updating Due Date: %s", err)
 
         try:
-            if PREFS[PreferenceKeys.CUSTCOL_LOAN_TYPE] and loan.get("type", {}).get(
-                "id"
-            ):
-                db.set_field(
-                    PREFS[PreferenceKeys.CUSTCOL_LOAN_TYPE],
-                    {book_id: OverDriveClient.extract_type(loan)},
-                )
+            if PREFS[PreferenceKeys.CUSTCOL_LOAN_TYPE]:
+                loan_types = {
+                    book_id: OverDriveClient.extract_type(loan)
+                    for book_id, loan in book_id_loans.items()
+                    if loan.get("type", {}).get("id")
+                }
+                if loan_types:
+                    db.set_field(PREFS[PreferenceKeys.CUSTCOL_LOAN_TYPE], loan_types)
         except Exception as err:
             logger.exception("Error updating Loan Type: %s", err)
 
@@ -182,7 +220,8 @@ class LibbyDownload:
         tags: Optional[List[str]] = None,
         metadata=None,
         logger=None,
-    ) -> None:
+        refresh_gui: bool = True,
+    ) -> Tuple[int, bool]:
         """
         Adds the new downloaded book to calibre db
 
@@ -196,67 +235,304 @@ class LibbyDownload:
         :param tags:
         :param metadata:
         :param logger:
-        :return:
+        :param refresh_gui: If False, the library view is not refreshed so that
+                            this can be done once for a batch of books
+        :return: The book id, and if it is a new book
         """
 
+        if not logger:
+            logger = logging.getLogger(__name__)
         db = gui.current_db.new_api
-        ext = downloaded_file.suffix[1:]  # remove the "." suffix
+        new_path, new_ext = self._run_import_plugins(downloaded_file)
 
         if book_id and metadata:
-            logger.info(
-                "Adding %s format to existing book %s", ext.upper(), metadata.title
-            )
-            # we have to run_import_plugins first so that we can get
-            # the correct metadata for the .acsm
-            new_path = run_import_plugins(
-                (str(downloaded_file),),
-                time.monotonic_ns(),
-                str(downloaded_file.parent),
-            )[0]
-            new_ext = Path(new_path).suffix[1:]
-
-            # if book_id is found, it's an empty book, download and add the epub/pdf as a format
-            successfully_added = db.add_format(
-                book_id, new_ext.upper(), new_path, replace=False
-            )
-            if successfully_added:
-                metadata = self.update_metadata(
-                    gui, loan, library, format_id, metadata, tags
-                )
-                # Reference: https://github.com/kovidgoyal/calibre/blob/58c609fa7db3a8df59981c3bf73823fa1862c392/src/calibre/gui2/ebook_download.py#L108-L116
-                with open(new_path, "rb") as f:
-                    new_metadata = get_metadata(f, new_ext, force_read_metadata=True)
-                # we update new_metadata using old metadata to keep old metadata as precedence
-                new_metadata.smart_update(metadata)
-                db.set_metadata(book_id, new_metadata)
+            if self._add_format_to_book(
+                gui,
+                loan,
+                library,
+                format_id,
+                book_id,
+                metadata,
+                tags,
+                new_path,
+                new_ext,
+                logger,
+            ):
                 self.update_custom_columns(book_id, loan, db, logger)
-
-                if PREFS[PreferenceKeys.MARK_UPDATED_BOOKS]:
-                    gui.current_db.set_marked_ids([book_id])  # mark updated book
-                gui.library_view.model().refresh_ids([book_id])
+                if refresh_gui:
+                    self.refresh_library_view(gui, updated_book_ids=[book_id])
+            return book_id, False
         else:
             # add as a new book
-
-            # we have to run_import_plugins first so that we can get
-            # the correct metadata for the .acsm
-            new_path = run_import_plugins(
-                (str(downloaded_file),),
-                time.monotonic_ns(),
-                str(downloaded_file.parent),
-            )[0]
-            new_ext = Path(new_path).suffix[1:]
-
-            # Reference: https://github.com/kovidgoyal/calibre/blob/58c609fa7db3a8df59981c3bf73823fa1862c392/src/calibre/gui2/ebook_download.py#L108-L116
-            with open(new_path, "rb") as f:
-                metadata = get_metadata(f, new_ext, force_read_metadata=True)
-
-            metadata = self.update_metadata(
-                gui, loan, library, format_id, metadata, tags
-            )
-            book_id = gui.library_view.model().db.create_book_entry(metadata)
-            gui.library_view.model().db.add_format_with_hooks(
-                book_id, new_ext.upper(), new_path, index_is_id=True
+            metadata = self._read_new_book_metadata(
+                gui, loan, library, format_id, tags, new_path, new_ext
             )
+            book_id = self._create_book(gui, metadata, new_ext.upper(), new_path)
             self.update_custom_columns(book_id, loan, db, logger)
-            gui.library_view.model().books_added(1)
+            if refresh_gui:
+                self.refresh_library_view(gui, new_books_count=1)
+            return book_id, True
+
+    @staticmethod
+    def _run_import_plugins(downloaded_file: Path) -> Tuple[str, str]:
+        """
+        Run the import plugins on the downloaded file. This has to be done first
+        so that we can get the correct metadata for the .acsm
+
+        :param downloaded_file:
+        :return: The path to the imported file, and its extension
+        """
+        new_path = run_import_plugins(
+            (str(downloaded_file),),
+            time.monotonic_ns(),
+            str(downloaded_file.parent),
+        )[0]
+        return new_path, Path(new_path).suffix[1:]
+
+    def _add_format_to_book(
+        self,
+        gui,
+        loan: Dict,
+        library: Dict,
+        format_id: str,
+        book_id: int,
+        metadata,
+        tags: Optional[List[str]],
+        new_path: str,
+        new_ext: str,
+        logger,
+    ) -> bool:
+        """
+        Adds the imported file as a format to an existing (empty) book.
+        Custom columns are not updated.
+
+        :param gui:
+        :param loan:
+        :param library:
+        :param format_id:
+        :param book_id:
+        :param metadata:
+        :param tags:
+        :param new_path:
+        :param new_ext:
+        :param logger:
+        :return: True if the format was added
+        """
+        logger.info(
+            "Adding %s format to existing book %s", new_ext.upper(), metadata.title
+        )
+        db = gui.current_db.new_api
+        # if book_id is found, it's an empty book, add the epub/pdf as a format
+        if not db.add_format(book_id, new_ext.upper(), new_path, replace=False):
+            return False
+        metadata = self.update_metadata(gui, loan, library, format_id, metadata, tags)
+        # Reference: https://github.com/kovidgoyal/calibre/blob/58c609fa7db3a8df59981c3bf73823fa1862c392/src/calibre/gui2/ebook_download.py#L108-L116
+        with open(new_path, "rb") as f:
+            new_metadata = get_metadata(f, new_ext, force_read_metadata=True)
+        # we update new_metadata using old metadata to keep old metadata as precedence
+        new_metadata.smart_update(metadata)
+        db.set_metadata(book_id, new_metadata)
+        return True
+
+    def _read_new_book_metadata(
+        self,
+        gui,
+        loan: Dict,
+        library: Dict,
+        format_id: str,
+        tags: Optional[List[str]],
+        new_path: str,
+        new_ext: str,
+    ):
+        """
+        Read the metadata for a new book from the imported file.
+
+        :param gui:
+        :param loan:
+        :param library:
+        :param format_id:
+        :param tags:
+        :param new_path:
+        :param new_ext:
+        :return:
+        """
+        # Reference: https://github.com/kovidgoyal/calibre/blob/58c609fa7db3a8df59981c3bf73823fa1862c392/src/calibre/gui2/ebook_download.py#L108-L116
+        with open(new_path, "rb") as f:
+            metadata = get_metadata(f, new_ext, force_read_metadata=True)
+        return self.update_metadata(gui, loan, library, format_id, metadata, tags)
+
+    @staticmethod
+    def _create_book(gui, metadata, fmt: str, path: str) -> int:
+        """
+        Create a new book entry with the imported file.
+
+        :param gui:
+        :param metadata:
+        :param fmt:
+        :param path:
+        :return: The new book id
+        """
+        book_id = gui.library_view.model().db.create_book_entry(metadata)
+        gui.library_view.model().db.add_format_with_hooks(
+            book_id, fmt, path, index_is_id=True
+        )
+        return book_id
+
+    def _add_new_books_after_failure(
+        self,
+        gui,
+        new_books: List[Tuple[int, object, str, str]],
+        existing_book_ids: Set[int],
+        book_ids: List[Optional[int]],
+        downloaded_loans: List[DownloadedLoan],
+        logger,
+    ) -> None:
+        """
+        Add the new books one at a time after the bulk add has failed, so that a bad
+        entry does not fail the rest. The books that the bulk add created before it
+        failed are matched by title and are not added again.
+
+        :param gui:
+        :param new_books: index in downloaded_loans, metadata, format, path
+        :param existing_book_ids: The book ids from before the bulk add
+        :param book_ids: Updated with the ids of the books added
+        :param downloaded_loans:
+        :param logger:
+        :return:
+        """
+        db = gui.current_db.new_api
+        # books are created in order, so the earliest matching book is used
+        created_book_ids = sorted(set(db.all_book_ids()) - existing_book_ids)
+        if created_book_ids:
+            # the legacy view data is only updated when the bulk add succeeds
+            gui.library_view.model().db.data.books_added(created_book_ids)
+        for i, metadata, fmt, path in new_books:
+            try:
+                book_id = next(
+                    (
+                        b
+                        for b in created_book_ids
+                        if db.field_for("title", b) == metadata.title  # type: ignore[attr-defined]
+                    ),
+                    0,
+                )
+                if book_id:
+                    created_book_ids.remove(book_id)
+                    if fmt not in db.formats(book_id):
+                        # the bulk add failed while adding this format
+                        db.add_format(book_id, fmt, path, replace=False)
+                else:
+                    book_id = self._create_book(gui, metadata, fmt, path)
+                book_ids[i] = book_id
+            except Exception as err:
+                logger.exception(
+                    "Error adding %s: %s", downloaded_loans[i].downloaded_file.name, err
+                )
+
+    @staticmethod
+    def refresh_library_view(
+        gui, new_books_count: int = 0, updated_book_ids: Optional[List[int]] = None
+    ) -> None:
+        """
+        Refresh the calibre library view after books are added or updated.
+
+        :param gui:
+        :param new_books_count:
+        :param updated_book_ids:
+        :return:
+        """
+        if updated_book_ids:
+            if PREFS[PreferenceKeys.MARK_UPDATED_BOOKS]:
+                gui.current_db.set_marked_ids(updated_book_ids)  # mark updated books
+            gui.library_view.model().refresh_ids(updated_book_ids)
+        if new_books_count:
+            gui.library_view.model().books_added(new_books_count)
             gui.library_view.model().count_changed()
+
+    def add_many(
+        self, gui, downloaded_loans: List[DownloadedLoan], logger=None
+    ) -> List[Optional[int]]:
+        """
+        Adds multiple downloaded books to the calibre db in bulk. New books are
+        created together, custom columns are written once per column for all books,
+        and the library view is only refreshed once.
+
+        :param gui:
+        :param downloaded_loans:
+        :param logger:
+        :return: The book ids, in the same order as downloaded_loans. None if the
+                 book could not be added.
+        """
+        if not logger:
+            logger = logging.getLogger(__name__)
+        db = gui.current_db.new_api
+        book_ids: List[Optional[int]] = [None] * len(downloaded_loans)
+        updated_book_ids: List[int] = []
+        # index in downloaded_loans, metadata, format, path
+        new_books: List[Tuple[int, object, str, str]] = []
+
+        for i, d in enumerate(downloaded_loans):
+            try:
+                new_path, new_ext = self._run_import_plugins(d.downloaded_file)
+                if d.book_id and d.metadata:
+                    if self._add_format_to_book(
+                        gui,
+                        d.loan,
+                        d.library,
+                        d.format_id,
+                        d.book_id,
+                        d.metadata,
+                        d.tags,
+                        new_path,
+                        new_ext,
+                        logger,
+                    ):
+                        book_ids[i] = d.book_id
+                        updated_book_ids.append(d.book_id)
+                else:
+                    metadata = self._read_new_book_metadata(
+                        gui, d.loan, d.library, d.format_id, d.tags, new_path, new_ext
+                    )
+                    new_books.append((i, metadata, new_ext.upper(), new_path))
+            except Exception as err:
+                logger.exception("Error adding %s: %s", d.downloaded_file.name, err)
+
+        if new_books:
+            existing_book_ids = set(db.all_book_ids())
+            try:
+                # the legacy db api also updates the library view data
+                _, new_book_ids = gui.library_view.model().db.add_books(
+                    [p for _, _, _, p in new_books],
+                    [fmt for _, _, fmt, _ in new_books],
+                    [mi for _, mi, _, _ in new_books],
+                    add_duplicates=True,
+                    return_ids=True,
+                )
+                for (i, _, _, _), book_id in zip(new_books, new_book_ids):
+                    book_ids[i] = book_id
+            except Exception as err:
+                logger.exception("Error adding books in bulk: %s", err)
+                self._add_new_books_after_failure(
+                    gui,
+                    new_books,
+                    existing_book_ids,
+                    book_ids,
+                    downloaded_loans,
+                    logger,
+                )
+
+        self.update_custom_columns_for_books(
+            {
+                book_id: d.loan
+                for book_id, d in zip(book_ids, downloaded_loans)
+                if book_id
+            },
+            db,
+            logger,
+        )
+        self.refresh_library_view(
+            gui,
+            new_books_count=len([i for i, _, _, _ in new_books if book_ids[i]]),
+            updated_book_ids=updated_book_ids,
+        )
+        return book_ids
@@ -8,22 +8,82 @@
 # information
 #
 
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set
 
+from calibre.constants import config_dir
 from calibre.ptempfile import PersistentTemporaryDirectory
 
+from . import PLUGIN_NAME, PLUGINS_FOLDER_NAME
 from .compat import _c
-from .download import LibbyDownload
+from .download import DownloadedLoan, LibbyDownload
 from .libby import LibbyClient
+from .models import get_media_title
 from .utils import create_job_logger
 
 # noinspection PyUnreachableCode
 if False:
-    load_translations = lambda x=None: x  # noqa: E731
+    load_translations = ngettext = lambda x=None, y=None, z=None: x  # noqa: E731
 
 load_translations()
 
+# the arguments for downloading a loan in a batch, see CustomEbookDownload
+EbookDownloadItem = namedtuple(
+    "EbookDownloadItem",
+    ["loan", "card", "library", "format_id", "book_id", "metadata", "filename", "tags"],
+)
+
+# interrupted downloads are kept here so that they can be resumed by a later job
+PARTIAL_DOWNLOADS_DIR = Path(
+    config_dir, PLUGINS_FOLDER_NAME, f"{PLUGIN_NAME}.downloads"
+)
+# number of seconds before an abandoned partial download is removed
+PARTIAL_DOWNLOAD_MAX_AGE = 24 * 60 * 60
+# partial downloads that are being written to by a job
+_partial_downloads_in_progress: Set[Path] = set()
+_partial_downloads_lock = threading.Lock()
+
+# fraction of the batch progress for the downloads, the rest is for adding to the db
+BATCH_DOWNLOAD_PROGRESS_FRACTION = 0.9
+
+
+def _prune_partial_downloads() -> None:
+    """
+    Remove the partial downloads that have not been written to recently,
+    together with their saved validators. Must be called with
+    _partial_downloads_lock held.
+
+    :return:
+    """
+    cutoff = time.time() - PARTIAL_DOWNLOAD_MAX_AGE
+    for part_path in PARTIAL_DOWNLOADS_DIR.glob("*.part"):
+        if part_path in _partial_downloads_in_progress:
+            continue
+        validators_path = part_path.with_name(part_path.name + ".json")
+        try:
+            if part_path.stat().st_mtime < cutoff:
+                part_path.unlink(missing_ok=True)
+                validators_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+    for validators_path in PARTIAL_DOWNLOADS_DIR.glob("*.part.json"):
+        try:
+            if not validators_path.with_suffix("").exists():
+                validators_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+class BatchDownloadException(Exception):
+    def __init__(self, msg, added_loans: Optional[List[Dict]] = None):
+        super().__init__(msg)
+        # the loans that were added successfully before the batch failed
+        self.added_loans = added_loans or []
+
 
 class CustomEbookDownload(LibbyDownload):
     def __call__(
@@ -90,11 +150,180 @@ class CustomEbookDownload(LibbyDownload):
         book_folder_path = Path(PersistentTemporaryDirectory())
         book_file_path = book_folder_path.joinpath(filename)
 
-        notifications.put((0.5, _c("Downloading")))
-        res_content = libby_client.fulfill_loan_file(
-            loan["id"], loan["cardId"], format_id
+        def report_progress(bytes_read: int, total_size: Optional[int]):
+            if abort and abort.is_set():
+                raise RuntimeError("Abort signal received.")
+            if total_size:
+                notifications.put((bytes_read / total_size, _c("Downloading")))
+
+        loan_part_path = PARTIAL_DOWNLOADS_DIR.joinpath(
+            f'{loan["cardId"]}-{loan["id"]}-{format_id}.part'
         )
-        with book_file_path.open("w+b") as tf:
-            tf.write(res_content)
+        part_path: Optional[Path] = None
+        with _partial_downloads_lock:
+            PARTIAL_DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
+            _prune_partial_downloads()
+            if loan_part_path not in _partial_downloads_in_progress:
+                _partial_downloads_in_progress.add(loan_part_path)
+                part_path = loan_part_path
+            elif logger:
+                # the same loan is being downloaded by another job, so its
+                # partial file is not shared
+                logger.info("Loan is already being downloaded: %s", loan["id"])
+
+        notifications.put((0.5, _c("Downloading")))
+        try:
+            libby_client.fulfill_loan_file_to_path(
+                loan["id"],
+                loan["cardId"],
+                format_id,
+                book_file_path,
+                progress_callback=report_progress,
+                part_path=part_path,
+            )
+        finally:
+            if part_path:
+                with _partial_downloads_lock:
+                    _partial_downloads_in_progress.discard(part_path)
 
         return book_file_path
+
+
+class BatchProgress:
+    """
+    Aggregates the progress of concurrent downloads into a single job progress.
+    """
+
+    def __init__(self, notifications, count: int, fraction: float = 1.0):
+        self.notifications = notifications
+        self.fraction = fraction
+        self._progress = [0.0] * count
+        self._lock = threading.Lock()
+
+    def for_item(self, index: int):
+        """
+        A notifications-like object to be passed to a single download.
+
+        :param index:
+        :return:
+        """
+        batch_progress = self
+
+        class ItemNotifications:
+            def put(self, notification):
+                item_progress, msg = notification
+                batch_progress.update(index, item_progress, msg)
+
+        return ItemNotifications()
+
+    def update(self, index: int, item_progress: float, msg: str) -> None:
+        with self._lock:
+            self._progress[index] = min(1.0, max(0.0, item_progress))
+            total_progress = sum(self._progress) / len(self._progress)
+        if self.notifications:
+            self.notifications.put((total_progress * self.fraction, msg))
+
+
+class CustomEbookBatchDownload(CustomEbookDownload):
+    """
+    Downloads multiple ebook loans in a single job with bounded concurrency,
+    then adds them to the calibre db together with a single library view refresh.
+    """
+
+    def __call__(  # type: ignore[override]
+        self,
+        gui,
+        libby_client: LibbyClient,
+        download_items: List[EbookDownloadItem],
+        max_workers: int = 1,
+        log=None,
+        abort=None,
+        notifications=None,
+    ):
+        logger = create_job_logger(log)
+        progress = BatchProgress(
+            notifications, len(download_items), BATCH_DOWNLOAD_PROGRESS_FRACTION
+        )
+
+        def download(index: int, item: EbookDownloadItem) -> Path:
+            if abort and abort.is_set():
+                raise RuntimeError("Abort signal received.")
+            logger.info("Downloading %s", get_media_title(item.loan))
+            downloaded_filepath = self._custom_download(
+                libby_client,
+                item.loan,
+                item.format_id,
+                item.filename,
+                logger=logger,
+                abort=abort,
+                notifications=progress.for_item(index),
+            )
+            progress.update(index, 1.0, _c("Downloading"))
+            return downloaded_filepath
+
+        downloaded_filepaths: List[Optional[Path]] = [None] * len(download_items)
+        # titles of the loans that could not be downloaded or added
+        failed_titles: List[str] = []
+        added_loans: List[Dict] = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futures = [
+                    executor.submit(download, i, item)
+                    for i, item in enumerate(download_items)
+                ]
+                for i, (item, future) in enumerate(zip(download_items, futures)):
+                    try:
+                        downloaded_filepaths[i] = future.result()
+                    except Exception as err:
+                        logger.error(
+                            "Error downloading %s: %s", get_media_title(item.loan), err
+                        )
+                        failed_titles.append(get_media_title(item.loan))
+
+            # add all downloaded books to the db in bulk
+            downloaded_loans = [
+                DownloadedLoan(
+                    item.loan,
+                    item.card,
+                    item.library,
+                    item.format_id,
+                    downloaded_filepath,
+                    item.book_id,
+                    item.tags,
+                    item.metadata,
+                )
+                for item, downloaded_filepath in zip(
+                    download_items, downloaded_filepaths
+                )
+                if downloaded_filepath
+            ]
+            if downloaded_loans:
+                if notifications:
+                    notifications.put((BATCH_DOWNLOAD_PROGRESS_FRACTION, _c("Adding")))
+                book_ids = self.add_many(gui, downloaded_loans, logger=logger)
+                for d, book_id in zip(downloaded_loans, book_ids):
+                    if book_id:
+                        added_loans.append(d.loan)
+                    else:
+                        failed_titles.append(get_media_title(d.loan))
+        finally:
+            for downloaded_filepath in downloaded_filepaths:
+                try:
+                    if downloaded_filepath:
+                        downloaded_filepath.unlink(missing_ok=True)
+                except:  # noqa
+                    pass
+
+        logger.info(
+            "Added %d of %d loans to the library", len(added_loans), len(download_items)
+        )
+        if failed_titles:
+            raise BatchDownloadException(
+                ngettext(
+                    "{n} loan could not be downloaded: {titles}",
+                    "{n} loans could not be downloaded: {titles}",
+                    len(failed_titles),
+                ).format(n=len(failed_titles), titles=", ".join(failed_titles)),
+                added_loans,
+            )
+        return added_loans
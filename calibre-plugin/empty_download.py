@@ -8,7 +8,7 @@
 # information
 #
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 from urllib.parse import urlencode, urlparse
 
 from calibre import browser
@@ -97,12 +97,28 @@ class EmptyBookDownload(LibbyDownload):
             filename = f'{content["id"]}.{LibbyClient.get_file_extension(format_id)}'
             book_file_path = book_folder_path.joinpath(filename)
 
+            def report_progress(
+                bytes_read: int, total_size: Optional[int], content_index: int = i
+            ):
+                if abort and abort.is_set():
+                    raise RuntimeError("Abort signal received.")
+                if total_size:
+                    notifications.put(
+                        (
+                            (content_index + bytes_read / total_size)
+                            / len(bundled_contents),
+                            _c("Downloading"),
+                        )
+                    )
+
             notifications.put((i / len(bundled_contents), _c("Downloading")))
-            res_content = libby_client.fulfill_loan_file(
-                content["id"], loan["cardId"], format_id
+            libby_client.fulfill_loan_file_to_path(
+                content["id"],
+                loan["cardId"],
+                format_id,
+                book_file_path,
+                progress_callback=report_progress,
             )
-            with book_file_path.open("w+b") as tf:
-                tf.write(res_content)
 
             book_file_paths.append(book_file_path)
 
@@ -11,21 +11,26 @@ import base64
 import gzip
 import json
 import logging
+import re
 import time
 import uuid
-from datetime import datetime, timezone
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from http.client import HTTPException
 from http.cookiejar import CookieJar
 from io import BytesIO
+from pathlib import Path
 from socket import error as SocketError, timeout as SocketTimeout
 from ssl import SSLError
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from urllib import parse, request
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode, urljoin
 from urllib.request import HTTPCookieProcessor, Request, build_opener
 
 from .errors import ClientConnectionError, ErrorHandler, ClientForbiddenError
+from .keepalive import ConnectionPool, build_keepalive_handlers
 from .utils import StringEnum
 
 
@@ -92,10 +97,45 @@ DOWNLOADABLE_FORMATS = (
     LibbyFormats.MagazineOverDrive,
     # LibbyFormats.AudioBookMP3,
 )
+# size of each chunk read when streaming a download to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_1) AppleWebKit/605.1.15 (KHTML, like Gecko) "
     "Version/14.0.2 Safari/605.1.15"
 )
+# the ISO 8601 datetime shapes returned by the API,
+# e.g. 2023-08-10T23:00:01.000Z, 2023-09-14T07:20:30+00:00
+ISO_DATETIME_RE = re.compile(
+    r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})"
+    r"T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})"
+    r"(?:\.(?P<fraction>\d{1,6}))?"
+    r"(?:(?P<utc>Z)|(?P<offset_sign>[+-])(?P<offset_hour>\d{2}):?(?P<offset_minute>\d{2}))?"
+)
+# number of parsed datetime strings memoized
+PARSE_DATETIME_CACHE_SIZE = 4096
+DATETIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%S%z",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%m/%d/%Y",  # publishDateText
+)
+
+
+def parse_content_range(value: str) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Parses a Content-Range header value, e.g. "bytes 100-199/200".
+
+    :param value:
+    :return: tuple of (start offset, total size or None if unknown)
+    """
+    mobj = re.match(r"bytes\s+(\d+)-\d+/(\d+|\*)", value or "")
+    if not mobj:
+        return None
+    total = mobj.group(2)
+    return int(mobj.group(1)), int(total) if total.isdigit() else None
 
 
 class NoRedirectHandler(request.HTTPRedirectHandler):
@@ -134,12 +174,20 @@ class LibbyClient(object):
         self.api_base = "https://sentry.libbyapp.com/"
         self.tags_api_base = "https://vandal.libbyapp.com/"
 
+        # persistent connections shared by both openers
+        self.connection_pool: ConnectionPool = (
+            kwargs.pop("connection_pool", None) or ConnectionPool()
+        )
+
         cookie_jar = CookieJar()
         handlers = [
             HTTPCookieProcessor(cookie_jar),
+            *build_keepalive_handlers(self.connection_pool),
         ]
         self.opener = build_opener(*handlers)
-        self.opener_noredirect = build_opener(NoRedirectHandler)
+        self.opener_noredirect = build_opener(
+            NoRedirectHandler, *build_keepalive_handlers(self.connection_pool)
+        )
         self.cookie_jar = cookie_jar
 
     @staticmethod
@@ -317,17 +365,49 @@ class LibbyClient(object):
         """
         if not value:
             return None
+        # datetimes are immutable, so it's safe to share the cached values
+        return _parse_datetime_cached(value)
 
-        formats = (
-            "%Y-%m-%dT%H:%M:%SZ",
-            "%Y-%m-%dT%H:%M:%S.%fZ",
-            "%Y-%m-%dT%H:%M:%S%z",
-            "%Y-%m-%dT%H:%M:%S.%f%z",
-            "%Y-%m-%dT%H:%M:%S",
-            "%Y-%m-%dT%H:%M:%S.%f",            
-            "%m/%d/%Y",  # publishDateText
+    @staticmethod
+    def _parse_iso_datetime(value: str) -> Optional[datetime]:
+        """
+        Fast path for the common ISO 8601 datetime strings from the API.
+
+        :param value:
+        :return: None if value is not in a supported ISO 8601 shape
+        """
+        mobj = ISO_DATETIME_RE.fullmatch(value)
+        if not mobj:
+            return None
+        tz = timezone.utc
+        if mobj.group("offset_sign"):
+            offset = timedelta(
+                hours=int(mobj.group("offset_hour")),
+                minutes=int(mobj.group("offset_minute")),
+            )
+            if offset:
+                tz = timezone(-offset if mobj.group("offset_sign") == "-" else offset)
+        fraction = mobj.group("fraction")
+        return datetime(
+            int(mobj.group("year")),
+            int(mobj.group("month")),
+            int(mobj.group("day")),
+            int(mobj.group("hour")),
+            int(mobj.group("minute")),
+            int(mobj.group("second")),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+            tzinfo=tz,
         )
-        for i, fmt in enumerate(formats, start=1):
+
+    @staticmethod
+    def _parse_datetime_strptime(value: str) -> datetime:
+        """
+        Parses a datetime string by trying each of the known formats in turn.
+
+        :param value:
+        :return:
+        """
+        for fmt in DATETIME_FORMATS:
             try:
                 dt = datetime.strptime(value, fmt)
                 if not dt.tzinfo:
@@ -336,7 +416,9 @@ class LibbyClient(object):
             except ValueError:
                 pass
 
-        raise ValueError(f"time data '{value}' does not match known formats {formats}")
+        raise ValueError(
+            f"time data '{value}' does not match known formats {DATETIME_FORMATS}"
+        )
 
     @staticmethod
     def is_renewable(loan: Dict) -> bool:
@@ -430,6 +512,48 @@ class LibbyClient(object):
             self.logger.debug("RES BODY: %s", decoded_res)
         return decoded_res
 
+    @staticmethod
+    def _write_response(
+        response,
+        file_path: Path,
+        progress_callback: Optional[Callable[[int, Optional[int]], None]] = None,
+        chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+        resume_from: int = 0,
+    ) -> int:
+        """
+        Stream the response body to a file in fixed-size chunks so that
+        the whole body is never held in memory. Gzip-encoded bodies are
+        decompressed incrementally.
+
+        :param response:
+        :param file_path: Destination file
+        :param progress_callback: Called after each chunk with the number of bytes read
+                                  and the total bytes expected (None if unknown)
+        :param chunk_size:
+        :param resume_from: If set, append to file_path, which already has this number of bytes
+        :return: Number of bytes read from the response
+        """
+        decompressor = None
+        if response.info().get("Content-Encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        content_length = response.info().get("Content-Length", "")
+        total_size = (
+            int(content_length) + resume_from if content_length.isdigit() else None
+        )
+        bytes_read = 0
+        with file_path.open("ab" if resume_from else "wb") as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                bytes_read += len(chunk)
+                f.write(decompressor.decompress(chunk) if decompressor else chunk)
+                if progress_callback:
+                    progress_callback(resume_from + bytes_read, total_size)
+            if decompressor:
+                f.write(decompressor.flush())
+        return bytes_read
+
     def _send_request(
         self,
         endpoint: str,
@@ -791,6 +915,157 @@ class LibbyClient(object):
         res = opener.open(req, timeout=timeout)
         return res.read()
 
+    def _urlretrieve_to_path(
+        self,
+        endpoint: str,
+        file_path: Path,
+        headers: Optional[Dict] = None,
+        progress_callback: Optional[Callable[[int, Optional[int]], None]] = None,
+        part_path: Optional[Path] = None,
+    ) -> Path:
+        """
+        Streaming version of :meth:`_urlretrieve` that saves to file_path.
+
+        The download is written to a partial file. If the connection fails, the
+        retry resumes from the end of the partial file with a HTTP Range request.
+        The resumed content is only accepted if the ETag (If-Range) and the total
+        size (Content-Range) still match the original response. The completed file
+        is checked against the Content-Length.
+
+        The ETag and size are saved next to the partial file, so that a later
+        call with the same part_path can also resume the download.
+
+        :param endpoint: fulfillment url
+        :param file_path:
+        :param headers:
+        :param progress_callback:
+        :param part_path: Partial file location, defaults to file_path with a .part suffix
+        :return:
+        """
+        headers = dict(headers or {})
+        # range offsets must refer to the actual file and not an encoded response
+        headers["Accept-Encoding"] = "identity"
+        if not part_path:
+            part_path = file_path.with_name(file_path.name + ".part")
+        validators_path = part_path.with_name(part_path.name + ".json")
+        etag: Optional[str] = None
+        expected_size: Optional[int] = None
+        try:
+            with validators_path.open("r", encoding="utf-8") as f:
+                validators = json.load(f)
+            etag = validators["etag"]
+            expected_size = int(validators["size"])
+        except (OSError, ValueError, KeyError, TypeError):
+            etag = expected_size = None
+        if not (
+            etag
+            and expected_size
+            and part_path.exists()
+            and part_path.stat().st_size < expected_size
+        ):
+            # a partial file from an earlier call can only be resumed
+            # if it can be validated with If-Range
+            etag = expected_size = None
+            part_path.unlink(missing_ok=True)
+            validators_path.unlink(missing_ok=True)
+
+        opener = request.build_opener()
+        for attempt in range(0, self.max_retries + 1):
+            part_size = part_path.stat().st_size if part_path.exists() else 0
+            req_headers = dict(headers)
+            if part_size and expected_size:
+                req_headers["Range"] = f"bytes={part_size}-"
+                if etag:
+                    req_headers["If-Range"] = etag
+            req = request.Request(endpoint, headers=req_headers)
+            try:
+                self.logger.debug(
+                    "REQUEST: GET %s %s", endpoint, req_headers.get("Range", "")
+                )
+                with opener.open(req, timeout=self.timeout) as res:
+                    resume_from = 0
+                    if res.status == 206:
+                        content_range = parse_content_range(
+                            res.info().get("Content-Range", "")
+                        )
+                        if not content_range or content_range != (
+                            part_size,
+                            expected_size,
+                        ):
+                            part_path.unlink(missing_ok=True)
+                            validators_path.unlink(missing_ok=True)
+                            raise ClientConnectionError(
+                                f"Unexpected Content-Range: {res.info().get('Content-Range')}"
+                            )
+                        resume_from = part_size
+                        self.logger.info(
+                            "Resuming download from %d/%d bytes",
+                            part_size,
+                            expected_size,
+                        )
+                    else:
+                        # full response, either first request or the file has changed
+                        etag = res.info().get("ETag")
+                        content_length = res.info().get("Content-Length", "")
+                        expected_size = (
+                            int(content_length) if content_length.isdigit() else None
+                        )
+                        if etag and expected_size:
+                            with validators_path.open("w", encoding="utf-8") as f:
+                                json.dump({"etag": etag, "size": expected_size}, f)
+                        else:
+                            validators_path.unlink(missing_ok=True)
+                    self._write_response(
+                        res, part_path, progress_callback, resume_from=resume_from
+                    )
+            except HTTPError as e:
+                if e.code == 416:  # Range Not Satisfiable
+                    part_path.unlink(missing_ok=True)
+                    validators_path.unlink(missing_ok=True)
+                if attempt < self.max_retries and (e.code >= 500 or e.code == 416):
+                    self.logger.warning(
+                        "Retrying due to %s: %s", e.__class__.__name__, str(e)
+                    )
+                    continue
+                raise
+            except (
+                SSLError,
+                SocketTimeout,
+                SocketError,
+                URLError,
+                HTTPException,
+                ConnectionError,
+                ClientConnectionError,
+            ) as connection_error:
+                if attempt < self.max_retries:
+                    self.logger.warning(
+                        "Retrying due to %s: %s",
+                        connection_error.__class__.__name__,
+                        str(connection_error),
+                    )
+                    continue
+                if isinstance(connection_error, ClientConnectionError):
+                    raise
+                raise ClientConnectionError(
+                    "{} {}".format(
+                        connection_error.__class__.__name__, str(connection_error)
+                    )
+                ) from connection_error
+
+            downloaded_size = part_path.stat().st_size
+            if expected_size is not None and downloaded_size != expected_size:
+                msg = f"Incomplete download: {downloaded_size}/{expected_size} bytes"
+                if attempt < self.max_retries:
+                    self.logger.warning("Retrying due to %s", msg)
+                    continue
+                raise ClientConnectionError(msg)
+
+            part_path.replace(file_path)
+            validators_path.unlink(missing_ok=True)
+            return file_path
+
+        raise ClientConnectionError(f"Unable to download {endpoint}")
+
     def fulfill_loan_file(self, loan_id: str, card_id: str, format_id: str) -> bytes:
         """
         Returns the loan file contents directly for MP3 audiobooks (.odm)
@@ -832,6 +1107,60 @@ class LibbyClient(object):
         )
         return res
 
+    def fulfill_loan_file_to_path(
+        self,
+        loan_id: str,
+        card_id: str,
+        format_id: str,
+        file_path: Path,
+        progress_callback: Optional[Callable[[int, Optional[int]], None]] = None,
+        part_path: Optional[Path] = None,
+    ) -> Path:
+        """
+        Streams the loan file to file_path instead of returning the file contents,
+        so that large files are not held in memory.
+        See :meth:`fulfill_loan_file` for what is downloaded.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :param file_path: Destination file
+        :param progress_callback: Called after each chunk with the number of bytes read
+                                  and the total bytes expected (None if unknown)
+        :param part_path: Partial file for open epub/pdf loans, which is kept
+                          if the download is interrupted so that it can be resumed
+        :return:
+        """
+        if format_id not in DOWNLOADABLE_FORMATS:
+            raise ValueError(f"Unsupported format_id: {format_id}")
+
+        headers = self.default_headers()
+        headers["Accept"] = "*/*"
+
+        if format_id in (LibbyFormats.EBookEPubOpen, LibbyFormats.EBookPDFOpen):
+            res_redirect = self.send_request(
+                f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
+                headers=headers,
+                no_redirect=True,
+                return_response=True,
+            )
+            return self._urlretrieve_to_path(
+                res_redirect.info()["Location"],
+                file_path,
+                headers=headers,
+                progress_callback=progress_callback,
+                part_path=part_path,
+            )
+
+        res = self.send_request(
+            f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
+            headers=headers,
+            return_response=True,
+        )
+        with res:
+            self._write_response(res, file_path, progress_callback)
+        return file_path
+
     def process_ebook(self, loan: Dict) -> Tuple[str, Dict, List[Dict]]:
         """
         Returns the data needed to download an ebook/magazine directly.
@@ -1357,3 +1686,11 @@ class LibbyClient(object):
             is_form=False,
         )
         return res
+
+
+@lru_cache(maxsize=PARSE_DATETIME_CACHE_SIZE)
+def _parse_datetime_cached(value: str) -> datetime:
+    dt = LibbyClient._parse_iso_datetime(value)
+    if dt:
+        return dt
+    return LibbyClient._parse_datetime_strptime(value)
@@ -14,16 +14,18 @@ import re
 import shutil
 import xml.etree.ElementTree as ET
 import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from functools import cmp_to_key
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urljoin, urlparse
 
 from bs4 import BeautifulSoup, Doctype, Tag, element
 from calibre.ptempfile import PersistentTemporaryDirectory
 
 from .compat import _c
+from .config import PREFS, PreferenceKeys
 from .download import LibbyDownload
 from .empty_download import EmptyBookDownload
 from .libby import LibbyClient
@@ -360,6 +362,41 @@ def _filter_content(entry: Dict, media_info: Dict, toc_pages: List[str]):
     return True
 
 
+def _fetch_in_order(
+    fetch: Callable[[Dict], bytes],
+    entries: List[Dict],
+    max_workers: int,
+    abort=None,
+) -> Iterator[Tuple[Dict, bytes]]:
+    """
+    Fetches entries concurrently but yields the results strictly in the order of entries.
+    Only a limited number of fetches are scheduled ahead of the entry being yielded
+    so that downloaded contents are not all held in memory.
+
+    :param fetch:
+    :param entries:
+    :param max_workers:
+    :param abort:
+    :return:
+    """
+    fetch_window = max_workers * 2
+    fetches: Dict[int, Future] = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for i, entry in enumerate(entries):
+            if abort and abort.is_set():
+                break
+            for j in range(i, min(i + fetch_window, len(entries))):
+                if j not in fetches:
+                    fetches[j] = executor.submit(fetch, entries[j])
+            yield entry, fetches.pop(i).result()
+    finally:
+        # don't start fetches that are no longer needed, e.g. on abort or error
+        for pending in fetches.values():
+            pending.cancel()
+        executor.shutdown(wait=True)
+
+
 class CustomMagazineDownload(LibbyDownload):
     def __call__(
         self,
@@ -575,13 +612,38 @@ class CustomMagazineDownload(LibbyDownload):
         # holds the manifest item ID for the image identified as the cover
         cover_img_manifest_id = None
 
-        total_downloads = len(title_content_entries)
+        downloadable_entries = []
+        for entry in title_content_entries:
+            entry_name = Path(urlparse(entry["url"]).path).name
+            if not guess_mimetype(entry_name):
+                logger.warning("Skipped roster entry: %s", entry_name)
+                continue
+            downloadable_entries.append(entry)
+        total_downloads = len(downloadable_entries)
 
-        for i, entry in enumerate(title_content_entries, start=1):
+        def fetch_entry(entry_to_fetch: Dict) -> bytes:
             if abort.is_set():
-                msg = "Abort signal received."
-                logger.info(msg)
-                raise RuntimeError(msg)
+                raise RuntimeError("Abort signal received.")
+            # use the libby client session because the required
+            # auth cookies are set there
+            return libby_client.send_request(
+                entry_to_fetch["url"],
+                headers=dict(headers),
+                authenticated=False,
+                decode_response=False,
+            )
+
+        # entries are downloaded concurrently but still processed in the sorted
+        # roster order, so font files are saved before the css is patched
+        for i, (entry, res) in enumerate(
+            _fetch_in_order(
+                fetch_entry,
+                downloadable_entries,
+                max(1, PREFS[PreferenceKeys.NETWORK_CONCURRENT_DOWNLOADS]),
+                abort,
+            ),
+            start=1,
+        ):
             entry_url = entry["url"]
             parsed_entry_url = urlparse(entry_url)
             title_content_path = Path(parsed_entry_url.path[1:])
@@ -589,9 +651,6 @@ class CustomMagazineDownload(LibbyDownload):
                 "Proccesing %d/%d : %s", i, total_downloads, title_content_path.name
             )
             media_type = guess_mimetype(title_content_path.name)
-            if not media_type:
-                logger.warning("Skipped roster entry: %s", title_content_path.name)
-                continue
             asset_folder = book_content_folder.joinpath(title_content_path.parent)
             if media_type == "application/x-dtbncx+xml":
                 has_ncx = True
@@ -616,11 +675,6 @@ class CustomMagazineDownload(LibbyDownload):
             asset_file_path = asset_folder.joinpath(Path(parsed_entry_url.path).name)
 
             soup = None
-            # use the libby client session because the required
-            # auth cookies are set there
-            res: bytes = libby_client.send_request(
-                entry_url, headers=headers, authenticated=False, decode_response=False
-            )
             # patch magazine css to fix various rendering problems
             if (
                 OverDriveClient.extract_type(media_info) == LibbyMediaTypes.Magazine
@@ -718,8 +772,8 @@ class CustomMagazineDownload(LibbyDownload):
                 with open(asset_file_path, "w", encoding="utf-8") as f_out:
                     f_out.write(str(soup))
             else:
-                with open(asset_file_path, "wb") as f_out:
-                    f_out.write(res)
+                with open(asset_file_path, "wb") as f_bytes_out:
+                    f_bytes_out.write(res)
             notifications.put(
                 (
                     (i / total_downloads) * download_progress_fraction
@@ -756,6 +810,11 @@ class CustomMagazineDownload(LibbyDownload):
                 # replace the cover image already downloaded via the OD api, in case it is to be kept
                 shutil.copyfile(asset_file_path, cover_path)
 
+        if abort.is_set():
+            msg = "Abort signal received."
+            logger.info(msg)
+            raise RuntimeError(msg)
+
         if not has_nav:
             # Generate nav - needed for magazines
 
@@ -7,9 +7,14 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
+import json
+import threading
+from abc import abstractmethod
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cmp_to_key
-from typing import Dict, List, Optional
+from timeit import default_timer as timer
+from typing import Any, Collection, Dict, Iterable, List, Optional, Set, Tuple
 
 from calibre.gui2 import elided_text
 from calibre.utils.config import tweaks
@@ -20,17 +25,24 @@ from qt.core import (
     QFont,
     QModelIndex,
     QSortFilterProxyModel,
+    QTimer,
     Qt,
     pyqtSignal,
 )
 
-from . import DEMO_MODE
+from . import DEMO_MODE, logger
 from .compat import QColor_fromString, _c
 from .config import MAX_SEARCH_LIBRARIES, PREFS, PreferenceKeys
 from .libby import LibbyClient
 from .libby.client import LibbyFormats, LibbyMediaTypes
 from .overdrive import OverDriveClient
-from .utils import PluginColors, PluginImages, obfuscate_date, obfuscate_name
+from .utils import (
+    OD_IDENTIFIER,
+    PluginColors,
+    PluginImages,
+    obfuscate_date,
+    obfuscate_name,
+)
 
 # noinspection PyUnreachableCode
 if False:
@@ -137,6 +149,44 @@ CREATOR_ROLE_TRANSLATION = {
 }
 
 
+class MediaIndex(object):
+    """
+    Loans or holds, indexed by (title id, card id) and title id.
+    """
+
+    def __init__(self, medias: Optional[Iterable[Dict]] = None):
+        self._medias: Dict[Tuple[str, str], Dict] = {}
+        # number of medias for each title id, i.e. across cards
+        self._title_counts: Dict[str, int] = {}
+        for media in medias or []:
+            self.add(media)
+
+    def __len__(self) -> int:
+        return len(self._medias)
+
+    def __iter__(self):
+        return iter(self._medias.values())
+
+    def add(self, media: Dict) -> None:
+        key = (media["id"], media["cardId"])
+        if key not in self._medias:
+            self._title_counts[media["id"]] = self._title_counts.get(media["id"], 0) + 1
+        self._medias[key] = media
+
+    def remove(self, title_id: str, card_id: str) -> None:
+        if self._medias.pop((title_id, card_id), None) is None:
+            return
+        self._title_counts[title_id] -= 1
+        if not self._title_counts[title_id]:
+            del self._title_counts[title_id]
+
+    def has(self, title_id: str, card_id: str) -> bool:
+        return (title_id, card_id) in self._medias
+
+    def has_title(self, title_id: str) -> bool:
+        return title_id in self._title_counts
+
+
 class LibbyModel(QAbstractTableModel):
     column_headers: List[str] = []
     DisplaySortRole = Qt.UserRole + 1000
@@ -147,6 +197,25 @@ class LibbyModel(QAbstractTableModel):
         self._cards = []
         self._libraries = []
         self._rows = []
+        # precomputed lower-cased text that the filter text is matched against, for each row
+        self._row_filter_texts: List[str] = []
+        self._index_cards()
+
+    def _index_cards(self):
+        self._cards_by_id: Dict[str, Dict] = {c["cardId"]: c for c in self._cards}
+        self._cards_by_advantage_key: Dict[str, List[Dict]] = {}
+        self._cards_by_website_id: Dict[str, List[Dict]] = {}
+        for c in self._cards:
+            self._cards_by_advantage_key.setdefault(c["advantageKey"], []).append(c)
+            self._cards_by_website_id.setdefault(c.get("websiteId"), []).append(c)
+        self._libraries_by_website_id: Dict[int, Dict] = {
+            lib["websiteId"]: lib for lib in self._libraries
+        }
+        self._library_website_ids_by_key: Dict[str, List[str]] = {}
+        for lib in self._libraries:
+            self._library_website_ids_by_key.setdefault(
+                lib.get("preferredKey"), []
+            ).append(str(lib["websiteId"]))
 
     def headerData(self, section, orientation, role):
         if role != Qt.DisplayRole:
@@ -166,11 +235,36 @@ class LibbyModel(QAbstractTableModel):
     def removeRows(self, row, count, _):
         self.beginRemoveRows(QModelIndex(), row, row + count - 1)
         self._rows = self._rows[:row] + self._rows[row + count :]
+        del self._row_filter_texts[row : row + count]
         self.endRemoveRows()
         return True
 
+    def row_filter_text(self, row: Dict) -> str:
+        """
+        The lower-cased text that the filter text is matched against for row.
+
+        :param row:
+        :return:
+        """
+        return ""
+
+    def filter_text_at(self, position: int) -> str:
+        return self._row_filter_texts[position]
+
+    def _media_filter_text(self, media: Dict, include_creator: bool = True) -> str:
+        try:
+            library_key = self.get_card(media["cardId"])["advantageKey"]
+        except ValueError:
+            library_key = ""
+        texts = [get_media_title(media)]
+        if include_creator:
+            texts.append(media.get("firstCreatorName", ""))
+        texts.append(library_key)
+        # separated so that the filter text cannot match across fields
+        return "\n".join(icu_lower(t or "") for t in texts)
+
     def library_keys(self) -> List[str]:
-        return list(set([c["advantageKey"] for c in self._cards]))
+        return list(self._cards_by_advantage_key.keys())
 
     def limited_library_keys(self) -> List[str]:
         all_library_keys = self.library_keys()
@@ -189,12 +283,10 @@ class LibbyModel(QAbstractTableModel):
             synced_state = {}
         self._cards = synced_state.get("cards", [])
         self._libraries = synced_state.get("__libraries", [])
+        self._index_cards()
 
     def get_card(self, card_id) -> Dict:
-        card = next(
-            iter([c for c in self._cards if c["cardId"] == card_id]),
-            None,
-        )
+        card = self._cards_by_id.get(card_id)
         if not card:
             raise ValueError("Card is unknown: id=%s" % card_id)
         return card
@@ -208,27 +300,204 @@ class LibbyModel(QAbstractTableModel):
         return int(card.get("library", {}).get("websiteId", "0"))
 
     def get_library(self, website_id: int) -> Dict:
-        library = next(
-            iter([lib for lib in self._libraries if lib["websiteId"] == website_id]),
-            None,
-        )
+        library = self._libraries_by_website_id.get(website_id)
         if not library:
             raise ValueError("Library is unknown: websiteId=%s" % website_id)
         return library
 
-    def has_media(self, title_id: str, card_id: str, medias: List[Dict]):
-        return bool(
-            [m for m in medias if m["id"] == title_id and m["cardId"] == card_id]
+    def has_media(self, title_id: str, card_id: str, medias: MediaIndex) -> bool:
+        return medias.has(title_id, card_id)
+
+    def remove_media(
+        self, title_id: str, card_id: str, medias: MediaIndex
+    ) -> MediaIndex:
+        medias.remove(title_id, card_id)
+        return medias
+
+
+def bisect_descending(keys: List, key) -> int:
+    """
+    Like :func:`bisect.bisect_right` but for keys sorted in descending order,
+    i.e. the position after any existing equal keys.
+
+    :param keys:
+    :param key:
+    :return:
+    """
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key > keys[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class LibbySortedModel(LibbyModel):
+    """
+    A model with rows kept in descending order of :meth:`row_sort_key`
+    so that individual rows can be inserted and removed without resetting the model.
+    Rows are identified by (id, cardId).
+    """
+
+    def __init__(self, parent, synced_state=None, db=None):
+        super().__init__(parent, synced_state, db)
+        # precomputed sort key for each row
+        self._row_keys: List = []
+
+    @staticmethod
+    def row_id(row: Dict) -> Tuple[str, Optional[str]]:
+        return row["id"], row.get("cardId")
+
+    @abstractmethod
+    def row_sort_key(self, row: Dict):
+        """
+        The key that the rows are sorted by, in descending order.
+
+        :param row:
+        :return:
+        """
+
+    def sort_rows(self):
+        self.beginResetModel()
+        self._rows = sorted(self._rows, key=self.row_sort_key, reverse=True)
+        self._row_keys = [self.row_sort_key(r) for r in self._rows]
+        self._row_filter_texts = [self.row_filter_text(r) for r in self._rows]
+        self.endResetModel()
+
+    def removeRows(self, row, count, _):
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        del self._rows[row : row + count]
+        del self._row_keys[row : row + count]
+        del self._row_filter_texts[row : row + count]
+        self.endRemoveRows()
+        return True
+
+    def insert_row(self, row: Dict) -> int:
+        """
+        Insert a row at its sorted position.
+
+        :param row:
+        :return: The position of the inserted row
+        """
+        key = self.row_sort_key(row)
+        position = bisect_descending(self._row_keys, key)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self._rows.insert(position, row)
+        self._row_keys.insert(position, key)
+        self._row_filter_texts.insert(position, self.row_filter_text(row))
+        self.endInsertRows()
+        return position
+
+    def remove_row(self, title_id: str, card_id: str) -> None:
+        """
+        Remove the rows for (title_id, card_id).
+
+        :param title_id:
+        :param card_id:
+        :return:
+        """
+        for position in reversed(range(len(self._rows))):
+            if self.row_id(self._rows[position]) == (title_id, card_id):
+                self.removeRows(position, 1, QModelIndex())
+
+    def replace_row(self, position: int, row: Dict) -> None:
+        """
+        Replace a row, moving it if its sort position has changed.
+
+        :param position:
+        :param row:
+        :return:
+        """
+        key = self.row_sort_key(row)
+        if key != self._row_keys[position]:
+            new_position = bisect_descending(self._row_keys, key)
+            if new_position > position:
+                # the position is for the rows without this row
+                new_position -= 1
+            if new_position != position:
+                # destination is the position before the row is moved
+                self.beginMoveRows(
+                    QModelIndex(),
+                    position,
+                    position,
+                    QModelIndex(),
+                    new_position if new_position < position else new_position + 1,
+                )
+                self._rows.insert(new_position, self._rows.pop(position))
+                self._row_keys.insert(new_position, self._row_keys.pop(position))
+                self._row_filter_texts.insert(
+                    new_position, self._row_filter_texts.pop(position)
+                )
+                self.endMoveRows()
+                position = new_position
+            self._row_keys[position] = key
+        self._rows[position] = row
+        self._row_filter_texts[position] = self.row_filter_text(row)
+        self.dataChanged.emit(
+            self.index(position, 0), self.index(position, self.columnCount() - 1)
         )
 
-    def remove_media(self, title_id: str, card_id: str, medias: List[Dict]):
-        return [
-            m for m in medias if not (m["id"] == title_id and m["cardId"] == card_id)
-        ]
+    def apply_rows(self, rows: List[Dict]) -> None:
+        """
+        Update the model to the new rows, only inserting, removing and updating
+        the rows that have changed.
+
+        :param rows:
+        :return:
+        """
+        if not (self._rows and rows):
+            self._rows = list(rows)
+            self.sort_rows()
+            return
+
+        new_rows = {self.row_id(r): r for r in rows}
+        for position in reversed(range(len(self._rows))):
+            if self.row_id(self._rows[position]) not in new_rows:
+                self.removeRows(position, 1, QModelIndex())
+        existing_rows = {self.row_id(r): r for r in self._rows}
+        for row_id, row in new_rows.items():
+            existing_row = existing_rows.get(row_id)
+            if existing_row is None:
+                self.insert_row(row)
+            elif row != existing_row:
+                # looked up again because inserts and moves shift the positions
+                self.replace_row(self.row_position(existing_row), row)
+        # the cards may also have changed
+        self._row_filter_texts = [self.row_filter_text(r) for r in self._rows]
+
+    def row_position(self, row: Dict) -> int:
+        """
+        Find the position of a row, only searching the rows with the same sort key.
+
+        :param row:
+        :return:
+        """
+        key = self.row_sort_key(row)
+        row_id = self.row_id(row)
+        position = bisect_descending(self._row_keys, key) - 1
+        while position >= 0 and self._row_keys[position] == key:
+            if self.row_id(self._rows[position]) == row_id:
+                return position
+            position -= 1
+        raise ValueError("Row is not in the model: id=%s, cardId=%s" % row_id)
+
+    def setData(self, index, row, role=Qt.EditRole):
+        if role == Qt.EditRole:
+            self.replace_row(index.row(), row)
+            return True
 
 
 class LibbySortFilterModel(QSortFilterProxyModel):
+    """
+    Changes to the filter text are debounced so that the rows are only
+    filtered once the user has paused typing.
+    """
+
     filter_text_set = pyqtSignal()
+    # in milliseconds
+    filter_text_delay = 250
 
     def __init__(self, parent, model=None, db=None):
         super().__init__(parent)
@@ -236,6 +505,13 @@ class LibbySortFilterModel(QSortFilterProxyModel):
         self.setFilterKeyColumn(-1)
         self.setSortRole(LibbyModel.DisplaySortRole)
         self.filter_text = ""
+        self._pending_filter_text = ""
+        # when set, only these source rows need to be filtered again
+        self._narrowed_source_rows: Optional[Set[int]] = None
+        self._filter_text_timer = QTimer(self)
+        self._filter_text_timer.setSingleShot(True)
+        self._filter_text_timer.setInterval(self.filter_text_delay)
+        self._filter_text_timer.timeout.connect(self.apply_filter_text)
         self.db = db
         if model:
             self.setSourceModel(model)
@@ -247,17 +523,292 @@ class LibbySortFilterModel(QSortFilterProxyModel):
         return super().headerData(section, orientation, role)
 
     def set_filter_text(self, filter_text_value: str):
-        self.filter_text = icu_lower(str(filter_text_value).strip())
-        self.invalidateFilter()
+        """
+        Set the filter text, which is only applied after :attr:`filter_text_delay`.
+
+        :param filter_text_value:
+        :return:
+        """
+        self._pending_filter_text = icu_lower(str(filter_text_value).strip())
+        self._filter_text_timer.start()
+
+    def apply_filter_text(self):
+        """
+        Apply the pending filter text now.
+
+        :return:
+        """
+        self._filter_text_timer.stop()
+        previous_filter_text = self.filter_text
+        self.filter_text = self._pending_filter_text
+        if self.filter_text == previous_filter_text:
+            return
+        # if the new text extends the old text, rows that are currently
+        # filtered out cannot match, so only the accepted rows need to be tested
+        self.invalidate_filter_text(
+            bool(previous_filter_text)
+            and self.filter_text.startswith(previous_filter_text)
+        )
         self.filter_text_set.emit()
 
+    def invalidate_filter_text(self, narrowing: bool):
+        if narrowing:
+            self._narrowed_source_rows = {
+                self.mapToSource(self.index(row, 0)).row()
+                for row in range(self.rowCount())
+            }
+        try:
+            self.invalidateFilter()
+        finally:
+            self._narrowed_source_rows = None
+
+    def is_narrowed_out(self, source_row: int) -> bool:
+        """
+        If the source row can be rejected without testing it because
+        the filter text has been narrowed down.
+
+        :param source_row:
+        :return:
+        """
+        return (
+            self._narrowed_source_rows is not None
+            and source_row not in self._narrowed_source_rows
+        )
+
+    def matches_filter_text(self, source_row: int) -> bool:
+        if not self.filter_text:
+            return True
+        return self.filter_text in self.sourceModel().filter_text_at(source_row)
+
+
+class LibraryMatchIndex(object):
+    """
+    Lookup index of the calibre library titles and identifiers, so that
+    finding if a title is already in the library does not require a scan
+    of every book in the library.
+
+    The index is built on first use and is kept updated from the calibre
+    database events. The index can be used from multiple threads, so it is
+    only updated and read with the lock held.
+    """
+
+    # calibre fields that the index is built from
+    indexed_fields = ("title", "identifiers", "formats")
+
+    def __init__(self, db=None):
+        self.db = db
+        # reentrant because lookups refresh the index first
+        self._lock = threading.RLock()
+        self._is_stale = True
+        self._pending_book_ids: Set[int] = set()
+        self._titles: Dict[str, Set[int]] = {}
+        self._identifiers: Dict[Tuple[str, str], Set[int]] = {}
+        self._book_keys: Dict[int, Tuple[List[str], List[Tuple[str, str]]]] = {}
+        self._empty_book_ids: Set[int] = set()
+        if db is not None and hasattr(db, "add_listener"):
+            # calibre only holds a weak reference to the listener
+            db.add_listener(self.db_event_received)
+
+    def invalidate(self) -> None:
+        """
+        Mark the index for a full rebuild on next use.
+
+        :return:
+        """
+        with self._lock:
+            self._is_stale = True
+            self._pending_book_ids.clear()
+
+    def db_event_received(self, library_id, event_type, event_data) -> None:
+        """
+        Listener for calibre database events. This is called from calibre's
+        event dispatcher thread so changed books are only queued for re-indexing.
+
+        :param library_id:
+        :param event_type:
+        :param event_data:
+        :return:
+        """
+        event_name = getattr(event_type, "name", "")
+        book_ids: Iterable[int] = []
+        if event_name in ("book_created", "format_added", "book_edited"):
+            book_ids = [event_data[0]]
+        elif event_name == "books_removed":
+            book_ids = event_data[0]
+        elif event_name == "metadata_changed":
+            if event_data[0] not in self.indexed_fields:
+                return
+            book_ids = event_data[1]
+        elif event_name == "formats_removed":
+            self.invalidate()
+            return
+        else:
+            return
+        with self._lock:
+            self._pending_book_ids.update(book_ids)
+
+    @staticmethod
+    def _book_identifier_keys(identifiers: Dict) -> List[Tuple[str, str]]:
+        keys = []
+        if identifiers.get("isbn"):
+            keys.append(("isbn", identifiers["isbn"]))
+        for asin_key in ("amazon", "asin"):
+            if identifiers.get(asin_key):
+                keys.append(("asin", identifiers[asin_key]))
+        # the odid identifier can contain multiple links, e.g. 1234@abc.overdrive.com&5678@def.overdrive.com
+        for od_link in (identifiers.get(OD_IDENTIFIER) or "").split("&"):
+            title_id = od_link.split("@")[0]
+            if title_id:
+                keys.append(("odid", title_id))
+        return keys
+
+    def _unindex_book(self, book_id: int) -> None:
+        title_keys, identifier_keys = self._book_keys.pop(book_id, ([], []))
+        for title_key in title_keys:
+            self._discard_book_id(self._titles, title_key, book_id)
+        for identifier_key in identifier_keys:
+            self._discard_book_id(self._identifiers, identifier_key, book_id)
+        self._empty_book_ids.discard(book_id)
+
+    @staticmethod
+    def _discard_book_id(lookup: Dict[Any, Set[int]], key, book_id: int) -> None:
+        book_ids = lookup.get(key)
+        if book_ids is None:
+            return
+        book_ids.discard(book_id)
+        if not book_ids:
+            del lookup[key]
+
+    def _index_book(
+        self,
+        book_id: int,
+        title: Optional[str],
+        identifiers: Optional[Dict],
+        formats: Optional[Tuple],
+    ) -> None:
+        self._unindex_book(book_id)
+        if title is None:
+            # book has been removed
+            return
+        title_keys = [icu_lower(title)]
+        identifier_keys = self._book_identifier_keys(identifiers or {})
+        for key in title_keys:
+            self._titles.setdefault(key, set()).add(book_id)
+        for key in identifier_keys:
+            self._identifiers.setdefault(key, set()).add(book_id)
+        if not formats:
+            self._empty_book_ids.add(book_id)
+        self._book_keys[book_id] = (title_keys, identifier_keys)
+
+    def refresh(self) -> None:
+        """
+        Apply any pending updates to the index, e.g. before it is used from
+        another thread without refreshing.
+
+        :return:
+        """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        # must be called with the lock held so that the index is never seen half-built
+        is_stale = self._is_stale
+        pending_book_ids: Collection[int] = self._pending_book_ids
+        if not (is_stale or pending_book_ids) or self.db is None:
+            return
+        self._is_stale = False
+        self._pending_book_ids = set()
+
+        start = timer()
+        all_book_ids_titles = self.db.fields["title"].table.book_col_map
+        all_book_ids_formats = self.db.fields["formats"].table.book_col_map
+        all_book_ids_identifiers = self.db.fields["identifiers"].table.book_col_map
+        if is_stale:
+            self._titles = {}
+            self._identifiers = {}
+            self._book_keys = {}
+            self._empty_book_ids = set()
+            pending_book_ids = all_book_ids_titles.keys()
+        for book_id in pending_book_ids:
+            self._index_book(
+                book_id,
+                all_book_ids_titles.get(book_id),
+                all_book_ids_identifiers.get(book_id),
+                all_book_ids_formats.get(book_id),
+            )
+        logger.debug(
+            "Library match index %s for %d books took %f seconds",
+            "build" if is_stale else "update",
+            len(pending_book_ids),
+            timer() - start,
+        )
+
+    def find_book(
+        self,
+        titles: Iterable[str],
+        isbn: str = "",
+        asin: str = "",
+        odid: str = "",
+        refresh: bool = True,
+    ) -> Optional[int]:
+        """
+        Find the first book in the library matching any of the conditions.
+
+        :param titles: Lower-cased titles
+        :param isbn:
+        :param asin:
+        :param odid: OverDrive title id
+        :param refresh: If False, pending updates are not applied, so that the
+                        calibre db is not read, e.g. from a non-GUI thread
+        :return:
+        """
+        book_ids: Set[int] = set()
+        with self._lock:
+            if refresh:
+                self._refresh()
+            for title in titles:
+                book_ids.update(self._titles.get(title, ()))
+            for key in (("isbn", isbn), ("asin", asin), ("odid", odid)):
+                if key[1]:
+                    book_ids.update(self._identifiers.get(key, ()))
+        return min(book_ids) if book_ids else None
+
+    def in_library(
+        self,
+        titles: Iterable[str],
+        isbn: str = "",
+        asin: str = "",
+        odid: str = "",
+        exclude_empty_books: bool = False,
+        refresh: bool = True,
+    ) -> bool:
+        """
+        Check if a title is already in the library.
+
+        :param titles: Lower-cased titles
+        :param isbn:
+        :param asin:
+        :param odid: OverDrive title id
+        :param exclude_empty_books: If True, a book without formats is not considered a match
+        :param refresh: See :meth:`find_book`
+        :return:
+        """
+        with self._lock:
+            book_id = self.find_book(
+                titles, isbn=isbn, asin=asin, odid=odid, refresh=refresh
+            )
+            if book_id is None:
+                return False
+            # check only first matching book
+            return not (exclude_empty_books and book_id in self._empty_book_ids)
+
 
 LoanMatchCondition = namedtuple(
     "LoanMatchCondition", ["title1", "title2", "isbn", "asin"]
 )
 
 
-class LibbyLoansModel(LibbyModel):
+class LibbyLoansModel(LibbySortedModel):
     """
     Underlying data model for the Loans table view
     """
@@ -280,16 +831,15 @@ class LibbyLoansModel(LibbyModel):
         self.filter_hide_books_already_in_library = PREFS[
             PreferenceKeys.HIDE_BOOKS_ALREADY_IN_LIB
         ]
-        self._holds = []
+        self._holds = MediaIndex()
         self.sync(synced_state)
 
     def sync(self, synced_state: Optional[Dict] = None):
         super().sync(synced_state)
         if not synced_state:
             synced_state = {}
-        self._rows = synced_state.get("loans", [])
-        self._holds = synced_state.get("holds", [])
-        self.sort_rows()
+        self._holds = MediaIndex(synced_state.get("holds", []))
+        self.apply_rows(synced_state.get("loans", []))
 
     def has_hold(self, loan: Dict) -> bool:
         # used to check that we don't offer to create a new hold for
@@ -297,34 +847,26 @@ class LibbyLoansModel(LibbyModel):
         return self.has_media(loan["id"], loan["cardId"], self._holds)
 
     def add_loan(self, loan: Dict):
-        self._rows.append(loan)
-        self.sort_rows()
+        self.insert_row(loan)
 
     def remove_loan(self, loan: Dict):
-        self._rows = self.remove_media(loan["id"], loan["cardId"], self._rows)
-        self.sort_rows()
+        self.remove_row(loan["id"], loan["cardId"])
 
     def add_hold(self, hold: Dict):
-        self._holds.append(hold)
+        self._holds.add(hold)
 
     def remove_hold(self, hold: Dict):
         self._holds = self.remove_media(hold["id"], hold["cardId"], self._holds)
 
-    def sort_rows(self):
-        self.beginResetModel()
-        self._rows = sorted(self._rows, key=lambda ln: ln["checkoutDate"], reverse=True)
-        self.endResetModel()
+    def row_sort_key(self, loan: Dict):
+        return loan["checkoutDate"]
 
-    def set_filter_hide_books_already_in_library(self, value: bool):
-        if value != self.filter_hide_books_already_in_library:
-            self.filter_hide_books_already_in_library = value
-            self.sort_rows()
+    def row_filter_text(self, loan: Dict) -> str:
+        return self._media_filter_text(loan)
 
-    def setData(self, index, loan, role=Qt.EditRole):
-        if role == Qt.EditRole:
-            self._rows[index.row()] = loan
-            self.dataChanged.emit(index, index)
-            return True
+    def set_filter_hide_books_already_in_library(self, value: bool):
+        # the rows are filtered by LibbyLoansSortFilterModel
+        self.filter_hide_books_already_in_library = value
 
     def data(self, index, role):
         row, col = index.row(), index.column()
@@ -428,74 +970,207 @@ class LibbyLoansModel(LibbyModel):
         return None
 
 
+# snapshot of the loans filter settings, so that rows can be filtered off the GUI thread
+LoansFilterState = namedtuple(
+    "LoansFilterState",
+    [
+        "filter_text",
+        "hide_books_already_in_library",
+        "temporarily_hidden",
+        "prefer_open_formats",
+        "include_nondownloadable",
+        "exclude_empty_books",
+    ],
+)
+
+
 class LibbyLoansSortFilterModel(LibbySortFilterModel):
-    def __init__(self, parent, model=None, db=None):
-        super().__init__(parent, model, db)
-        self.all_book_ids_titles = self.db.fields["title"].table.book_col_map
-        self.all_book_ids_formats = self.db.fields["formats"].table.book_col_map
-        self.all_book_ids_identifiers = self.db.fields["identifiers"].table.book_col_map
+    """
+    Filtering a loan can require a calibre library lookup, so the filter
+    results for all rows are computed in a background thread whenever
+    the filters or the loans change, and then applied in one go.
+    """
+
+    # emitted from the filter thread with the filter generation and the results
+    filter_computed = pyqtSignal(int, object)
+
+    def __init__(self, parent, model=None, db=None, match_index=None):
+        # source model is only set once the filter attributes are initialised
+        super().__init__(parent, None, db)
+        self.match_index: LibraryMatchIndex = match_index or LibraryMatchIndex(db)
         self.filter_hide_books_already_in_library = PREFS[
             PreferenceKeys.HIDE_BOOKS_ALREADY_IN_LIB
         ]
-        self.temporarily_hidden: List[Dict] = []
+        self.temporarily_hidden: Set[Tuple[str, str]] = set()
+        # (title id, card id) -> if the row is accepted, from the last completed filter run
+        self._accepted_rows: Optional[Dict[Tuple[str, str], bool]] = None
+        # incremented for each filter run so that superseded results are ignored
+        self._filter_generation = 0
+        self._applied_filter_generation = 0
+        # if the next filter run only needs to test the currently accepted rows
+        self._filter_narrowing = False
+        self._filter_executor = ThreadPoolExecutor(max_workers=1)
+        self.filter_computed.connect(self._apply_filter_results)
+        # coalesces the changes made in the same event loop iteration into one filter run
+        self._filter_timer = QTimer(self)
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(0)
+        self._filter_timer.timeout.connect(self.run_filter)
+        if model:
+            self.setSourceModel(model)
+            for signal in (model.modelReset, model.rowsInserted, model.dataChanged):
+                signal.connect(self.refresh_filter)
+            self.refresh_filter()
 
     def temporarily_hide(self, loan: Dict):
         if not self.is_temporarily_hidden(loan):
-            self.temporarily_hidden.append(loan)
-            self.invalidateFilter()
+            self.temporarily_hidden.add((loan["id"], loan["cardId"]))
+            if (
+                self.filter_hide_books_already_in_library
+                and self._accepted_rows is not None
+            ):
+                # hide immediately instead of waiting for the filter run
+                self._accepted_rows[(loan["id"], loan["cardId"])] = False
+                self.invalidateFilter()
 
     def unhide(self, loan: Dict):
-        self.temporarily_hidden = [
-            h
-            for h in self.temporarily_hidden
-            if not (h["id"] == loan["id"] and h["cardId"] == loan["cardId"])
-        ]
-        self.invalidateFilter()
+        self.temporarily_hidden.discard((loan["id"], loan["cardId"]))
+        self.refresh_filter()
 
     def is_temporarily_hidden(self, loan: Dict) -> bool:
-        return bool(
-            [
-                h
-                for h in self.temporarily_hidden
-                if h["id"] == loan["id"] and h["cardId"] == loan["cardId"]
-            ]
-        )
+        return (loan["id"], loan["cardId"]) in self.temporarily_hidden
 
     def set_filter_hide_books_already_in_library(self, value: bool):
         if value != self.filter_hide_books_already_in_library:
             self.filter_hide_books_already_in_library = value
-            self.invalidateFilter()
+            self.refresh_filter()
+
+    def invalidate_filter_text(self, narrowing: bool):
+        # rows can only be narrowed down from the accepted rows if they are
+        # up-to-date, i.e. there are no filter runs pending or in progress
+        narrowing = (
+            narrowing
+            and self._accepted_rows is not None
+            and self._applied_filter_generation == self._filter_generation
+            and not self._filter_timer.isActive()
+        )
+        self.refresh_filter()
+        self._filter_narrowing = narrowing
+
+    def _filter_state(self) -> LoansFilterState:
+        return LoansFilterState(
+            filter_text=self.filter_text,
+            hide_books_already_in_library=self.filter_hide_books_already_in_library,
+            temporarily_hidden=frozenset(self.temporarily_hidden),
+            prefer_open_formats=PREFS[PreferenceKeys.PREFER_OPEN_FORMATS],
+            include_nondownloadable=PREFS[PreferenceKeys.INCL_NONDOWNLOADABLE_TITLES],
+            exclude_empty_books=PREFS[PreferenceKeys.EXCLUDE_EMPTY_BOOKS],
+        )
 
-    def filterAcceptsRow(self, sourceRow, sourceParent):
+    def refresh_filter(self, *_):
+        """
+        Schedule a filter run.
+
+        :return:
+        """
+        self._filter_narrowing = False
+        self._filter_timer.start()
+
+    def run_filter(self) -> Optional[Future]:
+        """
+        Recompute the filter results for all rows in the background.
+
+        :return:
+        """
         model: LibbyModel = self.sourceModel()
-        index = model.index(sourceRow, 0, sourceParent)
-        loan = model.data(index, Qt.UserRole)
+        if not model:
+            return None
+        self._filter_generation += 1
+        generation = self._filter_generation
+        state = self._filter_state()
+        if state.hide_books_already_in_library:
+            # the calibre db is only read on the GUI thread
+            self.match_index.refresh()
+        narrowed_rows = self._accepted_rows if self._filter_narrowing else None
+        self._filter_narrowing = False
+        # rows that are rejected without testing because the filter text was narrowed
+        rejected_rows = {}
+        loans = []
+        for row in range(model.rowCount()):
+            loan = model.data(model.index(row, 0), Qt.UserRole)
+            if (
+                narrowed_rows is not None
+                and narrowed_rows.get((loan["id"], loan["cardId"])) is False
+            ):
+                rejected_rows[(loan["id"], loan["cardId"])] = False
+                continue
+            loans.append((loan, model.filter_text_at(row)))
 
+        def run():
+            start = timer()
+            accepted_rows = dict(rejected_rows)
+            try:
+                for loan, loan_filter_text in loans:
+                    accepted_rows[(loan["id"], loan["cardId"])] = self._accepts_loan(
+                        loan, loan_filter_text, state, refresh_match_index=False
+                    )
+            except Exception as err:  # noqa
+                # show all the loans rather than leave the view empty
+                logger.exception("Error filtering loans: %s", err)
+                accepted_rows = {
+                    (loan["id"], loan["cardId"]): True for loan, _ in loans
+                }
+                accepted_rows.update({k: True for k in rejected_rows})
+            logger.debug(
+                "Filtering %d loans took %f seconds", len(loans), timer() - start
+            )
+            try:
+                self.filter_computed.emit(generation, accepted_rows)
+            except RuntimeError:
+                # model has been deleted
+                pass
+
+        return self._filter_executor.submit(run)
+
+    def _apply_filter_results(self, generation: int, accepted_rows: Dict):
+        if generation != self._filter_generation:
+            # superseded by a newer filter run
+            return
+        self._applied_filter_generation = generation
+        if accepted_rows == self._accepted_rows:
+            return
+        self._accepted_rows = accepted_rows
+        self.invalidateFilter()
+
+    def _accepts_loan(
+        self,
+        loan: Dict,
+        loan_filter_text: str,
+        state: LoansFilterState,
+        refresh_match_index: bool = True,
+    ) -> bool:
         if not is_valid_type(loan):
             return False
 
         try:
             loan_format = LibbyClient.get_loan_format(
                 loan,
-                PREFS[PreferenceKeys.PREFER_OPEN_FORMATS],
-                raise_if_not_downloadable=not PREFS[
-                    PreferenceKeys.INCL_NONDOWNLOADABLE_TITLES
-                ],
+                state.prefer_open_formats,
+                raise_if_not_downloadable=not state.include_nondownloadable,
             )
         except ValueError:
             return False
 
-        if not (self.filter_text or self.filter_hide_books_already_in_library):
+        if not (state.filter_text or state.hide_books_already_in_library):
             # return early if no filters
             return True
 
         loan_title1 = icu_lower(get_media_title(loan).strip())
-        if self.filter_hide_books_already_in_library:
+        if state.hide_books_already_in_library:
             # hide lib books filter is enabled
-            if self.is_temporarily_hidden(loan):
+            if (loan["id"], loan["cardId"]) in state.temporarily_hidden:
                 return False
 
-            book_in_library = False
             loan_title2 = icu_lower(
                 get_media_title(loan, include_subtitle=True).strip()
             )
@@ -503,38 +1178,38 @@ class LibbyLoansSortFilterModel(LibbySortFilterModel):
                 loan.get("formats", []), [loan_format] if loan_format else []
             )
             loan_asin = OverDriveClient.extract_asin(loan.get("formats", []))
-            for book_id, title in iter(self.all_book_ids_titles.items()):
-                book_identifiers = self.all_book_ids_identifiers.get(book_id) or {}
-                book_in_library = (
-                    icu_lower(title) in (loan_title1, loan_title2)
-                    or (loan_isbn and loan_isbn == book_identifiers.get("isbn", ""))
-                    or (loan_asin and loan_asin == book_identifiers.get("amazon", ""))
-                    or (loan_asin and loan_asin == book_identifiers.get("asin", ""))
-                )
-                if book_in_library:
-                    if PREFS[
-                        PreferenceKeys.EXCLUDE_EMPTY_BOOKS
-                    ] and not self.all_book_ids_formats.get(book_id):
-                        book_in_library = False
-                    break  # check only first matching book
-
-            if book_in_library:
+            if self.match_index.in_library(
+                (loan_title1, loan_title2),
+                isbn=loan_isbn,
+                asin=loan_asin,
+                odid=loan["id"],
+                exclude_empty_books=state.exclude_empty_books,
+                refresh=refresh_match_index,
+            ):
                 return False
 
-        if not self.filter_text:
-            return True
+        return not state.filter_text or state.filter_text in loan_filter_text
 
-        card = model.get_card(loan["cardId"])
-        creator_name = icu_lower(loan.get("firstCreatorName", ""))
-        library = icu_lower(card["advantageKey"])
-        return (
-            self.filter_text in loan_title1
-            or self.filter_text in creator_name
-            or self.filter_text in library
+    def filterAcceptsRow(self, sourceRow, sourceParent):
+        model: LibbyModel = self.sourceModel()
+        index = model.index(sourceRow, 0, sourceParent)
+        loan = model.data(index, Qt.UserRole)
+
+        if self._accepted_rows is not None:
+            accepted = self._accepted_rows.get((loan["id"], loan["cardId"]))
+            if accepted is not None:
+                return accepted
+        elif self.filter_hide_books_already_in_library:
+            # hidden until the first filter run has completed,
+            # instead of looking up the calibre library on the GUI thread
+            return False
+        # row added since the last filter run
+        return self._accepts_loan(
+            loan, model.filter_text_at(sourceRow), self._filter_state()
         )
 
 
-class LibbyHoldsModel(LibbyModel):
+class LibbyHoldsModel(LibbySortedModel):
     """
     Underlying data model for the Holds table view
     """
@@ -560,35 +1235,23 @@ class LibbyHoldsModel(LibbyModel):
         super().sync(synced_state)
         if not synced_state:
             synced_state = {}
-        self._rows = synced_state.get("holds", [])
-        self.sort_rows()
+        self.apply_rows(synced_state.get("holds", []))
 
     def add_hold(self, hold: Dict):
-        self._rows.append(hold)
-        self.sort_rows()
+        self.insert_row(hold)
 
     def remove_hold(self, hold: Dict):
-        self._rows = self.remove_media(hold["id"], hold["cardId"], self._rows)
-        self.sort_rows()
+        self.remove_row(hold["id"], hold["cardId"])
 
-    def sort_rows(self):
-        self.beginResetModel()
-        self._rows = sorted(
-            self._rows,
-            key=lambda h: (
-                h["isAvailable"],
-                -h.get("estimatedWaitDays", 9999),
-                h["placedDate"],
-            ),
-            reverse=True,
+    def row_sort_key(self, hold: Dict):
+        return (
+            hold["isAvailable"],
+            -hold.get("estimatedWaitDays", 9999),
+            hold["placedDate"],
         )
-        self.endResetModel()
 
-    def setData(self, index, hold, role=Qt.EditRole):
-        if role == Qt.EditRole:
-            self._rows[index.row()] = hold
-            self.dataChanged.emit(index, index)
-            return True
+    def row_filter_text(self, hold: Dict) -> str:
+        return self._media_filter_text(hold)
 
     def data(self, index, role):
         row, col = index.row(), index.column()
@@ -717,6 +1380,9 @@ class LibbyHoldsSortFilterModel(LibbySortFilterModel):
             self.invalidateFilter()
 
     def filterAcceptsRow(self, sourceRow, sourceParent):
+        if self.is_narrowed_out(sourceRow):
+            return False
+
         model: LibbyModel = self.sourceModel()
         index = model.index(sourceRow, 0, sourceParent)
         hold = model.data(index, Qt.UserRole)
@@ -731,20 +1397,7 @@ class LibbyHoldsSortFilterModel(LibbySortFilterModel):
         if self.filter_hide_unavailable_holds and not hold.get("isAvailable", False):
             return False
 
-        if not self.filter_text:
-            return True
-
-        index = self.sourceModel().index(sourceRow, 0, sourceParent)
-        hold = self.sourceModel().data(index, Qt.UserRole)
-        card = self.sourceModel().get_card(hold["cardId"])
-        title = icu_lower(get_media_title(hold))
-        creator_name = icu_lower(hold.get("firstCreatorName", ""))
-        library = icu_lower(card["advantageKey"])
-        return (
-            self.filter_text in title
-            or self.filter_text in creator_name
-            or self.filter_text in library
-        )
+        return self.matches_filter_text(sourceRow)
 
 
 class LibbyCardsModel(LibbyModel):
@@ -766,8 +1419,23 @@ class LibbyCardsModel(LibbyModel):
     def sort_rows(self):
         self.beginResetModel()
         self._rows = sorted(self._rows, key=lambda c: c["advantageKey"])
+        self._row_filter_texts = [self.row_filter_text(r) for r in self._rows]
         self.endResetModel()
 
+    def row_filter_text(self, card: Dict) -> str:
+        try:
+            library_name = self.get_library(self.get_website_id(card))["name"]
+        except ValueError:
+            library_name = ""
+        return "\n".join(
+            icu_lower(t or "")
+            for t in (
+                card.get("advantageKey", ""),
+                card.get("cardName", ""),
+                library_name,
+            )
+        )
+
     def data(self, index, role):
         row, col = index.row(), index.column()
         if row >= self.rowCount() or col >= self.columnCount():
@@ -786,20 +1454,12 @@ class LibbyCardsModel(LibbyModel):
 
 class LibbyCardsSortFilterModel(LibbySortFilterModel):
     def filterAcceptsRow(self, sourceRow, sourceParent):
-        if not self.filter_text:
-            return True
-        model = self.sourceModel()
-        index = model.index(sourceRow, 0, sourceParent)
-        card = model.data(index, Qt.UserRole)
-        library = model.get_library(model.get_website_id(card))
-        return (
-            self.filter_text in icu_lower(card.get("advantageKey", ""))
-            or self.filter_text in icu_lower(card.get("cardName", "") or "")
-            or self.filter_text in icu_lower(library["name"] or "")
-        )
+        if self.is_narrowed_out(sourceRow):
+            return False
+        return self.matches_filter_text(sourceRow)
 
 
-class LibbyMagazinesModel(LibbyModel):
+class LibbyMagazinesModel(LibbySortedModel):
     """
     Underlying data model for the Magazines table view
     """
@@ -810,39 +1470,50 @@ class LibbyMagazinesModel(LibbyModel):
 
     def __init__(self, parent, synced_state=None, db=None):
         super().__init__(parent, synced_state, db)
-        self._loans: List[Dict] = []
+        self._loans = MediaIndex()
         self.sync(synced_state)
 
     def sync(self, synced_state: Optional[Dict] = None):
         super().sync(synced_state)
         if not synced_state:
             synced_state = {}
-        self._loans = synced_state.get("loans", [])
-        self._rows = synced_state.get("__subscriptions", [])
-        self.fill_and_sort_rows()
+        self._loans = MediaIndex(synced_state.get("loans", []))
+        self.sync_subscriptions(synced_state.get("__subscriptions", []))
 
     def sync_subscriptions(self, subscriptions: List[Dict]):
-        self._rows = subscriptions
-        self.fill_and_sort_rows()
+        for r in subscriptions:
+            r[self.is_borrowed_key] = self._loans.has_title(r["id"])
+        self.apply_rows(subscriptions)
 
     def add_loan(self, loan: Dict):
-        self._loans.append(loan)
-        self.fill_and_sort_rows()
+        self._loans.add(loan)
+        self.update_borrowed(loan["id"])
 
     def remove_loan(self, loan: Dict):
         self._loans = self.remove_media(loan["id"], loan["cardId"], self._loans)
-        self.fill_and_sort_rows()
+        self.update_borrowed(loan["id"])
+
+    def update_borrowed(self, title_id: str):
+        """
+        Update the borrowed status of the rows for title_id.
+
+        :param title_id:
+        :return:
+        """
+        is_borrowed = self._loans.has_title(title_id)
+        for position, r in enumerate(self._rows):
+            if r["id"] == title_id and r.get(self.is_borrowed_key) != is_borrowed:
+                r[self.is_borrowed_key] = is_borrowed
+                self.dataChanged.emit(
+                    self.index(position, 0),
+                    self.index(position, self.columnCount() - 1),
+                )
 
-    def fill_and_sort_rows(self):
-        self.beginResetModel()
-        self._rows = sorted(
-            self._rows, key=lambda t: t["estimatedReleaseDate"], reverse=True
-        )
-        for r in self._rows:
-            r[self.is_borrowed_key] = bool(
-                [loan for loan in self._loans if loan["id"] == r["id"]]
-            )
-        self.endResetModel()
+    def row_sort_key(self, subscription: Dict):
+        return subscription["estimatedReleaseDate"]
+
+    def row_filter_text(self, subscription: Dict) -> str:
+        return self._media_filter_text(subscription, include_creator=False)
 
     def data(self, index, role):
         row, col = index.row(), index.column()
@@ -890,10 +1561,9 @@ class LibbyMagazinesModel(LibbyModel):
 
 
 class LibbyMagazinesSortFilterModel(LibbySortFilterModel):
-    def __init__(self, parent, model=None, db=None):
+    def __init__(self, parent, model=None, db=None, match_index=None):
         super().__init__(parent, model, db)
-        self.all_book_ids_titles = self.db.fields["title"].table.book_col_map
-        self.all_book_ids_formats = self.db.fields["formats"].table.book_col_map
+        self.match_index: LibraryMatchIndex = match_index or LibraryMatchIndex(db)
         self.filter_hide_magazines_already_in_library = PREFS[
             PreferenceKeys.HIDE_BOOKS_ALREADY_IN_LIB
         ]
@@ -904,37 +1574,174 @@ class LibbyMagazinesSortFilterModel(LibbySortFilterModel):
             self.invalidateFilter()
 
     def filterAcceptsRow(self, sourceRow, sourceParent):
+        if self.is_narrowed_out(sourceRow):
+            return False
+
+        # test the cheaper filter text first
+        if not self.matches_filter_text(sourceRow):
+            return False
 
-        if not (self.filter_hide_magazines_already_in_library or self.filter_text):
+        if not self.filter_hide_magazines_already_in_library:
             return True
 
         model: LibbyModel = self.sourceModel()
         index = model.index(sourceRow, 0, sourceParent)
         subscription = model.data(index, Qt.UserRole)
 
-        if self.filter_hide_magazines_already_in_library:
-            # hide lib books filter is enabled
-            book_in_library = False
-            q1 = icu_lower(get_media_title(subscription).strip())
-            q2 = icu_lower(get_media_title(subscription, include_subtitle=True).strip())
-            for book_id, title in iter(self.all_book_ids_titles.items()):
-                if icu_lower(title) not in (q1, q2):
-                    continue
-                if (
-                    not PREFS[PreferenceKeys.EXCLUDE_EMPTY_BOOKS]
-                ) or self.all_book_ids_formats.get(book_id):
-                    book_in_library = True
-                break  # check only first matching book title
-            if book_in_library:
-                return False
+        # hide lib books filter is enabled
+        q1 = icu_lower(get_media_title(subscription).strip())
+        q2 = icu_lower(get_media_title(subscription, include_subtitle=True).strip())
+        return not self.match_index.in_library(
+            (q1, q2),
+            exclude_empty_books=PREFS[PreferenceKeys.EXCLUDE_EMPTY_BOOKS],
+        )
 
-        if not self.filter_text:
-            return True
 
-        card = self.sourceModel().get_card(subscription["cardId"])
-        title = icu_lower(get_media_title(subscription))
-        library = icu_lower(card["advantageKey"])
-        return self.filter_text in title or self.filter_text in library
+class LibrarySearchResultsMerger(object):
+    """
+    Merges the search results from multiple libraries, as each library's results
+    arrive, into a single list of titles with the availabilities for each library.
+    """
+
+    # keys in a library search result item that are specific to the library
+    site_availability_keys = frozenset(
+        [
+            "advantageKey",
+            "availabilityType",
+            "availableCopies",
+            "estimatedWaitDays",
+            "formats",
+            "holdsCount",
+            "holdsRatio",
+            "isAdvantageFiltered",
+            "isAvailable",
+            "isOwned",
+            "isRecommendableToLibrary",
+            "isFastlane",
+            "isHoldable",
+            "juvenileEligible",
+            "luckyDayAvailableCopies",
+            "luckyDayOwnedCopies",
+            "ownedCopies",
+            "visitorEligible",
+            "youngAdultEligible",
+        ]
+    )
+
+    def __init__(self):
+        self.library_keys: Set[str] = set()
+        self._titles: Dict[str, Dict] = {}
+        self._format_ids: Dict[str, Set[str]] = {}
+        # order in which the titles were first found, to keep ties stable
+        self._sequence: Dict[str, int] = {}
+
+    def merge(self, library_key: str, items: List[Dict], start_rank: int = 1) -> None:
+        """
+        Merge a library's search results.
+
+        :param library_key:
+        :param items:
+        :param start_rank: Rank of the first item, e.g. for subsequent pages of results
+        :return:
+        """
+        self.library_keys.add(library_key)
+        for item_rank, item in enumerate(items, start=start_rank):
+            site_availability = {
+                k: v for k, v in item.items() if k in self.site_availability_keys
+            }
+            site_availability["advantageKey"] = library_key
+            title_id = item["id"]
+            title = self._titles.get(title_id)
+            if title is None:
+                title = {
+                    k: v
+                    for k, v in item.items()
+                    if k not in self.site_availability_keys
+                }
+                title["siteAvailabilities"] = {}
+                title["__item_ranks"] = []
+                title["formats"] = []
+                self._titles[title_id] = title
+                self._format_ids[title_id] = set()
+                self._sequence[title_id] = len(self._sequence)
+            title["siteAvailabilities"][library_key] = site_availability
+            title["__item_ranks"].append(item_rank)
+            format_ids = self._format_ids[title_id]
+            for f in site_availability.get("formats", []):
+                if f["id"] not in format_ids:
+                    format_ids.add(f["id"])
+                    title["formats"].append(f)
+
+    def results(self) -> List[Dict]:
+        """
+        The merged titles, ordered by their average rank across the libraries.
+
+        :return:
+        """
+        return sorted(
+            self._titles.values(),
+            key=lambda r: (
+                sum(r["__item_ranks"]) / len(r["__item_ranks"]),  # average rank
+                1 / len(r["__item_ranks"]),
+                self._sequence[r["id"]],
+            ),
+        )
+
+
+class SearchResultRow(object):
+    """
+    A compact search result row. Only the title id, library keys and the
+    precomputed display values are kept as objects. The search result itself
+    is kept as a JSON string until it is first requested, and the decoded
+    search result is kept from then on.
+    """
+
+    __slots__ = ("id", "library_keys", "availability_hash", "values", "_raw", "_media")
+
+    def __init__(self, media: Dict, values: Dict):
+        self.id: str = media["id"]
+        self.values = values
+        self._raw = ""
+        self._media: Optional[Dict] = None
+        self.set_media(media)
+
+    @property
+    def media(self) -> Dict:
+        if self._media is None:
+            # so that the same search result is returned, including any changes to it
+            self._media = json.loads(self._raw)
+            self._raw = ""
+        return self._media
+
+    def set_media(self, media: Dict) -> None:
+        self.library_keys: Tuple[str, ...] = tuple(
+            media.get("siteAvailabilities", {}).keys()
+        )
+        self.availability_hash = self.get_availability_hash(media)
+        self._raw = json.dumps(media, separators=(",", ":"))
+        self._media = None
+
+    @staticmethod
+    def get_availability_hash(media: Dict) -> int:
+        """
+        Hash the site availabilities and formats of a search result, which are
+        the parts that change when the same title is returned again.
+
+        :param media:
+        :return:
+        """
+        site_availabilities = {
+            # advantageKey is added when the row is built
+            k: {kk: vv for kk, vv in v.items() if kk != "advantageKey"}
+            for k, v in media.get("siteAvailabilities", {}).items()
+        }
+        return hash(
+            json.dumps(
+                [site_availabilities, media.get("formats", [])],
+                sort_keys=True,
+                separators=(",", ":"),
+            )
+        )
 
 
 class LibbySearchModel(LibbyModel):
@@ -951,13 +1758,22 @@ class LibbySearchModel(LibbyModel):
         _("Library"),
     ]
     filter_hide_magazines_already_in_library = False
+    # max age (in seconds) of the search results availabilities before they are refreshed
+    availability_max_age = 60
+    # emitted when the view needs more rows, i.e. the next page of search results
+    fetch_more_requested = pyqtSignal()
+    # role for the title id, which does not require the search result to be decoded
+    TitleIdRole = Qt.UserRole + 1001
 
     def __init__(self, parent, synced_state=None, db=None):
         super().__init__(parent, synced_state, db)
-        self._search_results: List[Dict] = []
+        self._rows: List[SearchResultRow] = []
+        self.availabilities_updated_at: float = 0
+        self._can_fetch_more = False
+        self._fetching_more = False
+        self._holds = MediaIndex()
+        self._loans = MediaIndex()
         self.sync(synced_state)
-        self._holds = []
-        self._loans = []
 
     def has_loan(self, title_id: str, card_id: str):
         return self.has_media(title_id, card_id, self._loans)
@@ -965,32 +1781,51 @@ class LibbySearchModel(LibbyModel):
     def has_hold(self, title_id: str, card_id: str):
         return self.has_media(title_id, card_id, self._holds)
 
-    def library_keys(self) -> List[str]:
-        return list(set([c["advantageKey"] for c in self._cards]))
-
     def get_cards_for_library_key(self, key):
-        cards = [c for c in self._cards if c["advantageKey"] == key]
+        cards = self._cards_by_advantage_key.get(key, [])
         if not cards:
             # use websiteId
-            website_ids = [
-                str(s["websiteId"]) for s in self._libraries if s["preferredKey"] == key
+            cards = [
+                c
+                for website_id in self._library_website_ids_by_key.get(key, [])
+                for c in self._cards_by_website_id.get(website_id, [])
             ]
-            cards = [c for c in self._cards if c["websiteId"] in website_ids]
         return sorted(cards, key=lambda c: c.get("counts", {}).get("loan", 0))
 
-    def sync(self, synced_state: Optional[Dict] = None):
+    def sync(
+        self, synced_state: Optional[Dict] = None, fetched_at: Optional[float] = None
+    ):
+        """
+        :param synced_state:
+        :param fetched_at: The timer() value when the search results were fetched,
+                           which may be earlier than now if they were cached
+        :return:
+        """
         if not synced_state:
             synced_state = {}
         if "cards" in synced_state and "__libraries" in synced_state:
             super().sync(synced_state)
-            self._holds = synced_state.get("holds", [])
-            self._loans = synced_state.get("loans", [])
+            self._holds = MediaIndex(synced_state.get("holds", []))
+            self._loans = MediaIndex(synced_state.get("loans", []))
 
         if "search_results" not in synced_state:
             return
         self.beginResetModel()
-        self._rows = []
-        for r in synced_state["search_results"]:
+        self._rows = [
+            self._build_row(r)
+            for r in self._valid_search_results(synced_state["search_results"])
+        ]
+        self.availabilities_updated_at = (
+            fetched_at if fetched_at is not None else timer()
+        )
+        self._can_fetch_more = False
+        self._fetching_more = False
+        self.endResetModel()
+
+    @staticmethod
+    def _valid_search_results(search_results: List[Dict]) -> List[Dict]:
+        rows = []
+        for r in search_results:
             try:
                 if is_valid_type(r, include_provisional=True):
                     # Patch missing formats: Sometimes search returns no "formats"
@@ -1010,108 +1845,249 @@ class LibbySearchModel(LibbyModel):
                                 formats.append(site_format)
                         if formats:
                             r["formats"] = formats
-                    self._rows.append(r)
+                    rows.append(r)
             except ValueError:
                 pass
-        self.endResetModel()
+        return rows
+
+    def update_search_results(
+        self, search_results: List[Dict], fetched_at: Optional[float] = None
+    ) -> None:
+        """
+        Update the search results without a model reset so that the selection and
+        scroll position are kept, e.g. when results from more libraries are merged in.
+
+        :param search_results: The complete ordered list of search results, which
+                               should include the existing results
+        :param fetched_at: The timer() value when the new results were fetched
+        :return:
+        """
+        if fetched_at is None:
+            fetched_at = timer()
+        if self._rows:
+            # the availabilities are only as recent as the oldest results
+            fetched_at = min(fetched_at, self.availabilities_updated_at)
+        rows = self._valid_search_results(search_results)
+        row_positions = {r["id"]: i for i, r in enumerate(rows)}
+        if any(r.id not in row_positions for r in self._rows):
+            # existing results have been removed
+            self.sync({"search_results": search_results}, fetched_at=fetched_at)
+            return
+
+        existing_rows = {r.id: r for r in self._rows}
+        new_rows = [self._build_row(r) for r in rows if r["id"] not in existing_rows]
+        if new_rows:
+            start = len(self._rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(new_rows) - 1)
+            self._rows = self._rows + new_rows
+            self.endInsertRows()
+
+        # move the rows into their new positions
+        self.layoutAboutToBeChanged.emit()
+        for index in self.persistentIndexList():
+            self.changePersistentIndex(
+                index,
+                self.index(row_positions[self._rows[index.row()].id], index.column()),
+            )
+        # only rebuild the existing results that have new availabilities or formats
+        rows_by_id = {r.id: r for r in new_rows}
+        for r in rows:
+            row = existing_rows.get(r["id"])
+            if row is not None:
+                rows_by_id[row.id] = (
+                    row
+                    if row.availability_hash == SearchResultRow.get_availability_hash(r)
+                    else self._build_row(r)
+                )
+        self._rows = [rows_by_id[r["id"]] for r in rows]
+        self.availabilities_updated_at = fetched_at
+        self.layoutChanged.emit()
+
+    def set_can_fetch_more(self, can_fetch_more: bool) -> None:
+        """
+        Set if there are more search results to be fetched, e.g. after a page
+        of search results has been loaded.
+
+        :param can_fetch_more:
+        :return:
+        """
+        self._can_fetch_more = can_fetch_more
+        self._fetching_more = False
+
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self._can_fetch_more and not self._fetching_more
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        # the next page is fetched asynchronously, so only request it once
+        self._fetching_more = True
+        self.fetch_more_requested.emit()
+
+    def availabilities_expired(self) -> bool:
+        return timer() - self.availabilities_updated_at > self.availability_max_age
+
+    def get_library_title_ids(self, title_ids: List[str]) -> Dict[str, List[str]]:
+        """
+        Get the ids of the search results available at each library.
+
+        :param title_ids: Only include these titles, e.g. the visible ones
+        :return: Mapping of library key to title ids
+        """
+        title_ids_set = set(title_ids)
+        library_title_ids: Dict[str, List[str]] = {}
+        for r in self._rows:
+            if r.id not in title_ids_set:
+                continue
+            for library_key in r.library_keys:
+                library_title_ids.setdefault(library_key, []).append(r.id)
+        return library_title_ids
+
+    def update_availabilities(self, availabilities: Dict[str, List[Dict]]) -> None:
+        """
+        Patch the site availabilities of the search results in place.
+
+        :param availabilities: Mapping of library key to title availabilities
+        :return:
+        """
+        rows_by_id = {r.id: i for i, r in enumerate(self._rows)}
+        # the decoded search results of the rows being updated
+        updated_rows: Dict[int, Dict] = {}
+        for library_key, items in availabilities.items():
+            for item in items:
+                row = rows_by_id.get(item["id"])
+                if row is None or library_key not in self._rows[row].library_keys:
+                    continue
+                media = updated_rows.get(row) or self._rows[row].media
+                media["siteAvailabilities"][library_key].update(
+                    {k: v for k, v in item.items() if k != "id"}
+                )
+                updated_rows[row] = media
+        for row in sorted(updated_rows.keys()):
+            self._rows[row] = self._build_row(updated_rows[row])
+            self.dataChanged.emit(
+                self.index(row, 0), self.index(row, self.columnCount() - 1)
+            )
+        self.availabilities_updated_at = timer()
+
+    def removeRows(self, row, count, _):
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        self._rows = self._rows[:row] + self._rows[row + count :]
+        self.endRemoveRows()
+        return True
+
+    @classmethod
+    def _build_row(cls, media: Dict) -> SearchResultRow:
+        return SearchResultRow(media, cls._build_row_values(media))
+
+    @staticmethod
+    def _build_row_values(media: Dict) -> Dict:
+        """
+        Precompute the display, tooltip and sort values for a search result
+        because :meth:`data` is called very frequently when scrolling and sorting.
+
+        :param media:
+        :return:
+        """
+        available_sites = []
+        for k, v in media.get("siteAvailabilities", {}).items():
+            v["advantageKey"] = k
+            available_sites.append(v)
+        available_sites = sorted(
+            available_sites,
+            key=cmp_to_key(OverDriveClient.sort_availabilities),
+            reverse=True,
+        )
+        available_sites_keys = ", ".join([s["advantageKey"] for s in available_sites])
+        creator_name = media.get("firstCreatorName", "")
+        publisher_name = media.get("publisher", {}).get("name", "")
+
+        values = {
+            (Qt.ToolTipRole, 0): get_media_title(media, include_subtitle=True),
+            (Qt.ToolTipRole, 1): creator_name,
+            (Qt.ToolTipRole, 3): media.get("publisher", {}).get("name"),
+            (Qt.ToolTipRole, 5): available_sites_keys,
+            (Qt.DisplayRole, 0): get_media_title(media),
+            (LibbyModel.DisplaySortRole, 0): get_media_title(media, for_sorting=True),
+            (Qt.DisplayRole, 1): creator_name
+            if DEMO_MODE
+            else truncate_for_display(creator_name, text_length=20),
+            (LibbyModel.DisplaySortRole, 1): media.get("firstCreatorSortName", "")
+            or creator_name,
+            (Qt.DisplayRole, 3): publisher_name
+            if DEMO_MODE
+            else truncate_for_display(publisher_name, text_length=20),
+            (Qt.DisplayRole, 5): truncate_for_display(
+                available_sites_keys, text_length=15
+            ),
+            (LibbyModel.DisplaySortRole, 5): len(available_sites),
+        }
+        values[(LibbyModel.DisplaySortRole, 3)] = values[(Qt.DisplayRole, 3)]
+
+        publish_date = media.get("publishDate") or media.get("estimatedReleaseDate")
+        dt_value = LibbyClient.parse_datetime(publish_date) if publish_date else None
+        if dt_value:
+            values[(Qt.DisplayRole, 2)] = dt_value.year
+            values[(LibbyModel.DisplaySortRole, 2)] = dt_value.isoformat()
+
+        try:
+            media_format = LibbyClient.get_loan_format(
+                media,
+                PREFS[PreferenceKeys.PREFER_OPEN_FORMATS],
+                raise_if_not_downloadable=False,
+            )
+            values[(Qt.DisplayRole, 4)] = _(
+                LOAN_FORMAT_TRANSLATION.get(media_format, str(media_format))
+            )
+            values[(LibbyModel.DisplaySortRole, 4)] = str(media_format)
+        except ValueError:
+            media_formats = ", ".join(
+                [
+                    _(
+                        LOAN_FORMAT_TRANSLATION.get(
+                            media_format["id"], str(media_format["id"])
+                        )
+                    )
+                    for media_format in media.get("formats", [])
+                ]
+            )
+            values[(Qt.DisplayRole, 4)] = media_formats
+            values[(LibbyModel.DisplaySortRole, 4)] = media_formats
+        return values
 
     def add_hold(self, hold: Dict):
-        self._holds.append(hold)
+        self._holds.add(hold)
+        # the title availability has changed
+        self.availabilities_updated_at = 0
 
     def remove_hold(self, hold: Dict):
         self._holds = self.remove_media(hold["id"], hold["cardId"], self._holds)
+        self.availabilities_updated_at = 0
 
     def add_loan(self, loan: Dict):
-        self._loans.append(loan)
+        self._loans.add(loan)
+        self.availabilities_updated_at = 0
 
     def remove_loan(self, loan: Dict):
         self._loans = self.remove_media(loan["id"], loan["cardId"], self._loans)
+        self.availabilities_updated_at = 0
 
     def data(self, index, role):
         row, col = index.row(), index.column()
         if row >= self.rowCount() or col >= self.columnCount():
             return None
-        media: Dict = self._rows[row]
         # UserRole
         if role == Qt.UserRole:
-            return media
+            return self._rows[row].media
+        if role == LibbySearchModel.TitleIdRole:
+            return self._rows[row].id
         # TextAlignmentRole
         if role == Qt.TextAlignmentRole and col >= 2:
             return Qt.AlignCenter
-        # ToolTipRole
-        available_sites = []
-        for k, v in media.get("siteAvailabilities", {}).items():
-            v["advantageKey"] = k
-            available_sites.append(v)
-        available_sites = sorted(
-            available_sites,
-            key=cmp_to_key(OverDriveClient.sort_availabilities),
-            reverse=True,
-        )
-        if role == Qt.ToolTipRole:
-            if col == 0:
-                return get_media_title(media, include_subtitle=True)
-            if col == 1:
-                return media.get("firstCreatorName", "")
-            if col == 3:
-                return media.get("publisher", {}).get("name")
-            if col == 5:
-                return ", ".join([s["advantageKey"] for s in available_sites])
-        # DisplayRole, DisplaySortRole
-        if role not in (Qt.DisplayRole, LibbyModel.DisplaySortRole):
-            return None
-        if col == 0:
-            if role == LibbyModel.DisplaySortRole:
-                return get_media_title(media, for_sorting=True)
-            return get_media_title(media)
-        if col == 1:
-            creator_name = media.get("firstCreatorName", "")
-            if role == LibbyModel.DisplaySortRole:
-                return media.get("firstCreatorSortName", "") or creator_name
-            if DEMO_MODE:
-                return creator_name
-            return truncate_for_display(creator_name, text_length=20)
-        if col == 2:
-            publish_date = media.get("publishDate") or media.get("estimatedReleaseDate")
-            if publish_date:
-                dt_value = LibbyClient.parse_datetime(publish_date)
-                if role == LibbyModel.DisplaySortRole:
-                    return dt_value.isoformat()
-                return dt_value.year
-        if col == 3:
-            if DEMO_MODE:
-                return media.get("publisher", {}).get("name", "")
-            return truncate_for_display(
-                media.get("publisher", {}).get("name", ""), text_length=20
-            )
-        if col == 4:
-            try:
-                media_format = LibbyClient.get_loan_format(
-                    media,
-                    PREFS[PreferenceKeys.PREFER_OPEN_FORMATS],
-                    raise_if_not_downloadable=False,
-                )
-                if role == LibbyModel.DisplaySortRole:
-                    return str(media_format)
-                return _(LOAN_FORMAT_TRANSLATION.get(media_format, str(media_format)))
-            except ValueError:
-                return ", ".join(
-                    [
-                        _(
-                            LOAN_FORMAT_TRANSLATION.get(
-                                media_format["id"], str(media_format["id"])
-                            )
-                        )
-                        for media_format in media.get("formats", [])
-                    ]
-                )
-        if col == 5:
-            if role == LibbyModel.DisplaySortRole:
-                return len(available_sites)
-            return truncate_for_display(
-                ", ".join([s["advantageKey"] for s in available_sites]), text_length=15
-            )
-        return None
+        # ToolTipRole, DisplayRole, DisplaySortRole
+        return self._rows[row].values.get((role, col))
 
 
 class LibbySearchSortFilterModel(LibbySortFilterModel):
@@ -16,13 +16,14 @@ from http.client import HTTPException
 from io import BytesIO
 from socket import error as SocketError, timeout as SocketTimeout
 from ssl import SSLError
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Union, overload
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode, urljoin
 from urllib.request import Request, build_opener
 
 from .common import pageable
 from .errors import ClientConnectionError
+from .keepalive import ConnectionPool, build_keepalive_handlers
 
 USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_1) AppleWebKit/605.1.15 (KHTML, like Gecko) "  # noqa
@@ -98,6 +99,22 @@ class LibraryMediaSearchParams:
         return result
 
 
+@dataclass
+class ConditionalResponse:
+    """
+    Response for a conditional request, see :meth:`OverDriveClient.send_request`.
+    """
+
+    content: Union[Dict, List, str, None] = None
+    # the response ETag/Last-Modified headers
+    validators: Dict = field(default_factory=dict)
+    not_modified: bool = False
+
+
+# response headers that can be used to validate a cached response
+VALIDATOR_HEADERS = ("ETag", "Last-Modified")
+
+
 class OverDriveClient(object):
     """
     A really simplified OverDrive Thunder API client
@@ -120,7 +137,10 @@ class OverDriveClient(object):
         self.max_retries = max_retries
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
         self.api_base = THUNDER_API_URL
-        self.opener = build_opener()
+        self.connection_pool: ConnectionPool = (
+            kwargs.pop("connection_pool", None) or ConnectionPool()
+        )
+        self.opener = build_opener(*build_keepalive_handlers(self.connection_pool))
 
     def default_headers(self) -> Dict:
         """
@@ -177,6 +197,7 @@ class OverDriveClient(object):
         headers: Optional[Dict] = None,
         is_form: bool = True,
         decode_response: bool = True,
+        validators: Optional[Dict] = None,
     ):
         """
         Calls the private Libby api.
@@ -191,12 +212,20 @@ class OverDriveClient(object):
                         If False, content-type is set to 'application/json'
                         and params are json-encoded in the request body.
         :param decode_response: If False, return raw bytes
+        :param validators: The ETag/Last-Modified headers from a previous response.
+                           If set, a conditional request is made and a
+                           :class:`ConditionalResponse` is returned.
         """
         if not query:
             query = {}
         endpoint_url = urljoin(self.api_base, endpoint)
         if headers is None:
             headers = self.default_headers()
+        if validators:
+            if validators.get("ETag"):
+                headers["If-None-Match"] = validators["ETag"]
+            if validators.get("Last-Modified"):
+                headers["If-Modified-Since"] = validators["Last-Modified"]
         if query:
             endpoint_url += ("?" if "?" not in endpoint else "&") + urlencode(
                 query, doseq=True
@@ -243,6 +272,11 @@ class OverDriveClient(object):
                     "RES HEADERS: \n%s",
                     "\n".join(["{}: {}".format(k, v) for k, v in e.info().items()]),
                 )
+                if validators is not None and e.code == 304:
+                    return ConditionalResponse(
+                        validators=self.extract_validators(e.headers) or validators,
+                        not_modified=True,
+                    )
                 if (
                     attempt < self.max_retries and e.code >= 500
                 ):  # retry for server 5XX errors
@@ -286,13 +320,28 @@ class OverDriveClient(object):
 
             response_content = self._read_response(response)
             if not response_content.strip():
-                return {}
-
-            if response.headers["content-type"].startswith("application/json"):
+                res_obj = {}
+            elif response.headers["content-type"].startswith("application/json"):
                 res_obj = json.loads(response_content)
-                return res_obj
+            else:
+                res_obj = response_content
+
+            if validators is not None:
+                return ConditionalResponse(
+                    content=res_obj,
+                    validators=self.extract_validators(response.headers),
+                )
+            return res_obj
 
-            return response_content
+    @staticmethod
+    def extract_validators(headers) -> Dict:
+        """
+        Extract the headers that can be used for a conditional request.
+
+        :param headers:
+        :return:
+        """
+        return {h: headers[h] for h in VALIDATOR_HEADERS if headers.get(h)}
 
     @staticmethod
     def library_title_permalink(library_key: str, title_id: str) -> str:
@@ -407,38 +456,70 @@ class OverDriveClient(object):
     def extract_type(media) -> str:
         return media.get("type", {}).get("id")
 
-    def media(self, title_id: str, **kwargs) -> Dict:
+    @overload
+    def media(self, title_id: str, validators: Dict, **kwargs) -> ConditionalResponse:
+        ...
+
+    @overload
+    def media(self, title_id: str, validators: None = None, **kwargs) -> Dict:
+        ...
+
+    def media(
+        self, title_id: str, validators: Optional[Dict] = None, **kwargs
+    ) -> Union[Dict, ConditionalResponse]:
         """
         Retrieve a title.
         Title id can also be a reserve id.
 
         :param title_id: A unique id that identifies the content.
+        :param validators: If set, make a conditional request, see :meth:`send_request`
         :return:
         """
         params = self.default_query()
         params.update(kwargs)
-        return self.send_request(f"media/{title_id}", query=params)
+        return self.send_request(
+            f"media/{title_id}", query=params, validators=validators
+        )
+
+    @overload
+    def media_bulk(
+        self, title_ids: List[str], validators: Dict, **kwargs
+    ) -> ConditionalResponse:
+        ...
+
+    @overload
+    def media_bulk(
+        self, title_ids: List[str], validators: None = None, **kwargs
+    ) -> List[Dict]:
+        ...
 
-    def media_bulk(self, title_ids: List[str], **kwargs) -> List[Dict]:
+    def media_bulk(
+        self, title_ids: List[str], validators: Optional[Dict] = None, **kwargs
+    ) -> Union[List[Dict], ConditionalResponse]:
         """
         Retrieve a list of titles.
 
         :param title_ids: The ids passed in this request can be titleIds or reserveIds.
+        :param validators: If set, make a conditional request, see :meth:`send_request`
         :return:
         """
         params = self.default_query()
         params.update({"titleIds": ",".join(title_ids)})
         params.update(kwargs)
-        return self.send_request("media/bulk", query=params)
+        return self.send_request("media/bulk", query=params, validators=validators)
 
     @pageable
     def libraries(
-        self, website_ids: Optional[List[Union[int, str]]] = None, **kwargs
-    ) -> Dict:
+        self,
+        website_ids: Optional[List[Union[int, str]]] = None,
+        validators: Optional[Dict] = None,
+        **kwargs,
+    ) -> Union[Dict, ConditionalResponse]:
         """
         Get a list of libraries.
 
         :param website_ids: Comma-separated list of website IDs to get the information for. Max 24 items.
+        :param validators: If set, make a conditional request, see :meth:`send_request`
         :param kwargs:
             - websiteId: A unique id that identifies the library
             - libraryKeys: Comma-separated list of library keys to get the information for.
@@ -452,7 +533,7 @@ class OverDriveClient(object):
                 [str(website_id) for website_id in website_ids]
             )
         params.update(kwargs)
-        return self.send_request("libraries/", query=params)
+        return self.send_request("libraries/", query=params, validators=validators)
 
     def library_media(self, library_key: str, title_id: str, **kwargs) -> Dict:
         """
@@ -0,0 +1,246 @@
+#
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of the OverDrive Libby Plugin by ping
+# OverDrive Libby Plugin for calibre / libby-calibre-plugin
+#
+# See https://github.com/ping/libby-calibre-plugin for more
+# information
+#
+
+import threading
+import time
+from collections import deque
+from http.client import HTTPResponse, RemoteDisconnected
+from typing import Deque, Dict, Optional, Tuple
+from urllib import request
+from urllib.error import URLError
+
+# errors raised when a pooled connection has been silently dropped by the server
+_STALE_CONNECTION_ERRORS = (
+    RemoteDisconnected,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+# requests that can be safely resent if the server has dropped the connection
+# after the request was sent, because they do not change anything on the server
+_RETRYABLE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of idle persistent HTTP/1.1 connections, keyed by host.
+
+    Connections are checked out for the duration of a request and only returned
+    to the pool once the response body has been fully read.
+    """
+
+    def __init__(self, max_per_host: int = 4, idle_timeout: float = 60.0) -> None:
+        """
+
+        :param max_per_host: Maximum number of idle connections kept for each host
+        :param idle_timeout: Idle connections older than this (in seconds) are discarded
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[Tuple, Deque] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple):
+        """
+        Check out an idle connection for key, discarding expired connections.
+
+        :param key:
+        :return:
+        """
+        expired = []
+        conn = None
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                candidate, idle_since = idle.pop()
+                if now - idle_since > self.idle_timeout or not candidate.sock:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+        for c in expired:
+            c.close()
+        return conn
+
+    def put(self, key: Tuple, conn) -> None:
+        """
+        Return a connection to the pool. The connection is closed instead
+        if the pool for the host is full.
+
+        :param key:
+        :param conn:
+        :return:
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def count(self, key: Optional[Tuple] = None) -> int:
+        """
+        Number of idle connections in the pool.
+
+        :param key: If specified, only count the connections for the key
+        :return:
+        """
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key, []))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def clear(self) -> None:
+        """
+        Close and discard all idle connections.
+
+        :return:
+        """
+        with self._lock:
+            idle_conns = [c for idle in self._idle.values() for c, _ in idle]
+            self._idle.clear()
+        for conn in idle_conns:
+            conn.close()
+
+
+class PooledHTTPResponse(HTTPResponse):
+    """
+    Releases the underlying connection back to the pool when the
+    response body has been completely read.
+    """
+
+    _pool_release = None
+    _pool_discard = False
+
+    def close(self):
+        if self.fp is not None:
+            # closed before the body was consumed, connection cannot be reused
+            self._pool_discard = True
+        super().close()
+
+    def _close_conn(self):
+        super()._close_conn()
+        release = self._pool_release
+        if release:
+            self._pool_release = None
+            release(not (self._pool_discard or self.will_close))
+
+
+class KeepAliveHandlerMixin(object):
+    """
+    Replaces the one connection per request behaviour of
+    :class:`urllib.request.AbstractHTTPHandler` with pooled persistent connections.
+    """
+
+    def __init__(self, *args, pool: Optional[ConnectionPool] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool or ConnectionPool()
+
+    def _release(self, key: Tuple, conn, reusable: bool) -> None:
+        if reusable and conn.sock:
+            self.pool.put(key, conn)
+        else:
+            conn.close()
+
+    def _send_request(self, conn, req, headers: Dict) -> None:
+        conn.request(
+            req.get_method(),
+            req.selector,
+            req.data,
+            headers,
+            encode_chunked=req.has_header("Transfer-encoding"),
+        )
+
+    def _start_request(self, conn, req, headers: Dict):
+        self._send_request(conn, req, headers)
+        return conn.getresponse()
+
+    def do_open(self, http_class, req, **http_conn_args):
+        if req._tunnel_host:
+            # proxy tunnels are not pooled
+            return super().do_open(http_class, req, **http_conn_args)
+
+        host = req.host
+        if not host:
+            raise URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+
+        key = (http_class.__name__, host)
+        conn = self.pool.get(key)
+        response = None
+        if conn:
+            conn.timeout = req.timeout
+            conn.sock.settimeout(req.timeout)
+            is_sent = False
+            try:
+                self._send_request(conn, req, headers)
+                is_sent = True
+                response = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS as err:
+                conn.close()
+                if is_sent and req.get_method() not in _RETRYABLE_METHODS:
+                    # the server may have already acted on the request
+                    raise URLError(err)
+                # server has closed the idle connection, retry with a new one
+                response = None
+            except OSError as err:
+                conn.close()
+                raise URLError(err)
+            except:  # noqa
+                conn.close()
+                raise
+
+        if response is None:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            conn.response_class = PooledHTTPResponse
+            try:
+                try:
+                    response = self._start_request(conn, req, headers)
+                except OSError as err:  # timeout error
+                    raise URLError(err)
+            except:  # noqa
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            response._pool_release = lambda reusable: self._release(key, conn, reusable)
+            if response.length == 0:
+                # no body to read, e.g. HEAD, 204, 304, so release immediately
+                response._close_conn()
+
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, request.HTTPHandler):
+    pass
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, request.HTTPSHandler):
+    pass
+
+
+def build_keepalive_handlers(pool: ConnectionPool):
+    """
+    Handlers to be used with :func:`urllib.request.build_opener`, sharing the same pool.
+
+    :param pool:
+    :return:
+    """
+    return [KeepAliveHTTPHandler(pool=pool), KeepAliveHTTPSHandler(pool=pool)]
@@ -7,6 +7,7 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
+import copy
 import json
 import logging
 import math
@@ -14,6 +15,7 @@ import os
 import platform
 import random
 import re
+import sqlite3
 import time
 import unicodedata
 from collections import OrderedDict, namedtuple
@@ -21,7 +23,7 @@ from datetime import datetime, timedelta, timezone
 from enum import Enum
 from pathlib import Path
 from threading import Lock
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from calibre.constants import DEBUG as CALIBRE_DEBUG
 from calibre.gui2 import is_dark_theme
@@ -201,6 +203,329 @@ class SimpleCache:
             return self.cache.items()
 
 
+class ExpiringCache:
+    """
+    A small in-memory LRU cache where items expire after a number of seconds.
+    Values are copied in and out so that cached items are not modified by callers.
+    """
+
+    def __init__(self, capacity: int = 50, ttl: float = 300):
+        """
+
+        :param capacity: Max number of items kept
+        :param ttl: Number of seconds before an item expires
+        """
+        self.cache: OrderedDict = OrderedDict()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        item = self.get_with_age(key)
+        return item[0] if item else None
+
+    def get_with_age(self, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        Get an item with the number of seconds since it was cached.
+
+        :param key:
+        :return: tuple of (value, age), or None if not found
+        """
+        with self.lock:
+            item = self.cache.get(key)
+            age = time.monotonic() - item[0] if item is not None else 0
+            if item is None or age > self.ttl:
+                if item is not None:
+                    del self.cache[key]
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item[1]), age
+
+    def put(self, key: str, value) -> None:
+        with self.lock:
+            self.cache[key] = (time.monotonic(), copy.deepcopy(value))
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.cache.clear()
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.cache)
+
+
+class SqliteCache:
+    """
+    A SimpleCache-compatible cache backed by a sqlite database, with one row per key.
+
+    Items are only read from disk when requested and then kept in a small
+    in-memory LRU. Each write is committed immediately, and expired or excess
+    rows are evicted in SQL by :meth:`save` instead of re-serialising the
+    whole cache.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 5000,
+        persist_to_path: Optional[Path] = None,
+        cache_age_days: int = 3,
+        logger: Optional[logging.Logger] = None,
+        memory_capacity: int = 100,
+        import_from_path: Optional[Path] = None,
+        stale_age_days: int = 0,
+    ):
+        """
+
+        :param capacity: Max number of items kept on disk
+        :param persist_to_path: Path to the sqlite database. If not set, an in-memory database is used.
+        :param cache_age_days:
+        :param logger:
+        :param memory_capacity: Max number of items kept in memory
+        :param import_from_path: Path to a SimpleCache json file to be imported (and removed)
+        :param stale_age_days: Number of days that expired items are kept for, so that
+                               they can be revalidated with :meth:`get_stale` and :meth:`renew`
+        """
+        self.cache: OrderedDict = OrderedDict()
+        self.capacity = capacity
+        self.memory_capacity = memory_capacity
+        self.lock = Lock()
+        self.persist_to_path = persist_to_path
+        self.import_from_path = import_from_path
+        self.cache_age_days = cache_age_days
+        self.stale_age_days = stale_age_days
+        if not logger:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+        self.cache_timestamp_key = "__cached_at"
+        # connection is only opened when first needed
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._conn:
+            return self._conn
+        self._conn = sqlite3.connect(
+            str(self.persist_to_path) if self.persist_to_path else ":memory:",
+            check_same_thread=False,
+        )
+        # each write is committed, so use WAL to keep commits cheap and
+        # to not block readers on other connections
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, cached_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_cached_at_idx ON cache (cached_at)"
+        )
+        self._import_from_file()
+        self._evict()
+        self._conn.commit()
+        return self._conn
+
+    def _import_from_file(self):
+        if not (self.import_from_path and self.import_from_path.exists()):
+            return
+        try:
+            with self.import_from_path.open("r", encoding="utf-8") as fp:
+                rows = [
+                    (k, json.dumps(v), v[self.cache_timestamp_key])
+                    for k, v in json.load(fp).items()
+                    if v.get(self.cache_timestamp_key)
+                ]
+            self._conn.executemany(  # type: ignore[union-attr]
+                "INSERT OR REPLACE INTO cache (key, value, cached_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.logger.debug(
+                "Imported %d items from file cache %s", len(rows), self.import_from_path
+            )
+            self.import_from_path.unlink()
+        except Exception as err:  # noqa
+            self.logger.warning(
+                "Unable to import file cache %s: %s", self.import_from_path, err
+            )
+
+    def _expiry_timestamp(self) -> float:
+        return time.time() - timedelta(days=self.cache_age_days).total_seconds()
+
+    def _retention_timestamp(self) -> float:
+        return (
+            self._expiry_timestamp()
+            - timedelta(days=self.stale_age_days).total_seconds()
+        )
+
+    def _evict(self):
+        conn = self._get_connection()
+        conn.execute(
+            "DELETE FROM cache WHERE cached_at < ?", (self._retention_timestamp(),)
+        )
+        conn.execute(
+            "DELETE FROM cache WHERE key NOT IN "
+            "(SELECT key FROM cache ORDER BY cached_at DESC LIMIT ?)",
+            (self.capacity,),
+        )
+
+    def _to_row(self, key: str, value: Dict) -> Tuple[str, str, float]:
+        # exclude bytes
+        serialisable = {k: v for k, v in value.items() if not isinstance(v, bytes)}
+        return key, json.dumps(serialisable), value[self.cache_timestamp_key]
+
+    def _remember(self, key: str, value: Dict):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.memory_capacity:
+            self.cache.popitem(last=False)
+
+    def reload(self):
+        with self.lock:
+            self.cache.clear()
+            self._evict()
+            self._get_connection().commit()
+
+    def save(self):
+        with self.lock:
+            self._evict()
+            self._get_connection().commit()
+            self.logger.debug(
+                "Saved file cache at %s", self.persist_to_path or ":memory:"
+            )
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            with self._get_connection() as conn:
+                conn.execute("DELETE FROM cache")
+
+    def get(self, key: str) -> Optional[Dict]:
+        if not self.cache_age_days:
+            return None
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                if value[self.cache_timestamp_key] < self._expiry_timestamp():
+                    del self.cache[key]
+                    return None
+                self.cache.move_to_end(key)
+                return value
+            row = (
+                self._get_connection()
+                .execute(
+                    "SELECT value, cached_at FROM cache WHERE key = ? AND cached_at >= ?",
+                    (key, self._expiry_timestamp()),
+                )
+                .fetchone()
+            )
+            if not row:
+                return None
+            value = json.loads(row[0])
+            value[self.cache_timestamp_key] = row[1]
+            self._remember(key, value)
+            return value
+
+    def _get_stale(self, key: str) -> Optional[Dict]:
+        value = self.cache.get(key)
+        if value is not None:
+            if value[self.cache_timestamp_key] < self._retention_timestamp():
+                del self.cache[key]
+                return None
+            return value
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT value, cached_at FROM cache WHERE key = ? AND cached_at >= ?",
+                (key, self._retention_timestamp()),
+            )
+            .fetchone()
+        )
+        if not row:
+            return None
+        value = json.loads(row[0])
+        value[self.cache_timestamp_key] = row[1]
+        return value
+
+    def get_stale(self, key: str) -> Optional[Dict]:
+        """
+        Get an item, even if it has expired, as long as it is still retained.
+
+        :param key:
+        :return:
+        """
+        if not self.cache_age_days:
+            return None
+        with self.lock:
+            return self._get_stale(key)
+
+    def renew(self, key: str) -> Optional[Dict]:
+        """
+        Reset the cached timestamp of a (possibly expired) item, e.g. after it has
+        been revalidated with the server.
+
+        :param key:
+        :return: The renewed item, or None if it is no longer retained
+        """
+        if not self.cache_age_days:
+            return None
+        with self.lock:
+            value = self._get_stale(key)
+            if value is None:
+                return None
+            value[self.cache_timestamp_key] = time.time()
+            self._remember(key, value)
+            with self._get_connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, cached_at) VALUES (?, ?, ?)",
+                    self._to_row(key, value),
+                )
+            return value
+
+    def put(self, key: str, value: Dict) -> None:
+        if not self.cache_age_days:
+            return
+        with self.lock:
+            if not value.get(self.cache_timestamp_key):
+                value[self.cache_timestamp_key] = time.time()
+            self._remember(key, value)
+            with self._get_connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, cached_at) VALUES (?, ?, ?)",
+                    self._to_row(key, value),
+                )
+
+    def count(self) -> int:
+        with self.lock:
+            return (
+                self._get_connection()
+                .execute(
+                    "SELECT COUNT(*) FROM cache WHERE cached_at >= ?",
+                    (self._expiry_timestamp(),),
+                )
+                .fetchone()[0]
+            )
+
+    def items(self) -> List[Tuple[str, Dict]]:
+        with self.lock:
+            results = []
+            for key, value, cached_at in self._get_connection().execute(
+                "SELECT key, value, cached_at FROM cache WHERE cached_at >= ? ORDER BY cached_at",
+                (self._expiry_timestamp(),),
+            ):
+                if key in self.cache:
+                    results.append((key, self.cache[key]))
+                    continue
+                value = json.loads(value)
+                value[self.cache_timestamp_key] = cached_at
+                results.append((key, value))
+            return results
+
+
 def obfuscate_date(dt: datetime, day=None, month=None, year=None):
     if not dt:
         return dt
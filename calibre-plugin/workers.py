@@ -8,9 +8,14 @@
 # information
 #
 
+import json
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 from timeit import default_timer as timer
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from calibre import browser
 from qt.core import QObject, pyqtSignal
@@ -18,8 +23,25 @@ from qt.core import QObject, pyqtSignal
 from . import logger
 from .config import PREFS, PreferenceKeys
 from .libby import LibbyClient, LibbyFormats
-from .overdrive import OverDriveClient, LibraryMediaSearchParams
-from .utils import SimpleCache
+from .overdrive import ConditionalResponse, OverDriveClient, LibraryMediaSearchParams
+from .utils import ExpiringCache, SqliteCache
+
+
+def search_cache_key(*args) -> str:
+    """
+    Helper method to generate a search results cache key.
+
+    :param args: Search parameters
+    :return:
+    """
+    return json.dumps(args, sort_keys=True, separators=(",", ":"))
+
+
+def log_search_cache_stats(cache: Optional[ExpiringCache]) -> None:
+    if cache:
+        logger.debug(
+            "Search results cache: %d hits, %d misses", cache.hits, cache.misses
+        )
 
 
 class OverDriveMediaSearchWorker(QObject):
@@ -27,7 +49,8 @@ class OverDriveMediaSearchWorker(QObject):
     Search media
     """
 
-    finished = pyqtSignal(list)
+    # results, and the timer() value when the results were fetched
+    finished = pyqtSignal(list, float)
     errored = pyqtSignal(Exception)
 
     def setup(
@@ -37,24 +60,42 @@ class OverDriveMediaSearchWorker(QObject):
         library_keys: List[str],
         formats: List[LibbyFormats],
         max_items: int = 20,
+        cache: Optional[ExpiringCache] = None,
     ):
         self.client = overdrive_client
         self.query = query
         self.library_keys = library_keys
         self.formats = formats
         self.max_items = max_items
+        self.cache = cache
 
     def run(self):
         total_start = timer()
         try:
-            results = self.client.media_search(
-                self.library_keys,
-                self.query,
-                maxItems=self.max_items,
-                format=self.formats,
+            cache_key = search_cache_key(
+                "media_search",
+                sorted(self.library_keys),
+                " ".join(self.query.lower().split()),
+                sorted(self.formats),
+                self.max_items,
             )
+            cached = self.cache.get_with_age(cache_key) if self.cache else None
+            if cached:
+                results, age = cached
+                fetched_at = timer() - age
+            else:
+                fetched_at = timer()
+                results = self.client.media_search(
+                    self.library_keys,
+                    self.query,
+                    maxItems=self.max_items,
+                    format=self.formats,
+                )
+                if self.cache:
+                    self.cache.put(cache_key, results)
+            log_search_cache_stats(self.cache)
             logger.info("OverDrive Media Search took %f seconds", timer() - total_start)
-            self.finished.emit(results)
+            self.finished.emit(results, fetched_at)
         except Exception as err:
             logger.info(
                 "OverDrive Media Search failed after %f seconds",
@@ -68,7 +109,8 @@ class OverDriveLibraryMediaSearchWorker(QObject):
     Search library media
     """
 
-    finished = pyqtSignal(str, dict)
+    # library key, results, and the timer() value when the results were fetched
+    finished = pyqtSignal(str, dict, float)
     errored = pyqtSignal(str, Exception)
 
     def setup(
@@ -76,21 +118,45 @@ class OverDriveLibraryMediaSearchWorker(QObject):
         overdrive_client: OverDriveClient,
         library_key: str,
         query: LibraryMediaSearchParams,
+        cache: Optional[ExpiringCache] = None,
     ):
         self.client = overdrive_client
         self.library_key = library_key
         self.query = query
+        self.cache = cache
+        self.queued_at = timer()
 
     def run(self):
         total_start = timer()
+        logger.debug(
+            "OverDrive Library Media Search (%s) waited %f seconds to start",
+            self.library_key,
+            total_start - self.queued_at,
+        )
         try:
-            results = self.client.library_medias(self.library_key, self.query)
+            query_params = self.query.to_dict()
+            for k in ("query", "title", "creator", "identifier"):
+                if k in query_params:
+                    query_params[k] = " ".join(query_params[k].lower().split())
+            cache_key = search_cache_key(
+                "library_medias", self.library_key, query_params
+            )
+            cached = self.cache.get_with_age(cache_key) if self.cache else None
+            if cached:
+                results, age = cached
+                fetched_at = timer() - age
+            else:
+                fetched_at = timer()
+                results = self.client.library_medias(self.library_key, self.query)
+                if self.cache:
+                    self.cache.put(cache_key, results)
+            log_search_cache_stats(self.cache)
             logger.info(
                 "OverDrive Library Media Search (%s) took %f seconds",
                 self.library_key,
                 timer() - total_start,
             )
-            self.finished.emit(self.library_key, results)
+            self.finished.emit(self.library_key, results, fetched_at)
         except Exception as err:
             logger.info(
                 "OverDrive Library Media Search (%s) failed after %f seconds",
@@ -100,6 +166,58 @@ class OverDriveLibraryMediaSearchWorker(QObject):
             self.errored.emit(self.library_key, err)
 
 
+class OverDriveMediaAvailabilityWorker(QObject):
+    """
+    Refreshes the availability of titles across libraries (for Search tabs)
+    """
+
+    finished = pyqtSignal(dict)
+    errored = pyqtSignal(Exception)
+
+    # max number of concurrent OverDrive requests
+    max_workers = 4
+
+    def setup(
+        self, overdrive_client: OverDriveClient, library_title_ids: Dict[str, List[str]]
+    ):
+        self.client = overdrive_client
+        self.library_title_ids = library_title_ids
+
+    def run(self):
+        total_start = timer()
+        try:
+            availabilities: Dict[str, List[Dict]] = {}
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {
+                    library_key: executor.submit(
+                        self.client.library_media_availability_bulk,
+                        library_key,
+                        title_ids,
+                    )
+                    for library_key, title_ids in self.library_title_ids.items()
+                }
+                for library_key, future in futures.items():
+                    try:
+                        res = future.result()
+                    except Exception as err:
+                        logger.warning(
+                            "Error refreshing availability (%s): %s", library_key, err
+                        )
+                        continue
+                    # unknown titles are returned as null items
+                    availabilities[library_key] = [i for i in res.get("items", []) if i]
+            logger.info(
+                "OverDrive Availability Refresh took %f seconds", timer() - total_start
+            )
+            self.finished.emit(availabilities)
+        except Exception as err:
+            logger.info(
+                "OverDrive Availability Refresh failed after %f seconds",
+                timer() - total_start,
+            )
+            self.errored.emit(err)
+
+
 class OverDriveMediaWorker(QObject):
     """
     Fetches a media detail (for preview)
@@ -110,7 +228,7 @@ class OverDriveMediaWorker(QObject):
     cover_data_key = "_cover_data"
 
     def setup(
-        self, overdrive_client: OverDriveClient, title_id: str, media_cache: SimpleCache
+        self, overdrive_client: OverDriveClient, title_id: str, media_cache: SqliteCache
     ):
         self.client = overdrive_client
         self.title_id = title_id
@@ -119,8 +237,15 @@ class OverDriveMediaWorker(QObject):
     def run(self):
         total_start = timer()
         try:
-            media = self.media_cache.get(self.title_id) or self.client.media(
-                self.title_id
+            media = (
+                self.media_cache.get(self.title_id)
+                or fetch_revalidated_items(
+                    [self.title_id],
+                    self.media_cache,
+                    partial(self.client.media, self.title_id),
+                    lambda content: [content],
+                    lambda _: self.title_id,
+                )[0]
             )
             if not media.get(self.cover_data_key):
                 try:
@@ -324,7 +449,7 @@ class LibbyFulfillLoanWorker(QObject):
 
 
 def extract_cached_items(
-    object_ids: List[str], cache: SimpleCache
+    object_ids: List[str], cache: SqliteCache
 ) -> Tuple[List[str], List[Dict]]:
     """
     Helper method to extract uncached IDs and cached objects
@@ -346,6 +471,94 @@ def extract_cached_items(
     return uncached_object_ids, cached_objects
 
 
+# key for the ETag/Last-Modified validators stored with a cached object
+CACHE_VALIDATORS_KEY = "__validators"
+
+
+def get_stale_validators(object_ids: List[str], cache: SqliteCache) -> Optional[Dict]:
+    """
+    Get the validators of the expired cached objects, if they were all
+    cached from the same response.
+
+    :param object_ids:
+    :param cache:
+    :return: None if any of the objects cannot be revalidated together
+    """
+    validators = None
+    for object_id in object_ids:
+        stale_obj = cache.get_stale(object_id)
+        if not (stale_obj and stale_obj.get(CACHE_VALIDATORS_KEY)):
+            return None
+        if validators is not None and stale_obj[CACHE_VALIDATORS_KEY] != validators:
+            return None
+        validators = stale_obj[CACHE_VALIDATORS_KEY]
+    return validators
+
+
+def fetch_revalidated_items(
+    object_ids: List[str],
+    cache: SqliteCache,
+    fetch: Callable[..., ConditionalResponse],
+    extract_items: Callable[[Union[Dict, List]], List[Dict]],
+    extract_id: Callable[[Dict], str],
+) -> List[Dict]:
+    """
+    Helper method to fetch and cache uncached objects. If the objects have expired
+    cache entries from the same previous response, a conditional request is made
+    and the entries are renewed if they have not been modified.
+
+    :param object_ids:
+    :param cache:
+    :param fetch: Makes the request, called with the validators keyword argument
+    :param extract_items: Extracts the objects from the response content
+    :param extract_id: Extracts the cache key for an object
+    :return:
+    """
+    res = fetch(validators=get_stale_validators(object_ids, cache) or {})
+    if res.not_modified:
+        renewed = [cache.renew(object_id) for object_id in object_ids]
+        if all(renewed):
+            logger.debug("Revalidated %d cached items", len(renewed))
+            return renewed  # type: ignore[return-value]
+        res = fetch(validators={})
+    if not isinstance(res.content, (dict, list)):
+        raise ValueError("Unexpected response: %r" % res.content)
+    items = extract_items(res.content)
+    for item in items:
+        item[CACHE_VALIDATORS_KEY] = res.validators
+        cache.put(extract_id(item), item)
+    return items
+
+
+def _timed(fn, *args, **kwargs) -> Tuple:
+    """
+    Helper method to call a function from an executor and
+    also return the time at which it completed.
+
+    :param fn:
+    :return: tuple of the function result and the completion time
+    """
+    result = fn(*args, **kwargs)
+    return result, timer()
+
+
+def set_subscription_card_ids(titles: List[Dict], subscriptions: List[Dict]):
+    """
+    Set the card id for each latest magazine issue from the magazine subscriptions.
+
+    :param titles:
+    :param subscriptions:
+    :return:
+    """
+    subscription_card_ids: Dict[str, str] = {}
+    for s in subscriptions:
+        # first matching subscription is used
+        subscription_card_ids.setdefault(s["parent_magazine_id"], s["card_id"])
+    for t in titles:
+        t["cardId"] = subscription_card_ids.get(t["parentMagazineTitleId"])
+    return titles
+
+
 class SyncDataWorker(QObject):
     """
     Main sync worker
@@ -357,9 +570,139 @@ class SyncDataWorker(QObject):
     def __int__(self):
         super().__init__()
 
-    def setup(self, libraries_cache: SimpleCache, media_cache: SimpleCache):
+    # max number of concurrent OverDrive requests
+    max_workers = 4
+    # number of seconds before a magazine subscription is checked again for a new issue
+    latest_issue_check_interval = 6 * 60 * 60
+
+    def setup(
+        self,
+        libraries_cache: SqliteCache,
+        media_cache: SqliteCache,
+        synced_state_path: Optional[Path] = None,
+        magazines_cache: Optional[SqliteCache] = None,
+    ):
+        """
+
+        :param libraries_cache:
+        :param media_cache:
+        :param synced_state_path:
+        :param magazines_cache: Index of parent magazine ID to the latest issue ID
+        :return:
+        """
         self.libraries_cache = libraries_cache
         self.media_cache = media_cache
+        self.synced_state_path = synced_state_path
+        self.magazines_cache = magazines_cache
+
+    def _save_synced_state(self, synced_state: Dict):
+        """
+        Persist the synced state so that it can be displayed immediately
+        the next time the plugin is opened.
+
+        :param synced_state:
+        :return:
+        """
+        if not self.synced_state_path:
+            return
+        start = timer()
+        try:
+            # don't need to persist the auth token
+            state = {k: v for k, v in synced_state.items() if k != "identity"}
+            temp_path = self.synced_state_path.with_name(
+                self.synced_state_path.name + ".tmp"
+            )
+            with temp_path.open("w", encoding="utf-8") as f:
+                # bytes, e.g. cover data, are not saved
+                json.dump(state, f, default=lambda o: None)
+            temp_path.replace(self.synced_state_path)
+            logger.debug("Saving synced state took %f seconds", timer() - start)
+        except Exception as err:  # noqa
+            logger.warning("Unable to save synced state: %s", err)
+
+    def _get_checked_latest_issue_ids(
+        self, parent_magazine_ids: List[str]
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Get the latest issue IDs from the index for the parent magazine IDs that
+        have been checked recently.
+
+        :param parent_magazine_ids:
+        :return: tuple of the parent magazine IDs to be checked, and the latest issue IDs
+        """
+        if not self.magazines_cache:
+            return parent_magazine_ids, []
+        checked_since = time.time() - self.latest_issue_check_interval
+        unchecked_parent_magazine_ids: List[str] = []
+        latest_magazine_ids: List[str] = []
+        for parent_magazine_id in parent_magazine_ids:
+            indexed = self.magazines_cache.get(parent_magazine_id)
+            if (
+                indexed
+                and indexed[self.magazines_cache.cache_timestamp_key] >= checked_since
+            ):
+                latest_magazine_ids.append(indexed["latest_issue_id"])
+            else:
+                unchecked_parent_magazine_ids.append(parent_magazine_id)
+        return unchecked_parent_magazine_ids, latest_magazine_ids
+
+    def _fetch_latest_magazines(
+        self, od_client: OverDriveClient, parent_magazine_ids: List[str]
+    ) -> List[Dict]:
+        """
+        Get the latest issues for a page of parent magazine IDs.
+
+        :param od_client:
+        :param parent_magazine_ids:
+        :return:
+        """
+        (
+            unchecked_parent_magazine_ids,
+            latest_magazine_ids,
+        ) = self._get_checked_latest_issue_ids(parent_magazine_ids)
+        logger.debug(
+            "Checking %d magazines for new issues", len(unchecked_parent_magazine_ids)
+        )
+        checked_magazine_ids: List[str] = []
+        if unchecked_parent_magazine_ids:
+            parent_magazines = od_client.media_bulk(
+                title_ids=unchecked_parent_magazine_ids
+            )
+            # we re-query with the new title IDs because querying with the parent magazine ID
+            # returns an old estimatedReleaseDate, so if we want to sort by estimatedReleaseDate
+            # we need to re-query
+            checked_magazine_ids = [
+                # sometimes t["id"] is not the latest issue (due to misconfig?)
+                # so use t["recentIssues"] instead
+                t["recentIssues"][0]["id"] if t.get("recentIssues") else t["id"]
+                for t in parent_magazines
+            ]
+            latest_magazine_ids.extend(checked_magazine_ids)
+        uncached_latest_magazine_ids, titles = extract_cached_items(
+            latest_magazine_ids, self.media_cache
+        )
+        logger.debug("Reusing %d cached media", len(titles))
+        logger.debug("Fetching %d new media", len(uncached_latest_magazine_ids))
+        if uncached_latest_magazine_ids:
+            found = fetch_revalidated_items(
+                uncached_latest_magazine_ids,
+                self.media_cache,
+                lambda validators: od_client.media_bulk(
+                    uncached_latest_magazine_ids, validators=validators
+                ),
+                lambda content: content if isinstance(content, list) else [],
+                lambda m: m["id"],
+            )
+            titles.extend(found)
+        if self.magazines_cache and checked_magazine_ids:
+            # index the latest issues found so that they are not checked again until stale
+            checked = set(checked_magazine_ids)
+            for t in titles:
+                if t["id"] in checked and t.get("parentMagazineTitleId"):
+                    self.magazines_cache.put(
+                        t["parentMagazineTitleId"], {"latest_issue_id": t["id"]}
+                    )
+        return titles
 
     def run(self):
         libby_token: str = PREFS[PreferenceKeys.LIBBY_TOKEN]
@@ -397,83 +740,83 @@ class SyncDataWorker(QObject):
             )
             max_per_page = 24
             total_pages = math.ceil(len(uncached_website_ids) / max_per_page)
-            for page in range(1, 1 + total_pages):
-                website_ids = uncached_website_ids[
-                    (page - 1) * max_per_page : page * max_per_page
-                ]
-                results = od_client.libraries(
-                    website_ids=website_ids, per_page=max_per_page
-                )
-                found = results.get("items", [])
-                for library in found:
-                    self.libraries_cache.put(str(library["websiteId"]), library)
-                libraries.extend(found)
-            logger.info("OverDrive Libraries requests took %f seconds", timer() - start)
-            synced_state["__libraries"] = libraries
-
-            subbed_magazines = []
-            if subscriptions:
-                logger.info("Checking %d magazines", len(subscriptions))
-                # Fetch magazine details from OD
-                start = timer()
-                all_parent_magazine_ids = [
-                    s["parent_magazine_id"] for s in subscriptions
+            website_ids_pages = [
+                uncached_website_ids[(page - 1) * max_per_page : page * max_per_page]
+                for page in range(1, 1 + total_pages)
+            ]
+            # parent magazine IDs are not cached as media, instead the latest issue
+            # for each is indexed and checked again once the index entry is stale
+            all_parent_magazine_ids = [s["parent_magazine_id"] for s in subscriptions]
+            total_pages = math.ceil(
+                len(all_parent_magazine_ids) / OverDriveClient.MAX_PER_PAGE
+            )
+            parent_magazine_ids_pages = [
+                all_parent_magazine_ids[
+                    (page - 1)
+                    * OverDriveClient.MAX_PER_PAGE : page
+                    * OverDriveClient.MAX_PER_PAGE
                 ]
-                total_pages = math.ceil(
-                    len(all_parent_magazine_ids) / OverDriveClient.MAX_PER_PAGE
-                )
-                for page in range(1, 1 + total_pages):
-                    # don't cache parent magazine IDs, only the latest issues
-                    # to make sure that we'll always have the correct latest issue
-                    parent_magazine_ids = all_parent_magazine_ids[
-                        (page - 1)
-                        * OverDriveClient.MAX_PER_PAGE : page
-                        * OverDriveClient.MAX_PER_PAGE
-                    ]
-                    parent_magazines = od_client.media_bulk(
-                        title_ids=parent_magazine_ids
-                    )
-                    # we re-query with the new title IDs because querying with the parent magazine ID
-                    # returns an old estimatedReleaseDate, so if we want to sort by estimatedReleaseDate
-                    # we need to re-query
-                    latest_magazine_ids = [
-                        # sometimes t["id"] is not the latest issue (due to misconfig?)
-                        # so use t["recentIssues"] instead
-                        t["recentIssues"][0]["id"] if t.get("recentIssues") else t["id"]
-                        for t in parent_magazines
-                    ]
-                    uncached_latest_magazine_ids, titles = extract_cached_items(
-                        latest_magazine_ids, self.media_cache
+                for page in range(1, 1 + total_pages)
+            ]
+
+            # The library and magazine pages are independent of each other so they
+            # are all requested concurrently. Results are collected in page order.
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                libraries_pages = [
+                    executor.submit(
+                        _timed,
+                        fetch_revalidated_items,
+                        website_ids,
+                        self.libraries_cache,
+                        partial(
+                            od_client.libraries,
+                            website_ids=website_ids,
+                            per_page=max_per_page,
+                        ),
+                        lambda content: content.get("items", []),
+                        lambda library: str(library["websiteId"]),
                     )
-                    logger.debug("Reusing %d cached media", len(titles))
-                    logger.debug(
-                        "Fetching %d new media", len(uncached_latest_magazine_ids)
+                    for website_ids in website_ids_pages
+                ]
+                if subscriptions:
+                    logger.info("Checking %d magazines", len(subscriptions))
+                magazines_pages = [
+                    executor.submit(
+                        _timed,
+                        self._fetch_latest_magazines,
+                        od_client,
+                        parent_magazine_ids,
                     )
-                    if uncached_latest_magazine_ids:
-                        found = od_client.media_bulk(
-                            title_ids=uncached_latest_magazine_ids
-                        )
-                        for m in found:
-                            self.media_cache.put(m["id"], m)
-                        titles.extend(found)
-                    for t in titles:
-                        t["cardId"] = next(
-                            iter(
-                                [
-                                    s["card_id"]
-                                    for s in subscriptions
-                                    if s["parent_magazine_id"]
-                                    == t["parentMagazineTitleId"]
-                                ]
-                            ),
-                            None,
-                        )
-                    subbed_magazines.extend(titles)
+                    for parent_magazine_ids in parent_magazine_ids_pages
+                ]
+
+                libraries_end = start
+                for libraries_page in libraries_pages:
+                    found, end = libraries_page.result()
+                    libraries_end = max(libraries_end, end)
+                    libraries.extend(found)
                 logger.info(
-                    "OverDrive Magazines requests took %f seconds", timer() - start
+                    "OverDrive Libraries requests took %f seconds",
+                    libraries_end - start,
                 )
+                synced_state["__libraries"] = libraries
+
+                subbed_magazines = []
+                if subscriptions:
+                    magazines_end = start
+                    for magazines_page in magazines_pages:
+                        titles, end = magazines_page.result()
+                        magazines_end = max(magazines_end, end)
+                        subbed_magazines.extend(
+                            set_subscription_card_ids(titles, subscriptions)
+                        )
+                    logger.info(
+                        "OverDrive Magazines requests took %f seconds",
+                        magazines_end - start,
+                    )
             synced_state["__subscriptions"] = subbed_magazines
             logger.info("Total Sync Time took %f seconds", timer() - total_start)
+            self._save_synced_state(synced_state)
 
             self.finished.emit(synced_state)
         except Exception as err:
@@ -14,5 +14,6 @@ from pathlib import Path
 
 sys.path.append(str(Path("calibre-plugin/").absolute()))
 
+from .keepalive import KeepAliveTests
 from .libby import LibbyClientTests
 from .overdrive import OverDriveClientTests
@@ -43,6 +43,600 @@ class CalibreTests(unittest.TestCase):
         cache.clear()
         self.assertEqual(cache.count(), 0)
 
+    def test_expiringcache(self):
+        from calibre_plugins.overdrive_libby.utils import ExpiringCache
+
+        cache = ExpiringCache(capacity=2, ttl=60)
+        results = [{"id": "1"}]
+        cache.put("a", results)
+        results[0]["title"] = "x"
+        self.assertEqual(cache.get("a"), [{"id": "1"}])
+        cache.get("a")[0]["title"] = "x"
+        self.assertEqual(cache.get("a"), [{"id": "1"}])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        cache.put("b", [])
+        cache.put("c", [])
+        self.assertEqual(cache.count(), 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), [])
+        value, age = cache.get_with_age("b")
+        self.assertEqual(value, [])
+        self.assertTrue(0 <= age < 60)
+        cache.ttl = 0
+        self.assertIsNone(cache.get("c"))
+        cache.clear()
+        self.assertEqual(cache.count(), 0)
+
+    def test_sqlitecache(self):
+        import json
+        import tempfile
+        import time
+        from pathlib import Path
+
+        from calibre_plugins.overdrive_libby.utils import SqliteCache
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_cache_path = Path(temp_dir, "cache.json")
+            with json_cache_path.open("w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "a": {"a": 1, "__cached_at": time.time()},
+                        "expired": {"expired": 1, "__cached_at": 1},
+                    },
+                    f,
+                )
+            cache_path = Path(temp_dir, "cache.sqlite")
+            cache = SqliteCache(
+                capacity=2,
+                persist_to_path=cache_path,
+                import_from_path=json_cache_path,
+            )
+            self.assertEqual(cache.count(), 1)
+            self.assertFalse(json_cache_path.exists())
+            self.assertEqual(cache.get("a")["a"], 1)
+            self.assertIsNone(cache.get("expired"))
+            cache.put("b", {"b": 1, "cover": b"123"})
+            cache.put("c", {"c": 1})
+            self.assertEqual(cache.count(), 3)
+            # writes are committed without a save()
+            self.assertEqual(SqliteCache(persist_to_path=cache_path).get("c")["c"], 1)
+            cache.save()
+            self.assertEqual(cache.count(), 2)
+            self.assertEqual([k for k, _ in cache.items()], ["b", "c"])
+            # bytes are only kept in memory
+            self.assertEqual(cache.get("b")["cover"], b"123")
+            self.assertNotIn("cover", SqliteCache(persist_to_path=cache_path).get("b"))
+            # expired items can be revalidated while they are still retained
+            cache.stale_age_days = 2
+            cache.put("d", {"d": 1, "__cached_at": time.time() - 4 * 86400})
+            cache.put("e", {"e": 1, "__cached_at": time.time() - 6 * 86400})
+            self.assertIsNone(cache.get("d"))
+            self.assertEqual(cache.get_stale("d")["d"], 1)
+            self.assertIsNone(cache.get_stale("e"))
+            self.assertEqual(cache.renew("d")["d"], 1)
+            self.assertEqual(cache.get("d")["d"], 1)
+            self.assertIsNone(cache.renew("e"))
+            cache.cache_age_days = 0
+            self.assertIsNone(cache.get("b"))
+            cache.clear()
+            cache.save()
+            self.assertEqual(cache.count(), 0)
+
+    def test_synced_state(self):
+        import tempfile
+        from pathlib import Path
+        from types import SimpleNamespace
+
+        from qt.core import QLabel
+
+        from calibre_plugins.overdrive_libby.dialog.base import BaseDialogMixin
+        from calibre_plugins.overdrive_libby.workers import SyncDataWorker
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            synced_state_path = Path(temp_dir, "synced_state.json")
+            dialog = SimpleNamespace(
+                synced_state_path=synced_state_path, stale_lbl=QLabel()
+            )
+            self.assertIsNone(BaseDialogMixin.load_synced_state(dialog))
+
+            worker = SyncDataWorker()
+            worker.setup(None, None, synced_state_path)
+            worker._save_synced_state(
+                {
+                    "identity": "abc",
+                    "loans": [{"id": "1", "cover": b"123"}],
+                    "holds": [],
+                }
+            )
+            self.assertFalse(Path(temp_dir, "synced_state.json.tmp").exists())
+            synced_state = BaseDialogMixin.load_synced_state(dialog)
+            # the auth token and bytes are not saved
+            self.assertEqual(
+                synced_state, {"loans": [{"id": "1", "cover": None}], "holds": []}
+            )
+            self.assertTrue(dialog.stale_lbl.text())
+
+            synced_state_path.write_text("{", encoding="utf-8")
+            self.assertIsNone(BaseDialogMixin.load_synced_state(dialog))
+
+    def test_library_match_index(self):
+        from types import SimpleNamespace
+
+        from calibre_plugins.overdrive_libby.models import LibraryMatchIndex
+
+        def field(book_col_map):
+            return SimpleNamespace(table=SimpleNamespace(book_col_map=book_col_map))
+
+        titles = {1: "Ipsum Debitis", 2: "Dignissimos", 3: "Aspernatur"}
+        formats = {1: ("EPUB",), 3: ("EPUB",)}
+        identifiers = {
+            2: {"isbn": "9780000000002"},
+            3: {"amazon": "B000000003", "odid": "1234@abc.overdrive.com&5678@def"},
+        }
+        db = SimpleNamespace(
+            fields={
+                "title": field(titles),
+                "formats": field(formats),
+                "identifiers": field(identifiers),
+            }
+        )
+        index = LibraryMatchIndex(db)
+        self.assertEqual(index.find_book(["ipsum debitis"]), 1)
+        self.assertEqual(index.find_book(["x"], isbn="9780000000002"), 2)
+        self.assertEqual(index.find_book(["x"], asin="B000000003"), 3)
+        self.assertEqual(index.find_book(["x"], odid="5678"), 3)
+        self.assertIsNone(index.find_book(["x"], odid="9999"))
+        self.assertTrue(index.in_library(["dignissimos"]))
+        self.assertFalse(index.in_library(["dignissimos"], exclude_empty_books=True))
+
+        # incremental updates from db events
+        titles[4] = "Dolorem"
+        formats[2] = ("PDF",)
+        index.db_event_received("library", SimpleNamespace(name="book_created"), (4,))
+        index.db_event_received(
+            "library", SimpleNamespace(name="format_added"), (2, "PDF")
+        )
+        self.assertEqual(index.find_book(["dolorem"]), 4)
+        self.assertTrue(index.in_library(["dignissimos"], exclude_empty_books=True))
+        titles[1] = "Quia"
+        index.db_event_received(
+            "library", SimpleNamespace(name="metadata_changed"), ("title", [1])
+        )
+        self.assertIsNone(index.find_book(["ipsum debitis"]))
+        self.assertEqual(index.find_book(["quia"]), 1)
+        del titles[3]
+        index.db_event_received(
+            "library", SimpleNamespace(name="books_removed"), ([3],)
+        )
+        self.assertIsNone(index.find_book(["aspernatur"], asin="B000000003"))
+
+    def test_search_model_sort(self):
+        from qt.core import Qt
+        from calibre_plugins.overdrive_libby.models import (
+            LibbyModel,
+            LibbySearchModel,
+            LibbySearchSortFilterModel,
+        )
+
+        search_results = [
+            {
+                "id": str(1000 + i),
+                "title": f"Ipsum Debitis {i}",
+                "sortTitle": f"ipsum debitis {i}",
+                "firstCreatorName": f"Dignissimos {i % 37}",
+                "firstCreatorSortName": f"{i % 37}, Dignissimos",
+                "publisher": {"name": f"Aspernatur {i % 11}"},
+                "publishDate": f"20{10 + i % 13}-0{1 + i % 9}-1{i % 10}T00:00:00Z",
+                "type": {"id": "ebook"},
+                "formats": [{"id": "ebook-epub-adobe"}, {"id": "ebook-kindle"}],
+                "siteAvailabilities": {
+                    f"lib{j}": {
+                        "isAvailable": bool((i + j) % 2),
+                        "estimatedWaitDays": (i * j) % 60,
+                        "ownedCopies": j + 1,
+                    }
+                    for j in range(1 + i % 5)
+                },
+            }
+            for i in range(100)
+        ]
+        model = LibbySearchModel(None, {"search_results": search_results})
+        self.assertEqual(model.rowCount(), len(search_results))
+        proxy_model = LibbySearchSortFilterModel(None, model=model)
+
+        for col in range(model.columnCount()):
+            for order in (Qt.AscendingOrder, Qt.DescendingOrder):
+                proxy_model.sort(col, order)
+                sort_values = [
+                    proxy_model.index(row, col).data(LibbyModel.DisplaySortRole)
+                    for row in range(proxy_model.rowCount())
+                ]
+                self.assertEqual(
+                    sort_values,
+                    sorted(sort_values, reverse=order == Qt.DescendingOrder),
+                )
+
+    def test_search_model_update_availabilities(self):
+        from timeit import default_timer as timer
+
+        from qt.core import Qt
+        from calibre_plugins.overdrive_libby.models import LibbySearchModel
+
+        search_results = [
+            {
+                "id": str(1000 + i),
+                "title": f"Ipsum Debitis {i}",
+                "type": {"id": "ebook"},
+                "formats": [{"id": "ebook-epub-adobe"}],
+                "siteAvailabilities": {
+                    "lib1": {"isAvailable": False, "ownedCopies": 1},
+                    "lib2": {"isAvailable": False, "ownedCopies": 2},
+                },
+            }
+            for i in range(3)
+        ]
+        model = LibbySearchModel(None, {"search_results": search_results})
+        self.assertFalse(model.availabilities_expired())
+        self.assertEqual(
+            model.get_library_title_ids(["1000", "1002"]),
+            {"lib1": ["1000", "1002"], "lib2": ["1000", "1002"]},
+        )
+        changed_rows = []
+        model.dataChanged.connect(
+            lambda top_left, bottom_right: changed_rows.append(top_left.row())
+        )
+        model.update_availabilities(
+            {
+                "lib1": [{"id": "1002", "isAvailable": True, "availableCopies": 1}],
+                "lib3": [{"id": "1001", "isAvailable": True}],
+            }
+        )
+        self.assertEqual(changed_rows, [2])
+        updated = model.index(2, 0).data(Qt.UserRole)["siteAvailabilities"]["lib1"]
+        self.assertTrue(updated["isAvailable"])
+        self.assertEqual(updated["ownedCopies"], 1)
+        self.assertNotIn("lib3", search_results[1]["siteAvailabilities"])
+        # the search result is only decoded once
+        self.assertIs(
+            model.index(1, 0).data(Qt.UserRole), model.index(1, 0).data(Qt.UserRole)
+        )
+        model.add_loan({"id": "1002", "cardId": "1"})
+        self.assertTrue(model.availabilities_expired())
+
+        # cached search results are only as recent as when they were fetched
+        fetched_at = timer() - model.availability_max_age - 1
+        model.sync({"search_results": search_results}, fetched_at=fetched_at)
+        self.assertTrue(model.availabilities_expired())
+        model.update_availabilities({})
+        self.assertFalse(model.availabilities_expired())
+        model.update_search_results(search_results, fetched_at=fetched_at)
+        self.assertTrue(model.availabilities_expired())
+
+    def test_library_search_results_merger(self):
+        from qt.core import QPersistentModelIndex, Qt
+        from calibre_plugins.overdrive_libby.models import (
+            LibbySearchModel,
+            LibrarySearchResultsMerger,
+        )
+
+        def library_items(title_ids, format_id):
+            return [
+                {
+                    "id": title_id,
+                    "title": f"Ipsum Debitis {title_id}",
+                    "type": {"id": "ebook"},
+                    "isAvailable": True,
+                    "ownedCopies": 1,
+                    "formats": [{"id": format_id}],
+                }
+                for title_id in title_ids
+            ]
+
+        merger = LibrarySearchResultsMerger()
+        model = LibbySearchModel(None, {"search_results": []})
+        merger.merge("lib1", library_items(["1", "2"], "ebook-epub-adobe"))
+        model.update_search_results(merger.results())
+        self.assertEqual(model.rowCount(), 2)
+        selected = QPersistentModelIndex(model.index(1, 0))
+        unchanged = model.index(0, 0).data(Qt.UserRole)
+
+        merger.merge("lib2", library_items(["3", "2"], "ebook-kindle"))
+        merger.merge("lib3", library_items(["2"], "ebook-kindle"))
+        results = merger.results()
+        # ordered by average rank
+        self.assertEqual([r["id"] for r in results], ["1", "3", "2"])
+        self.assertEqual(merger.library_keys, {"lib1", "lib2", "lib3"})
+        merged = results[2]
+        self.assertEqual(
+            [f["id"] for f in merged["formats"]], ["ebook-epub-adobe", "ebook-kindle"]
+        )
+        self.assertEqual(
+            sorted(merged["siteAvailabilities"].keys()), ["lib1", "lib2", "lib3"]
+        )
+        self.assertEqual(merged["siteAvailabilities"]["lib2"]["advantageKey"], "lib2")
+        self.assertNotIn("isAvailable", merged)
+
+        model.update_search_results(results)
+        self.assertEqual(model.rowCount(), 3)
+        # selected row has moved with the title
+        self.assertEqual(selected.row(), 2)
+        self.assertEqual(selected.data(Qt.UserRole)["id"], "2")
+        # only the results with new availabilities are rebuilt
+        self.assertIs(model.index(0, 0).data(Qt.UserRole), unchanged)
+        self.assertEqual(
+            sorted(model.index(2, 5).data(Qt.ToolTipRole).split(", ")),
+            ["lib1", "lib2", "lib3"],
+        )
+
+        # next page of results are ranked after the first page
+        merger.merge("lib1", library_items(["4"], "ebook-epub-adobe"), start_rank=3)
+        self.assertEqual([r["id"] for r in merger.results()], ["1", "3", "2", "4"])
+
+    def test_search_model_fetch_more(self):
+        from qt.core import QModelIndex
+        from calibre_plugins.overdrive_libby.models import LibbySearchModel
+
+        model = LibbySearchModel(None, {"search_results": []})
+        requested = []
+        model.fetch_more_requested.connect(lambda: requested.append(True))
+        self.assertFalse(model.canFetchMore(QModelIndex()))
+
+        model.set_can_fetch_more(True)
+        self.assertTrue(model.canFetchMore(QModelIndex()))
+        model.fetchMore(QModelIndex())
+        # only requested once while the next page is being fetched
+        self.assertFalse(model.canFetchMore(QModelIndex()))
+        model.fetchMore(QModelIndex())
+        self.assertEqual(len(requested), 1)
+
+        model.set_can_fetch_more(True)
+        model.sync({"search_results": []})
+        self.assertFalse(model.canFetchMore(QModelIndex()))
+
+    def test_holds_model_incremental_updates(self):
+        from qt.core import QPersistentModelIndex, Qt
+        from calibre_plugins.overdrive_libby.models import LibbyHoldsModel
+
+        def hold(title_id, placed_date, is_available=False):
+            return {
+                "id": title_id,
+                "cardId": "1",
+                "title": f"Ipsum Debitis {title_id}",
+                "type": {"id": "ebook"},
+                "isAvailable": is_available,
+                "estimatedWaitDays": 10,
+                "placedDate": placed_date,
+            }
+
+        holds = [hold("1", "2023-01-01"), hold("2", "2023-01-03")]
+        model = LibbyHoldsModel(None, {"holds": holds})
+        resets = []
+        model.modelReset.connect(lambda: resets.append(True))
+        selected = QPersistentModelIndex(model.index(1, 0))
+        self.assertEqual(selected.data(Qt.UserRole)["id"], "1")
+
+        model.add_hold(hold("3", "2023-01-02"))
+        self.assertEqual(
+            [model.index(i, 0).data(Qt.UserRole)["id"] for i in range(3)],
+            ["2", "3", "1"],
+        )
+        self.assertEqual(selected.row(), 2)
+
+        model.remove_hold({"id": "2", "cardId": "1"})
+        self.assertEqual(selected.row(), 1)
+
+        changed_rows = []
+        model.dataChanged.connect(
+            lambda top_left, bottom_right: changed_rows.append(top_left.row())
+        )
+        # only the changed hold is updated, and moved to the top because it is available
+        model.sync({"holds": [hold("3", "2023-01-02"), hold("1", "2023-01-01", True)]})
+        self.assertEqual(
+            [model.index(i, 0).data(Qt.UserRole)["id"] for i in range(2)], ["1", "3"]
+        )
+        self.assertEqual(selected.row(), 0)
+        self.assertEqual(changed_rows, [0])
+        self.assertEqual(resets, [])
+
+    def test_loans_sort_filter_model(self):
+        from types import SimpleNamespace
+
+        from qt.core import QCoreApplication, Qt
+        from calibre_plugins.overdrive_libby.models import (
+            LibbyLoansModel,
+            LibbyLoansSortFilterModel,
+            LibraryMatchIndex,
+        )
+
+        def field(book_col_map):
+            return SimpleNamespace(table=SimpleNamespace(book_col_map=book_col_map))
+
+        db = SimpleNamespace(
+            fields={
+                "title": field({1: "Ipsum Debitis"}),
+                "formats": field({1: ("EPUB",)}),
+                "identifiers": field({}),
+            }
+        )
+        loans = [
+            {
+                "id": str(i),
+                "cardId": "1",
+                "title": title,
+                "firstCreatorName": "Aspernatur",
+                "type": {"id": "ebook"},
+                "formats": [{"id": "ebook-epub-adobe"}],
+                "checkoutDate": f"2023-01-0{i}T00:00:00Z",
+            }
+            for i, title in enumerate(["Ipsum Debitis", "Dignissimos"], start=1)
+        ]
+        model = LibbyLoansModel(
+            None,
+            {"cards": [{"cardId": "1", "advantageKey": "lib1"}], "loans": loans},
+            db,
+        )
+        proxy_model = LibbyLoansSortFilterModel(
+            None, model=model, db=db, match_index=LibraryMatchIndex(db)
+        )
+
+        def filtered_titles():
+            # wait for the background filter run to be applied
+            QCoreApplication.processEvents()
+            proxy_model.run_filter().result()
+            QCoreApplication.processEvents()
+            return [
+                proxy_model.index(i, 0).data(Qt.UserRole)["title"]
+                for i in range(proxy_model.rowCount())
+            ]
+
+        proxy_model.set_filter_hide_books_already_in_library(False)
+        self.assertEqual(filtered_titles(), ["Dignissimos", "Ipsum Debitis"])
+        proxy_model.set_filter_hide_books_already_in_library(True)
+        self.assertEqual(filtered_titles(), ["Dignissimos"])
+        proxy_model.set_filter_hide_books_already_in_library(False)
+        proxy_model.set_filter_text("ipsum")
+        proxy_model.apply_filter_text()
+        self.assertEqual(filtered_titles(), ["Ipsum Debitis"])
+        # narrowed down from the accepted rows
+        proxy_model.set_filter_text("ipsum deb")
+        proxy_model.apply_filter_text()
+        self.assertEqual(filtered_titles(), ["Ipsum Debitis"])
+        # matched against the library key
+        proxy_model.set_filter_text("lib1")
+        proxy_model.apply_filter_text()
+        self.assertEqual(filtered_titles(), ["Dignissimos", "Ipsum Debitis"])
+
+        def accepts_loan(*args, **kwargs):
+            raise KeyError("formats")
+
+        # all loans are shown if filtering fails
+        proxy_model._accepts_loan = accepts_loan
+        proxy_model.set_filter_hide_books_already_in_library(True)
+        self.assertEqual(filtered_titles(), ["Dignissimos", "Ipsum Debitis"])
+
+    def test_holds_sort_filter_model_filter_text(self):
+        from qt.core import Qt
+        from calibre_plugins.overdrive_libby.models import (
+            LibbyHoldsModel,
+            LibbyHoldsSortFilterModel,
+        )
+
+        holds = [
+            {
+                "id": str(i),
+                "cardId": "1",
+                "title": title,
+                "firstCreatorName": "Aspernatur",
+                "type": {"id": "ebook"},
+                "isAvailable": True,
+                "placedDate": f"2023-01-0{i}T00:00:00Z",
+            }
+            for i, title in enumerate(
+                ["Ipsum Debitis", "Ipsum Dolorem", "Dignissimos"], start=1
+            )
+        ]
+        model = LibbyHoldsModel(
+            None, {"cards": [{"cardId": "1", "advantageKey": "lib1"}], "holds": holds}
+        )
+        tested_rows = []
+
+        class HoldsSortFilterModel(LibbyHoldsSortFilterModel):
+            def filterAcceptsRow(self, sourceRow, sourceParent):
+                if not self.is_narrowed_out(sourceRow):
+                    tested_rows.append(sourceRow)
+                return super().filterAcceptsRow(sourceRow, sourceParent)
+
+        proxy_model = HoldsSortFilterModel(None, model=model)
+        filter_text_set = []
+        proxy_model.filter_text_set.connect(lambda: filter_text_set.append(True))
+
+        def filtered_titles():
+            return [
+                proxy_model.index(i, 0).data(Qt.UserRole)["title"]
+                for i in range(proxy_model.rowCount())
+            ]
+
+        # the filter text is only applied after the delay
+        for text in ("i", "ip", "ips"):
+            proxy_model.set_filter_text(text)
+        self.assertEqual(len(filtered_titles()), 3)
+        proxy_model.apply_filter_text()
+        self.assertEqual(filtered_titles(), ["Ipsum Dolorem", "Ipsum Debitis"])
+        self.assertEqual(len(filter_text_set), 1)
+        tested_rows.clear()
+
+        # the extended filter text only tests the accepted rows
+        proxy_model.set_filter_text("ipsum d")
+        proxy_model.apply_filter_text()
+        self.assertEqual(filtered_titles(), ["Ipsum Dolorem", "Ipsum Debitis"])
+        self.assertEqual(sorted(tested_rows), [1, 2])
+        proxy_model.set_filter_text("aspernatur")
+        proxy_model.apply_filter_text()
+        self.assertEqual(len(filtered_titles()), 3)
+
+    def test_media_index(self):
+        from calibre_plugins.overdrive_libby.models import MediaIndex
+
+        loans = MediaIndex(
+            [
+                {"id": "1", "cardId": "1"},
+                {"id": "1", "cardId": "2"},
+                {"id": "2", "cardId": "1"},
+            ]
+        )
+        self.assertEqual(len(loans), 3)
+        self.assertTrue(loans.has("1", "2"))
+        self.assertFalse(loans.has("2", "2"))
+        loans.remove("1", "1")
+        self.assertTrue(loans.has_title("1"))
+        loans.remove("1", "2")
+        self.assertFalse(loans.has_title("1"))
+        loans.add({"id": "3", "cardId": "1"})
+        self.assertEqual([m["id"] for m in loans], ["2", "3"])
+
+    def test_fetch_in_order(self):
+        import threading
+        import time
+
+        from calibre_plugins.overdrive_libby.magazine_download import _fetch_in_order
+
+        entries = [{"url": f"fonts/{i}.ttf"} for i in range(3)] + [
+            {"url": f"css/{i}.css"} for i in range(5)
+        ]
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(entry):
+            # later entries complete first
+            time.sleep(0.01 * (len(entries) - entries.index(entry)))
+            with lock:
+                fetched.append(entry["url"])
+            return entry["url"].encode("ascii")
+
+        results = list(_fetch_in_order(fetch, entries, 3))
+        self.assertEqual([e for e, _ in results], entries)
+        self.assertEqual([r for _, r in results], [e["url"].encode() for e in entries])
+        self.assertEqual(sorted(fetched), sorted(e["url"] for e in entries))
+
+        # nothing is yielded once aborted, and fetches not yet started are cancelled
+        abort = threading.Event()
+        fetched.clear()
+        yielded = []
+        for entry, _ in _fetch_in_order(fetch, entries, 1, abort):
+            yielded.append(entry)
+            abort.set()
+        self.assertEqual(yielded, entries[:1])
+        self.assertLess(len(fetched), len(entries))
+
+        def fetch_error(entry):
+            if entry["url"].endswith(".css"):
+                raise RuntimeError(entry["url"])
+            return b""
+
+        with self.assertRaisesRegex(RuntimeError, "css/0.css"):
+            list(_fetch_in_order(fetch_error, entries, 2))
+
     def test_truncate_for_display(self):
         from calibre_plugins.overdrive_libby.models import truncate_for_display
 
@@ -0,0 +1,181 @@
+#
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of the OverDrive Libby Plugin by ping
+# OverDrive Libby Plugin for calibre / libby-calibre-plugin
+#
+# See https://github.com/ping/libby-calibre-plugin for more
+# information
+#
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from libby import LibbyClient
+from libby.errors import ClientNotFoundError
+from overdrive import OverDriveClient
+from overdrive.errors import ClientConnectionError
+from .base import BaseTests
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connect_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, obj, gzipped=False):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if gzipped:
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/missing"):
+            self._send_json(404, {"result": "not_found"})
+        elif self.path.startswith("/redirect"):
+            self.send_response(302)
+            self.send_header("Location", "/ok")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self._send_json(
+                200, {"path": self.path}, gzipped=self.path.startswith("/gzip")
+            )
+            if self.path.startswith("/drop"):
+                # close without telling the client, as servers do with idle connections
+                self.close_connection = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.post_count += 1
+        if self.path.startswith("/drop"):
+            # close without a response, as if the connection was lost after the request
+            self.close_connection = True
+            return
+        self._send_json(200, {"path": self.path})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class KeepAliveTests(BaseTests):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+        self.server.lock = threading.Lock()
+        self.server.connect_count = 0
+        self.server.post_count = 0
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self.server_thread.start()
+        self.base_url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def test_libby_connection_reuse(self):
+        client = LibbyClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        for i in range(5):
+            res = client.send_request(f"ok/{i}", authenticated=False)
+            self.assertEqual(res["path"], f"/ok/{i}")
+        res = client.send_request("gzip", authenticated=False)
+        self.assertEqual(res["path"], "/gzip")
+        res = client.send_request("ok", method="HEAD", return_response=True)
+        self.assertEqual(res.code, 200)
+        res = client.send_request(
+            "redirect", no_redirect=True, return_response=True, authenticated=False
+        )
+        self.assertEqual(res.code, 302)
+        res.read()
+        with self.assertRaises(ClientNotFoundError):
+            client.send_request("missing", authenticated=False)
+        res = client.send_request("ok", authenticated=False)
+        self.assertEqual(res["path"], "/ok")
+        self.assertEqual(self.server.connect_count, 1)
+        self.assertEqual(client.connection_pool.count(), 1)
+
+    def test_overdrive_connection_reuse(self):
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        for i in range(5):
+            res = client.send_request(f"ok/{i}")
+            self.assertEqual(res["path"], f"/ok/{i}")
+        self.assertEqual(self.server.connect_count, 1)
+
+    def test_concurrent_requests(self):
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        errors = []
+
+        def fetch():
+            try:
+                for i in range(5):
+                    client.send_request(f"ok/{i}")
+            except Exception as err:  # noqa
+                errors.append(err)
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(errors)
+        self.assertLessEqual(self.server.connect_count, 3)
+        self.assertLessEqual(
+            client.connection_pool.count(), client.connection_pool.max_per_host
+        )
+
+    def test_idle_eviction(self):
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        client.connection_pool.idle_timeout = -1
+        client.send_request("ok")
+        client.send_request("ok")
+        self.assertEqual(self.server.connect_count, 2)
+
+    def test_stale_connection(self):
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        client.send_request("drop")
+        self.assertEqual(client.connection_pool.count(), 1)
+        res = client.send_request("ok")
+        self.assertEqual(res["path"], "/ok")
+        self.assertEqual(self.server.connect_count, 2)
+
+    def test_stale_connection_not_resent(self):
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = self.base_url
+        self.addCleanup(client.connection_pool.clear)
+        client.send_request("ok")
+        self.assertEqual(client.connection_pool.count(), 1)
+        # the server may have acted on a non-idempotent request, so it is not resent
+        with self.assertRaises(ClientConnectionError):
+            client.send_request("drop", params={"a": 1}, method="POST")
+        self.assertEqual(self.server.post_count, 1)
+        res = client.send_request("ok", params={"a": 1}, method="POST")
+        self.assertEqual(res["path"], "/ok")
+        self.assertEqual(self.server.post_count, 2)
@@ -7,12 +7,19 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
+import gzip
 import os
+import tempfile
+import threading
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
+from http.client import HTTPMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
 from pathlib import Path
 from unittest.mock import patch
 from urllib.error import URLError
+from urllib.response import addinfourl
 
 from libby import LibbyClient, LibbyFormats
 from libby.errors import (
@@ -28,6 +35,51 @@ from libby.errors import (
 from .base import BaseTests, MockHTTPError
 
 
+class FlakyFileRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.content, dropping the connection halfway through
+    the first response. Supports Range and If-Range.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.content
+        etag = self.server.etag
+        self.server.request_headers.append(dict(self.headers))
+        range_header = self.headers.get("Range")
+        start = 0
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            start = int(range_header[len("bytes=") : -1])
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        if not self.server.dropped:
+            self.server.dropped = True
+            self.wfile.write(content[start : len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+        self.server.bytes_sent += len(content) - start
+
+
+class ChangedFileRequestHandler(FlakyFileRequestHandler):
+    def do_GET(self):
+        if self.server.dropped:
+            # file is updated after the interrupted response
+            self.server.etag = '"updated"'
+        super().do_GET()
+
+
 class LibbyClientTests(BaseTests):
     def setUp(self):
         super().setUp()
@@ -114,6 +166,87 @@ class LibbyClientTests(BaseTests):
             if tested_magazine and tested_epub:
                 break
 
+    def test_write_response(self):
+        content = os.urandom(256 * 1024)
+        for is_gzip in (False, True):
+            with self.subTest(is_gzip=is_gzip):
+                body = gzip.compress(content) if is_gzip else content
+                headers = HTTPMessage()
+                headers["Content-Length"] = str(len(body))
+                if is_gzip:
+                    headers["Content-Encoding"] = "gzip"
+                response = addinfourl(BytesIO(body), headers, "")
+                progress = []
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    file_path = Path(temp_dir, "test.epub")
+                    bytes_read = LibbyClient._write_response(
+                        response,
+                        file_path,
+                        lambda read, total: progress.append((read, total)),
+                        chunk_size=64 * 1024,
+                    )
+                    self.assertEqual(file_path.read_bytes(), content)
+                self.assertEqual(bytes_read, len(body))
+                self.assertEqual(progress[-1], (len(body), len(body)))
+                self.assertEqual(len(progress), -(-len(body) // (64 * 1024)))
+
+    def test_urlretrieve_resume(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyFileRequestHandler)
+        server.content = os.urandom(512 * 1024)
+        server.etag = '"abc"'
+        server.dropped = False
+        server.bytes_sent = 0
+        server.request_headers = []
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}/file.epub".format(server.server_address[1])
+        client = LibbyClient(max_retries=1, timeout=5, logger=self.logger)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = Path(temp_dir, "file.epub")
+            client._urlretrieve_to_path(url, file_path)
+            self.assertEqual(file_path.read_bytes(), server.content)
+            self.assertFalse(file_path.with_name("file.epub.part").exists())
+            self.assertEqual(
+                server.request_headers[-1]["Range"],
+                f"bytes={len(server.content) // 2}-",
+            )
+            self.assertEqual(server.bytes_sent, len(server.content) // 2)
+
+            # file changed between attempts, so download restarts
+            server.dropped = False
+            server.bytes_sent = 0
+            server.request_headers.clear()
+            server.RequestHandlerClass = ChangedFileRequestHandler
+            client._urlretrieve_to_path(url, file_path)
+            self.assertEqual(file_path.read_bytes(), server.content)
+            self.assertIn("If-Range", server.request_headers[-1])
+            self.assertEqual(server.bytes_sent, len(server.content))
+
+            # no retries left
+            server.RequestHandlerClass = FlakyFileRequestHandler
+            server.dropped = False
+            client.max_retries = 0
+            with self.assertRaises(ClientConnectionError):
+                client._urlretrieve_to_path(url, file_path)
+
+            # the partial file is kept, so a later call resumes the download
+            part_path = file_path.with_name("file.epub.part")
+            self.assertTrue(part_path.exists())
+            server.bytes_sent = 0
+            client._urlretrieve_to_path(url, file_path)
+            self.assertEqual(file_path.read_bytes(), server.content)
+            self.assertEqual(
+                server.request_headers[-1]["Range"],
+                f"bytes={len(server.content) // 2}-",
+            )
+            self.assertEqual(server.request_headers[-1]["If-Range"], server.etag)
+            self.assertEqual(server.bytes_sent, len(server.content) // 2)
+            self.assertFalse(part_path.exists())
+            self.assertFalse(part_path.with_name("file.epub.part.json").exists())
+
     def test_get_loan_format(self):
         with self.assertRaises(ValueError) as context:
             LibbyClient.get_loan_format(
@@ -284,7 +417,16 @@ class LibbyClientTests(BaseTests):
         ):
             with self.subTest(value=value):
                 LibbyClient.parse_datetime(value)
+                self.assertEqual(
+                    LibbyClient.parse_datetime(value),
+                    LibbyClient._parse_datetime_strptime(value),
+                )
 
+        self.assertEqual(
+            LibbyClient.parse_datetime("2023-09-14T07:20:30.5-05:30"),
+            datetime(2023, 9, 14, 12, 50, 30, 500000, tzinfo=timezone.utc),
+        )
+        self.assertIsNone(LibbyClient._parse_iso_datetime("05/30/2023"))
         with self.assertRaises(ValueError):
             LibbyClient.parse_datetime("2023/05/30 23:01:14")
 
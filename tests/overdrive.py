@@ -7,13 +7,41 @@
 # See https://github.com/ping/libby-calibre-plugin for more
 # information
 #
+import json
 import math
+import threading
 from functools import cmp_to_key
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from overdrive import LibraryMediaSearchParams, OverDriveClient
 from .base import BaseTests
 
 
+class ConditionalRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves a json document with an ETag, and supports If-None-Match.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.request_headers.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.server.etag)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.content).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", "Wed, 21 Oct 2015 07:28:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+
 class OverDriveClientTests(BaseTests):
     def setUp(self):
         super().setUp()
@@ -48,6 +76,39 @@ class OverDriveClientTests(BaseTests):
             with self.subTest("media response", k=k):
                 self.assertIn(k, item, msg=f'"{k}" not found')
 
+    def test_conditional_request(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ConditionalRequestHandler)
+        server.content = {"id": "284716", "title": "Ipsum Debitis"}
+        server.etag = '"abc"'
+        server.request_headers = []
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = OverDriveClient(max_retries=0, timeout=5, logger=self.logger)
+        client.api_base = "http://127.0.0.1:{}/".format(server.server_address[1])
+
+        res = client.media("284716", validators={})
+        self.assertFalse(res.not_modified)
+        self.assertEqual(res.content, server.content)
+        self.assertEqual(res.validators["ETag"], server.etag)
+        self.assertIn("Last-Modified", res.validators)
+        self.assertNotIn("If-None-Match", server.request_headers[-1])
+
+        res = client.media("284716", validators=res.validators)
+        self.assertTrue(res.not_modified)
+        self.assertIsNone(res.content)
+        self.assertEqual(server.request_headers[-1]["If-None-Match"], server.etag)
+        self.assertIn("If-Modified-Since", server.request_headers[-1])
+
+        server.etag = '"def"'
+        res = client.media("284716", validators=res.validators)
+        self.assertFalse(res.not_modified)
+        self.assertEqual(res.validators["ETag"], server.etag)
+
+        # without validators, the response content is returned as before
+        self.assertEqual(client.media("284716"), server.content)
+
     def test_libraries(self):
         all_library_keys = [
             "lapl",